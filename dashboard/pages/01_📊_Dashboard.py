@@ -11,7 +11,7 @@ import plotly.express as px
 from datetime import datetime, date, timedelta
 
 from utils.auth import check_authentication
-from utils.api_client import get_all_products, get_devices, get_transactions, get_inventory_stats, get_device_inventory, get_advanced_analytics
+from utils.api_client import get_all_products, get_devices, get_transactions, get_inventory_stats, get_alerts, get_advanced_analytics
 from utils.helpers import format_currency, format_number, format_datetime, stock_status_color
 
 st.set_page_config(page_title="Dashboard — Vending Admin", page_icon="📊", layout="wide")
@@ -63,11 +63,39 @@ total_revenue_overall = analytics_data.get('total_revenue', 0) if analytics_data
 
 k1.metric("💰 Tổng Doanh Thu", format_currency(total_revenue_overall))
 k2.metric("📦 Mặt Hàng", len(products))
-k3.metric("🖥️ Máy Kết Nối", len(devices))
+online_count = sum(1 for d in devices if d.get("online"))
+k3.metric("🖥️ Máy Online", f"{online_count}/{len(devices)}")
 k4.metric("🧾 Tổng Giao Dịch (Kỳ này)", format_number(len(df_trans)))
 
 st.markdown("---")
 
+# ── Live Fleet Status ───────────────────────────────────────────────────────
+@st.fragment(run_every=15)
+def fleet_status():
+    """Chỉ phần này tự làm mới mỗi 15 giây (server trả trạng thái từ bộ nhớ, không tốn query)."""
+    st.subheader("🟢 Trạng Thái Máy (Live)")
+    resp = get_devices()
+    fleet = resp.get("devices", []) if resp.get("success") else []
+    if not fleet:
+        st.info("Chưa có máy nào.")
+        return
+    rows = []
+    for d in fleet:
+        online = d.get("online")
+        rows.append({
+            "Máy": d.get("device_id"),
+            "Trạng thái": "🟢 Online" if online else ("🔴 Offline" if online is False else "⚪ Chưa rõ"),
+            "Từ lúc": format_datetime(d.get("since")),
+            "Liên lạc cuối": format_datetime(d.get("last_seen")),
+            "Sản phẩm": d.get("product_count", 0),
+            "Tồn kho": d.get("total_units", 0),
+        })
+    st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+
+fleet_status()
+
+st.markdown("---")
+
 # ── Phân Tích Chuyên Sâu (Charts) ─────────────────────────────────────────
 st.markdown("### 🔍 Phân Tích Chuyên Sâu")
 col1, col2 = st.columns(2)
@@ -168,23 +196,23 @@ st.markdown("---")
 st.subheader("⚠️ Cảnh Báo Tồn Kho Thấp")
 if devices:
     low_stock_rows = []
-    for dev in devices:
-        dev_id = dev.get("device_id", "")
-        inv_resp = get_device_inventory(dev_id)
-        if inv_resp.get("success"):
-            for item in inv_resp.get("inventory", []):
-                ul = item.get("units_left", 0)
-                if ul < 10:
-                    low_stock_rows.append({
-                        "Máy": dev_id,
-                        "Sản phẩm": item.get("item_name"),
-                        "Tồn kho": ul,
-                        "Trạng thái": stock_status_color(ul),
-                    })
+    # Cảnh báo do server đánh giá ngay khi tồn kho thay đổi (ngưỡng cấu hình theo máy / sản phẩm)
+    alerts_resp = get_alerts(status="open")
+    if alerts_resp.get("success"):
+        for alert in alerts_resp.get("alerts", []):
+            ul = alert.get("units_left") or 0
+            low_stock_rows.append({
+                "Máy": alert.get("device_id"),
+                "Sản phẩm": alert.get("item_name"),
+                "Tồn kho": ul,
+                "Ngưỡng": alert.get("threshold"),
+                "Trạng thái": stock_status_color(ul),
+                "Từ lúc": format_datetime(alert.get("opened_at")),
+            })
     if low_stock_rows:
         st.dataframe(pd.DataFrame(low_stock_rows), use_container_width=True)
     else:
-        st.success("✅ Tất cả sản phẩm đều có tồn kho đủ (≥ 10).")
+        st.success("✅ Không có cảnh báo tồn kho thấp.")
 
 # ── Recent Transactions & Export ────────────────────────────────────────────
 st.subheader("📋 Giao Dịch Gần Nhất")
@@ -14,7 +14,7 @@ from utils.api_client import (
     get_all_products, create_product, update_product,
     delete_product, get_image_url, upload_image,
     get_devices, update_device_inventory, get_device_inventory,
-    remove_device_inventory
+    get_fleet_inventory, fleet_assign_product, remove_device_inventory
 )
 from utils.helpers import format_currency, format_datetime, validate_image_file
 from config import PAGINATION_SIZE
@@ -128,16 +128,13 @@ with tab_create:
                 conflict_msg = ""
                 if initial_stock > 0 and device_ids:
                     devs_to_check = device_ids if target_device == "Tất cả các máy" else [target_device]
-                    for dev in devs_to_check:
-                        inv_resp = get_device_inventory(dev)
-                        if inv_resp.get("success"):
-                            for item in inv_resp.get("inventory", []):
-                                if item.get("slot_number") == slot_number:
-                                    slot_conflict = True
-                                    conflict_msg = f"Máy **{dev}** đang chứa sản phẩm **'{item.get('item_name')}'** tại Ô số **{slot_number}**."
-                                    break
-                        if slot_conflict:
-                            break
+                    inv_resp = get_fleet_inventory(device_ids=devs_to_check)
+                    if inv_resp.get("success"):
+                        for item in inv_resp.get("inventory", []):
+                            if item.get("slot_number") == slot_number:
+                                slot_conflict = True
+                                conflict_msg = f"Máy **{item.get('device_id')}** đang chứa sản phẩm **'{item.get('item_name')}'** tại Ô số **{slot_number}**."
+                                break
                 
                 if slot_conflict:
                     st.error(f"❌ **Lỗi xung đột vị trí:** {conflict_msg} Vui lòng chọn ô khác để tạo!")
@@ -149,13 +146,15 @@ with tab_create:
                         success_msgs = [f"✅ Tạo sản phẩm **{name.strip()}** thành công!"]
                         
                         if initial_stock > 0 and device_ids:
-                            devs_to_update = device_ids if target_device == "Tất cả các máy" else [target_device]
-                            for dev in devs_to_update:
-                                stock_res = update_device_inventory(dev, name.strip(), initial_stock, slot_number)
-                                if stock_res.get("success"):
+                            devs_to_update = None if target_device == "Tất cả các máy" else [target_device]
+                            stock_res = fleet_assign_product(name.strip(), slot_number, initial_stock, device_ids=devs_to_update)
+                            if stock_res.get("success"):
+                                for dev in stock_res.get("assigned", []):
                                     success_msgs.append(f"📦 Đã set {initial_stock} sản phẩm cho máy {dev} ở Ô {slot_number}.")
-                                else:
-                                    st.warning(f"⚠️ Lỗi set tồn kho máy {dev}: {stock_res.get('message')}")
+                                for dev in stock_res.get("skipped", []):
+                                    st.warning(f"⚠️ Máy {dev}: Ô {slot_number} đang có sản phẩm khác, đã bỏ qua.")
+                            else:
+                                st.warning(f"⚠️ Lỗi set tồn kho: {stock_res.get('message')}")
                         
                         if image_file:
                             valid, err = validate_image_file(image_file)
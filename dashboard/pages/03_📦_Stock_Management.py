@@ -9,7 +9,7 @@ import streamlit as st
 import pandas as pd
 
 from utils.auth import check_authentication
-from utils.api_client import get_devices, get_all_products, get_device_inventory
+from utils.api_client import get_devices, get_all_products, get_fleet_inventory
 from utils.helpers import format_datetime, stock_status_color
 
 st.set_page_config(page_title="Kho Hàng — Vending Admin", page_icon="📦", layout="wide")
@@ -35,17 +35,10 @@ if not devices:
     st.warning("⚠️ Chưa có máy nào trong hệ thống. Hãy đảm bảo thiết bị đã kết nối và đồng bộ.")
     st.stop()
 
-# Tải toàn bộ tồn kho của tất cả các máy để gom chung vào 1 bảng
-all_inventory = []
+# Tải toàn bộ tồn kho của tất cả các máy để gom chung vào 1 bảng (1 request cho cả hệ thống)
 with st.spinner("Đang tải dữ liệu tồn kho chi tiết..."):
-    for dev in devices:
-        dev_id = dev.get("device_id")
-        inv_resp = get_device_inventory(dev_id)
-        if inv_resp.get("success"):
-            items = inv_resp.get("inventory", [])
-            for item in items:
-                item["device_id"] = dev_id
-                all_inventory.append(item)
+    fleet_resp = get_fleet_inventory()
+all_inventory = fleet_resp.get("inventory", []) if fleet_resp.get("success") else []
 
 df_inv = pd.DataFrame(all_inventory)
 
@@ -93,7 +93,8 @@ else:
         )
         
         total_fetched = len(users)
-        st.caption(f"Đang hiển thị {total_fetched} khách hàng (Trang {page}). Click vào một dòng để xem lịch sử mua hàng.")
+        total_label = f"≈{resp.get('total', 0):,}" if resp.get("total_is_estimate") else f"{resp.get('total', 0):,}"
+        st.caption(f"Đang hiển thị {total_fetched}/{total_label} khách hàng (Trang {page}). Click vào một dòng để xem lịch sử mua hàng.")
         
         # CẬP NHẬT: Chỉ gán selected_rows khi event đã thực sự được tạo
         selected_rows = event.selection.rows
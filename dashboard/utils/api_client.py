@@ -166,6 +166,26 @@ def get_device_inventory(device_id):
     return _get(f"/api/devices/{device_id}/inventory")
 
 
+def get_fleet_inventory(device_ids=None, item_names=None, units_left_below=None):
+    """GET /api/devices/inventory — tồn kho toàn bộ máy trong 1 request (kèm tổng hợp)."""
+    params = {}
+    if device_ids:
+        params["device_id"] = list(device_ids)
+    if item_names:
+        params["item_name"] = list(item_names)
+    if units_left_below is not None:
+        params["units_left_below"] = units_left_below
+    return _get("/api/devices/inventory", params=params)
+
+
+def get_alerts(status="open", device_id=None):
+    """GET /api/admin/alerts — cảnh báo tồn kho do server tự đánh giá."""
+    params = {"status": status}
+    if device_id:
+        params["device_id"] = device_id
+    return _get("/api/admin/alerts", params=params)
+
+
 # Ví dụ sửa trong utils/api_client.py
 def update_device_inventory(device_id, item_name, units_left, slot_number):
     """PUT /api/devices/<device_id>/inventory/<item_name>"""
@@ -177,6 +197,48 @@ def update_device_inventory(device_id, item_name, units_left, slot_number):
     return _put(f"/api/devices/{device_id}/inventory/{item_name}", json=payload)
 
 
+def set_planogram(device_id, slots, clear=False):
+    """PUT /api/devices/<device_id>/planogram — ghi đè toàn bộ bố cục ô của máy.
+    slots: list dict {"slot_number", "item_name", "units_left"}; slots rỗng cần clear=True."""
+    payload = {"slots": slots}
+    if clear:
+        payload["clear"] = True
+    return _put(f"/api/devices/{device_id}/planogram", json=payload)
+
+
+def fleet_assign_product(item_name, slot_number, units_left, device_ids=None, custom_price=None, on_slot_conflict="skip"):
+    """POST /api/admin/fleet/assign — gán 1 sản phẩm cho nhiều máy (device_ids=None: tất cả) trong 1 request."""
+    payload = {
+        "item_name": item_name,
+        "slot_number": slot_number,
+        "units_left": units_left,
+        "on_slot_conflict": on_slot_conflict,
+    }
+    if device_ids:
+        payload["device_ids"] = list(device_ids)
+    if custom_price is not None:
+        payload["custom_price"] = custom_price
+    return _post("/api/admin/fleet/assign", json=payload)
+
+
+def fleet_remove_product(item_name, device_ids=None):
+    """POST /api/admin/fleet/remove — gỡ 1 sản phẩm khỏi nhiều máy (device_ids=None: tất cả)."""
+    payload = {"item_name": item_name}
+    if device_ids:
+        payload["device_ids"] = list(device_ids)
+    return _post("/api/admin/fleet/remove", json=payload)
+
+
+def clone_device_layout(template_device_id, target_device_ids, include_pricing=True, copy_units=False):
+    """POST /api/admin/fleet/clone — sao chép bố cục + giá riêng từ máy mẫu sang các máy đích."""
+    return _post("/api/admin/fleet/clone", json={
+        "template_device_id": template_device_id,
+        "target_device_ids": list(target_device_ids),
+        "include_pricing": include_pricing,
+        "copy_units": copy_units,
+    })
+
+
 def set_custom_price(device_id, item_name, price):
     """POST /api/products/set_custom"""
     return _post("/api/products/set_custom", json={
@@ -0,0 +1,119 @@
+"""
+Low-stock alert engine.
+
+Thresholds live in alert_thresholds; '' in device_id / item_name means "any".
+The most specific row wins:
+
+    (device, item)  >  ('', item)  >  (device, '')  >  ('', '')  >  LOW_STOCK_THRESHOLD
+
+An alert opens when units_left < threshold and only resolves once units_left
+>= threshold + LOW_STOCK_CLEAR_MARGIN (hysteresis, so a machine hovering
+around the threshold does not flap). Removing the product from the machine
+resolves its alert as well.
+
+Evaluation is incremental: every code path that changes device_inventory
+calls evaluate_stock() in the same transaction with only the (device, item)
+pairs or devices it touched. New events are written to the outbox in that
+transaction and pushed on the admin topic by the relay.
+"""
+
+import logging
+import os
+from datetime import datetime, timezone
+
+from database import dict_fetchall
+
+logger = logging.getLogger(__name__)
+
+LOW_STOCK_THRESHOLD    = int(os.environ.get("LOW_STOCK_THRESHOLD", 10))
+LOW_STOCK_CLEAR_MARGIN = int(os.environ.get("LOW_STOCK_CLEAR_MARGIN", 3))
+
+TOPIC_ALERTS = "vending_machine/admin/alerts"
+
+_EVALUATE_SQL = """
+    WITH keys AS (
+        SELECT k.device_id, k.item_name
+        FROM unnest(%(pair_devices)s::text[], %(pair_items)s::text[]) AS k(device_id, item_name)
+        UNION
+        SELECT di.device_id, di.item_name FROM device_inventory di
+        WHERE %(everything)s OR di.device_id = ANY(%(devices)s)
+        UNION
+        SELECT a.device_id, a.item_name FROM stock_alerts a
+        WHERE a.resolved_at IS NULL AND (%(everything)s OR a.device_id = ANY(%(devices)s))
+    ),
+    cur AS (
+        SELECT k.device_id, k.item_name, di.units_left,
+               COALESCE(t.threshold, %(default)s) AS threshold
+        FROM keys k
+        LEFT JOIN device_inventory di ON di.device_id = k.device_id AND di.item_name = k.item_name
+        LEFT JOIN LATERAL (
+            SELECT th.threshold FROM alert_thresholds th
+            WHERE th.device_id IN (k.device_id, '') AND th.item_name IN (k.item_name, '')
+            ORDER BY (th.device_id <> '' AND th.item_name <> '') DESC,
+                     (th.item_name <> '') DESC,
+                     (th.device_id <> '') DESC
+            LIMIT 1
+        ) t ON TRUE
+    ),
+    opened AS (
+        INSERT INTO stock_alerts (device_id, item_name, units_left, threshold, opened_at)
+        SELECT device_id, item_name, units_left, threshold, %(now)s FROM cur
+        WHERE units_left < threshold
+        ON CONFLICT (device_id, item_name) WHERE resolved_at IS NULL DO NOTHING
+        RETURNING alert_id, device_id, item_name, units_left, threshold, opened_at
+    ),
+    resolved AS (
+        UPDATE stock_alerts a SET resolved_at = %(now)s
+        FROM cur c
+        WHERE a.device_id = c.device_id AND a.item_name = c.item_name AND a.resolved_at IS NULL
+          AND (c.units_left IS NULL OR c.units_left >= c.threshold + %(margin)s)
+        RETURNING a.alert_id, a.device_id, a.item_name, c.units_left, a.threshold, a.opened_at
+    )
+    SELECT 'opened' AS event, o.* FROM opened o
+    UNION ALL
+    SELECT 'resolved' AS event, r.* FROM resolved r
+"""
+
+
+def _severity(units_left):
+    if units_left is None:
+        return None
+    return 'out' if units_left <= 0 else 'low'
+
+
+def evaluate_stock(cursor, pairs=(), device_ids=(), everything=False, now_iso=None):
+    """
+    Re-evaluate alerts for the given (device_id, item_name) pairs and/or every
+    product of device_ids (or the whole fleet). Runs inside the caller's
+    transaction; returns the list of opened / resolved events.
+    """
+    pairs = list(dict.fromkeys(pairs))
+    device_ids = list(dict.fromkeys(device_ids))
+    if not pairs and not device_ids and not everything:
+        return []
+    now_iso = now_iso or datetime.now(timezone.utc).isoformat()
+
+    cursor.execute(_EVALUATE_SQL, {
+        'pair_devices': [p[0] for p in pairs],
+        'pair_items':   [p[1] for p in pairs],
+        'devices':      device_ids,
+        'everything':   everything,
+        'default':      LOW_STOCK_THRESHOLD,
+        'margin':       LOW_STOCK_CLEAR_MARGIN,
+        'now':          now_iso,
+    })
+    events = dict_fetchall(cursor)
+    for event in events:
+        event['severity'] = _severity(event['units_left'])
+    if events:
+        from outbox import Outbox
+        Outbox(cursor).publish_stock_alerts(events)
+    return events
+
+
+def alerts_payload(events):
+    """MQTT payload for a batch of alert events."""
+    return {
+        "event":  "stock_alerts",
+        "alerts": events,
+    }
@@ -0,0 +1,210 @@
+"""
+Analytics lane: dashboard reports run in a bounded process pool.
+
+The analytics queries scan the whole transaction history, and the restock
+forecast / related-products rebuild then spend seconds in pandas and SciPy.
+In a cooperative worker that CPU time would stall every greenlet, device
+polls included. The jobs below therefore run in a small per-worker pool of
+spawned processes (ANALYTICS_PROCESSES, 0 = run inline). Their Postgres
+sessions carry statement_timeout = ANALYTICS_STATEMENT_TIMEOUT_MS, and the
+request gives up after ANALYTICS_TIMEOUT seconds.
+
+Job functions live at module level and take / return plain Python values
+because they are pickled across the process boundary.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from database import getDatabaseConnection, dict_fetchall
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_PROCESSES            = int(os.environ.get("ANALYTICS_PROCESSES", 1))          # mỗi worker, 0 = chạy ngay trong worker
+ANALYTICS_TIMEOUT              = float(os.environ.get("ANALYTICS_TIMEOUT", 120))        # seconds
+ANALYTICS_STATEMENT_TIMEOUT_MS = int(os.environ.get("ANALYTICS_STATEMENT_TIMEOUT_MS", 60000))
+
+
+# ---------------------------------------------------------------------------
+# Jobs (run inside the pool processes)
+# ---------------------------------------------------------------------------
+def advanced_analytics(device_id=None):
+    """Data of GET /api/admin/analytics."""
+    conn = getDatabaseConnection()
+    try:
+        cursor = conn.cursor()
+
+        # Điều kiện WHERE linh hoạt
+        where_clause = "WHERE payment_status = 'completed'"
+        params = []
+        if device_id:
+            where_clause += " AND device_id = %s"
+            params.append(device_id)
+
+        # 1. Tổng doanh thu (Có lọc theo máy)
+        cursor.execute(f"SELECT COALESCE(SUM(total_amount), 0) FROM transactions {where_clause}", params)
+        total_revenue = cursor.fetchone()[0]
+
+        # 2. Top sản phẩm bán chạy tổng hợp
+        cursor.execute(f"""
+            SELECT
+                COALESCE(elem->>'product_name', elem->>'name', elem->>'item_name') AS item_name,
+                SUM((elem->>'quantity')::int) AS units_sold
+            FROM transactions, json_array_elements(items::json) AS elem
+            {where_clause}
+            GROUP BY 1 ORDER BY units_sold DESC LIMIT 5
+        """, params)
+        top_products = dict_fetchall(cursor)
+
+        # 3. Sản phẩm "ế" (Bán <= 3 cái) tại từng máy
+        cursor.execute(f"""
+            SELECT
+                device_id,
+                COALESCE(elem->>'product_name', elem->>'name', elem->>'item_name') AS item_name,
+                SUM((elem->>'quantity')::int) AS units_sold
+            FROM transactions, json_array_elements(items::json) AS elem
+            {where_clause}
+            GROUP BY 1, 2 HAVING SUM((elem->>'quantity')::int) <= 3
+            ORDER BY units_sold ASC
+        """, params)
+        underperforming = dict_fetchall(cursor)
+
+        # 4. Doanh thu theo từng máy (Luôn lấy toàn hệ thống để vẽ chart bar)
+        cursor.execute("""
+            SELECT device_id, SUM(total_amount) as revenue
+            FROM transactions WHERE payment_status = 'completed'
+            GROUP BY device_id ORDER BY revenue DESC
+        """)
+        revenue_by_device = dict_fetchall(cursor)
+
+        # 5. [THÊM MỚI] Top sản phẩm bán chạy CHIA THEO TỪNG MÁY
+        cursor.execute("""
+            SELECT
+                device_id,
+                COALESCE(elem->>'product_name', elem->>'name', elem->>'item_name') AS item_name,
+                SUM((elem->>'quantity')::int) AS units_sold
+            FROM transactions, json_array_elements(items::json) AS elem
+            WHERE payment_status = 'completed'
+            GROUP BY 1, 2
+            ORDER BY device_id, units_sold DESC
+        """)
+        top_products_by_device = dict_fetchall(cursor)
+    finally:
+        conn.close()
+
+    return {
+        'total_revenue': total_revenue,
+        'top_products': top_products,
+        'revenue_by_device': revenue_by_device,
+        'underperforming_products': underperforming,
+        'top_products_by_device': top_products_by_device  # Key quan trọng cho giao diện mới
+    }
+
+
+def restock_plan(target_days, lookback_days, max_units=None, device_filter=()):
+    """pick_list / machines of GET /api/admin/restock_plan."""
+    from forecasting import load_daily_sales, load_stock, forecast_stockout, restock_plan as plan, to_records
+
+    conn = getDatabaseConnection()
+    try:
+        cursor = conn.cursor()
+        sales = load_daily_sales(cursor, lookback_days)
+        stock = load_stock(cursor)
+    finally:
+        conn.close()
+
+    if device_filter:
+        stock = stock[stock['device_id'].isin(device_filter)]
+
+    forecast = forecast_stockout(sales, stock, lookback_days=lookback_days)
+    per_machine, pick_list = plan(forecast, target_days=target_days, max_units=max_units)
+    return {'pick_list': to_records(pick_list), 'machines': to_records(per_machine)}
+
+
+def rebuild_related(top_k, metric):
+    from recommendations import rebuild_related_products
+    return rebuild_related_products(top_k=top_k, metric=metric)
+
+
+# ---------------------------------------------------------------------------
+# Per-worker process pool
+# ---------------------------------------------------------------------------
+def _init_process(statement_timeout_ms):
+    # libpq đọc PGOPTIONS cho mọi kết nối mở trong process này
+    options = os.environ.get("PGOPTIONS", "")
+    os.environ["PGOPTIONS"] = f"{options} -c statement_timeout={statement_timeout_ms}".strip()
+
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+_stats = Counter()   # submitted / completed / failed / timeouts / in_flight
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # spawn: process con sạch, không thừa hưởng socket / thread / gevent của worker
+                _pool = ProcessPoolExecutor(ANALYTICS_PROCESSES, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_process, initargs=(ANALYTICS_STATEMENT_TIMEOUT_MS,))
+    return _pool
+
+
+def run_analytics(fn, *args, **kwargs):
+    """Run a job in the analytics pool and wait (cooperatively) for its result."""
+    global _pool
+    if ANALYTICS_PROCESSES <= 0:
+        return fn(*args, **kwargs)
+
+    _stats["submitted"] += 1
+    _stats["in_flight"] += 1
+    try:
+        future = _get_pool().submit(fn, *args, **kwargs)
+        try:
+            result = future.result(timeout=ANALYTICS_TIMEOUT)
+        except FutureTimeout:
+            future.cancel()
+            _stats["timeouts"] += 1
+            raise TimeoutError(f"{fn.__name__} did not finish within {ANALYTICS_TIMEOUT:g}s")
+        except BrokenProcessPool:
+            # Process con chết (OOM, kill): tạo pool mới cho lần sau
+            with _pool_lock:
+                _pool = None
+            _stats["failed"] += 1
+            raise
+        except Exception:
+            _stats["failed"] += 1
+            raise
+        _stats["completed"] += 1
+        return result
+    finally:
+        _stats["in_flight"] -= 1
+
+
+def pool_stats():
+    return {"processes": ANALYTICS_PROCESSES, "statement_timeout_ms": ANALYTICS_STATEMENT_TIMEOUT_MS,
+            **{key: _stats[key] for key in ("submitted", "completed", "failed", "timeouts", "in_flight")}}
+
+
+def shutdown_analytics():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _reset_after_fork():
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+    _stats.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -7,12 +7,19 @@ import logging
 
 # Import hàm khởi tạo DB
 from database import create_tables
+from json_provider import init_json
+from compression import init_compression
+from metrics import init_metrics
+from lanes import init_lanes
 
 # Import các Blueprints từ thư mục routes
 from routes.users import user_bp
 from routes.products import product_bp
 from routes.transactions import trans_bp
 from routes.devices import device_bp
+from routes.fleet import fleet_bp
+from routes.alerts import alerts_bp
+from routes.catalog import catalog_bp
 
 # --- CẤU HÌNH LOGGING ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
@@ -24,6 +31,10 @@ STATIC_FOLDER = os.path.join(os.path.dirname(__file__), 'static')
 # Khởi tạo Flask app
 app = Flask(__name__, static_folder=STATIC_FOLDER)
 CORS(app)
+init_json(app)          # orjson cho jsonify / get_json
+init_compression(app)   # gzip / brotli cho response lớn
+init_metrics(app)       # GET /metrics (Prometheus); đăng ký trước lanes để đo cả request bị từ chối
+init_lanes(app)         # lane device / admin / analytics, GET /api/admin/lanes
 
 # --- KHỞI TẠO DATABASE ---
 # Đảm bảo các bảng được tạo khi app khởi động
@@ -37,12 +48,32 @@ app.register_blueprint(user_bp)
 app.register_blueprint(product_bp)
 app.register_blueprint(trans_bp)
 app.register_blueprint(device_bp)
+app.register_blueprint(fleet_bp)
+app.register_blueprint(alerts_bp)
+app.register_blueprint(catalog_bp)
 
 # --- ROUTE CƠ BẢN ---
 @app.route('/')
 def healthCheck():
     return jsonify({'status': 'OK', 'message': 'Vending Machine Central Server is running'})
 
+@app.route('/api/admin/mqtt/stats')
+def mqttStats():
+    """Tồn đọng outbox (chưa gửi) và, nếu worker này có publisher trực tiếp, hàng đợi publish của nó."""
+    import mqtt_publisher
+    from database import getDatabaseConnection
+    conn = getDatabaseConnection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*), MIN(created_at) FROM outbox WHERE delivered_at IS NULL")
+        pending, oldest = cursor.fetchone()
+    finally:
+        conn.close()
+    publisher = mqtt_publisher._publisher_instance
+    return jsonify({'success': True, 'pid': os.getpid(),
+                    'outbox': {'pending': pending, 'oldest_pending_at': oldest},
+                    'mqtt': publisher.metrics() if publisher else None})
+
 # --- KHỞI CHẠY (Dành cho chạy local test, trên Docker sẽ dùng Gunicorn) ---
 if __name__ == '__main__':
     logger.info("Server Vending Machine running on port 5000...")
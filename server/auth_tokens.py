@@ -0,0 +1,226 @@
+"""
+Stateless signed session tokens for users and devices.
+
+Token format (URL-safe, no padding):
+
+    base64(json claims) "." base64(HMAC-SHA256(secret, base64(json claims)))
+
+Claims: sub (user_id / device_id), typ ("user" | "device"), scp (scopes),
+iat, exp, jti. Verification is pure in-memory work; the only DB access is a
+periodic refresh of the small revocation list, cached per worker.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from functools import wraps
+
+from flask import g, jsonify, request
+
+from database import getDatabaseConnection
+
+logger = logging.getLogger(__name__)
+
+SECRET_KEY = os.environ.get("SECRET_KEY", "change-me").encode()
+USER_TOKEN_TTL   = int(os.environ.get("USER_TOKEN_TTL", 15 * 60))           # phiên kiosk ngắn
+DEVICE_TOKEN_TTL = int(os.environ.get("DEVICE_TOKEN_TTL", 30 * 24 * 3600))
+# Khoá chung để máy đổi lấy token lần đầu (cấp phát khi lắp máy)
+DEVICE_PROVISION_KEY = os.environ.get("DEVICE_PROVISION_KEY", "")
+# Bật lên khi toàn bộ máy đã dùng token: không còn tin header X-Device-ID
+REQUIRE_DEVICE_TOKEN = os.environ.get("REQUIRE_DEVICE_TOKEN", "false").lower() == "true"
+_REVOCATION_REFRESH = int(os.environ.get("TOKEN_REVOCATION_REFRESH", 30))  # seconds
+
+USER_SCOPES   = ("user",)
+DEVICE_SCOPES = ("device", "products:read", "transactions:write", "users:sync")
+
+
+class TokenError(Exception):
+    """Raised when a token is missing, malformed, expired, revoked or lacks a scope."""
+
+
+# ---------------------------------------------------------------------------
+# Encoding helpers
+# ---------------------------------------------------------------------------
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _sign(body: str) -> str:
+    return _b64encode(hmac.new(SECRET_KEY, body.encode(), hashlib.sha256).digest())
+
+
+# ---------------------------------------------------------------------------
+# Revocation list (per-worker cache)
+# ---------------------------------------------------------------------------
+
+class _RevocationCache:
+    """Set of revoked jti values, reloaded from Postgres at most every few seconds."""
+
+    def __init__(self, refresh_seconds):
+        self._refresh = refresh_seconds
+        self._jtis = frozenset()
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        conn = getDatabaseConnection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT jti FROM revoked_tokens WHERE expires_at > %s", (int(time.time()),))
+            self._jtis = frozenset(row[0] for row in cursor.fetchall())
+        finally:
+            conn.close()
+
+    def contains(self, jti):
+        now = time.monotonic()
+        stale = self._loaded_at is None or now - self._loaded_at > self._refresh
+        if stale and self._lock.acquire(blocking=False):
+            try:
+                self._reload()
+            except Exception as exc:
+                # Giữ danh sách cũ nếu DB lỗi, thử lại ở lần sau
+                logger.warning("Token revocation list refresh failed: %s", exc)
+            finally:
+                self._loaded_at = now
+                self._lock.release()
+        return jti in self._jtis
+
+    def add(self, jti):
+        self._jtis = self._jtis | {jti}
+
+
+_revoked = _RevocationCache(_REVOCATION_REFRESH)
+
+
+# ---------------------------------------------------------------------------
+# Public API
+# ---------------------------------------------------------------------------
+
+def issue_token(subject: str, kind: str, scopes=(), ttl: int | None = None) -> tuple[str, dict]:
+    """Create a signed token. Returns (token, claims)."""
+    if ttl is None:
+        ttl = DEVICE_TOKEN_TTL if kind == "device" else USER_TOKEN_TTL
+    now = int(time.time())
+    claims = {
+        "sub": subject,
+        "typ": kind,
+        "scp": list(scopes),
+        "iat": now,
+        "exp": now + ttl,
+        "jti": uuid.uuid4().hex,
+    }
+    body = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return f"{body}.{_sign(body)}", claims
+
+
+def verify_token(token: str, scope: str | None = None, kind: str | None = None) -> dict:
+    """Validate signature, expiry, revocation, kind and scope. Returns the claims."""
+    try:
+        body, signature = token.split(".", 1)
+    except (AttributeError, ValueError):
+        raise TokenError("Malformed token")
+
+    # So sánh bytes: compare_digest với str chứa ký tự ngoài ASCII sẽ ném TypeError
+    if not hmac.compare_digest(signature.encode(), _sign(body).encode()):
+        raise TokenError("Invalid token signature")
+
+    try:
+        claims = json.loads(_b64decode(body))
+    except ValueError:
+        raise TokenError("Malformed token")
+
+    if claims.get("exp", 0) < time.time():
+        raise TokenError("Token expired")
+    if kind and claims.get("typ") != kind:
+        raise TokenError(f"Token is not a {kind} token")
+    if scope and scope not in claims.get("scp", ()):
+        raise TokenError(f"Token lacks scope '{scope}'")
+    if _revoked.contains(claims.get("jti")):
+        raise TokenError("Token revoked")
+    return claims
+
+
+def revoke_token(jti: str, subject: str | None = None, expires_at: int | None = None):
+    """
+    Persist a revocation and apply it to this worker immediately.
+    Other workers pick it up on their next revocation-list refresh.
+    """
+    if expires_at is None:
+        expires_at = int(time.time()) + max(USER_TOKEN_TTL, DEVICE_TOKEN_TTL)
+    conn = getDatabaseConnection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO revoked_tokens (jti, subject, expires_at)
+            VALUES (%s, %s, %s)
+            ON CONFLICT(jti) DO NOTHING
+        """, (jti, subject, expires_at))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    _revoked.add(jti)
+
+
+def bearer_token() -> str | None:
+    """Lấy token từ header Authorization: Bearer <token>."""
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        return header[7:].strip() or None
+    return None
+
+
+def current_identity() -> dict | None:
+    """Claims của request hiện tại (đã verify, cache trong flask.g). None nếu không gửi token."""
+    if "identity" not in g:
+        token = bearer_token()
+        g.identity = verify_token(token) if token else None
+    return g.identity
+
+
+def current_device_id(claimed: str | None = None) -> str | None:
+    """
+    Trusted device identity for the request.
+
+    A valid device token wins over anything the client claims. Without a token
+    the legacy X-Device-ID header / body value is accepted unless
+    REQUIRE_DEVICE_TOKEN is enabled.
+    """
+    identity = current_identity()
+    if identity is not None:
+        if identity.get("typ") != "device":
+            raise TokenError("Token is not a device token")
+        return identity["sub"]
+    if REQUIRE_DEVICE_TOKEN:
+        raise TokenError("Device token required")
+    return claimed or request.headers.get("X-Device-ID")
+
+
+def require_token(scope: str | None = None, kind: str | None = None):
+    """Decorator: trả 401 nếu request không có token hợp lệ; claims nằm ở flask.g.identity."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                token = bearer_token()
+                if not token:
+                    raise TokenError("Missing bearer token")
+                g.identity = verify_token(token, scope=scope, kind=kind)
+            except TokenError as te:
+                return jsonify({'success': False, 'message': str(te)}), 401
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
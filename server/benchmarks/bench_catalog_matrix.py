@@ -0,0 +1,165 @@
+"""
+Benchmark: GET /api/products served from the in-memory catalog matrix vs the SQL join.
+
+Also measures the CATALOG_MATRIX=false fallback, where concurrent identical
+requests in a worker share one Postgres render through SingleFlight
+(--render-ms simulates the query; with --sql the real _render_catalog runs).
+
+    python benchmarks/bench_catalog_matrix.py --machines 500 --products 60
+    python benchmarks/bench_catalog_matrix.py --sql      # cũng đo đường SQL trên DATABASE_URL
+"""
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from catalog_matrix import CatalogMatrix
+from singleflight import SingleFlight
+
+_SQL = """
+    SELECT i.item_name, i.price, i.description,
+           i.image_filename, i.image_url, i.created_at,
+           COALESCE(d.units_left, 0) as units_left,
+           d.slot_number,
+           dp.custom_price
+    FROM inventory i
+    LEFT JOIN device_inventory d ON i.item_name = d.item_name AND d.device_id = %s
+    LEFT JOIN device_pricing dp ON i.item_name = dp.item_name AND dp.device_id = %s
+"""
+
+
+def synthetic_catalog(n_machines, n_products, n_slots, seed=11):
+    """Sinh inventory, device_inventory và device_pricing như trong DB."""
+    rng = np.random.default_rng(seed)
+    now = datetime(2025, 1, 1)
+    products = [(i + 1, f"product_{i:03d}", float(rng.integers(5, 40) * 1000), 5000.0, "desc",
+                 None, f"/api/images/{i}.webp", now, now) for i in range(n_products)]
+    stock, pricing = [], []
+    for m in range(n_machines):
+        device_id = f"VM{m:05d}"
+        for slot, p in enumerate(rng.choice(n_products, n_slots, replace=False), start=1):
+            stock.append((device_id, products[p][1], int(rng.integers(0, 20)), slot))
+            if rng.random() < 0.1:
+                pricing.append((device_id, products[p][1], float(rng.integers(5, 40) * 1000)))
+    return products, stock, pricing
+
+
+def per_call_us(fn, args_list):
+    t0 = time.perf_counter()
+    for args in args_list:
+        fn(*args)
+    return (time.perf_counter() - t0) / len(args_list) * 1e6
+
+
+def burst(call, threads, rounds):
+    """rounds bursts of `threads` simultaneous call()s; returns ms per burst."""
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        barrier = threading.Barrier(threads)
+
+        def worker():
+            barrier.wait()
+            call()
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+    return (time.perf_counter() - t0) / rounds * 1000
+
+
+def single_flight_report(label, render, threads, rounds):
+    """Same-device bursts with and without SingleFlight; counts how many renders hit the database."""
+    runs = []
+
+    def counted():
+        runs.append(1)
+        return render()
+
+    direct_ms = burst(counted, threads, rounds)
+    direct_runs, runs[:] = len(runs), []
+    flight = SingleFlight()
+    flight_ms = burst(lambda: flight.do(("catalog", "VM00000"), counted), threads, rounds)
+    print(f"{label:<22}: {threads} concurrent requests, {rounds} bursts")
+    print(f"  without single-flight: {direct_ms:8.2f} ms/burst, {direct_runs / rounds:6.1f} renders/burst")
+    print(f"  with single-flight   : {flight_ms:8.2f} ms/burst, {len(runs) / rounds:6.1f} renders/burst "
+          f"(shared {flight.stats['shared']})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--machines", type=int, default=500)
+    parser.add_argument("--products", type=int, default=60)
+    parser.add_argument("--slots", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--render-ms", type=float, default=20, help="simulated Postgres render for the fallback path")
+    parser.add_argument("--flight-threads", type=int, default=50, help="concurrent identical requests per burst")
+    parser.add_argument("--flight-rounds", type=int, default=20)
+    parser.add_argument("--sql", action="store_true", help="also time the SQL path on DATABASE_URL")
+    args = parser.parse_args()
+
+    products, stock, pricing = synthetic_catalog(args.machines, args.products, args.slots)
+    print(f"{args.machines:,} machines, {args.products} products, {len(stock):,} stocked slots")
+
+    t0 = time.perf_counter()
+    matrix = CatalogMatrix(products, stock, pricing)
+    t1 = time.perf_counter()
+    print(f"build matrix          : {(t1 - t0) * 1000:10.2f} ms")
+
+    rng = np.random.default_rng(0)
+    devices = [(matrix.device_ids[i],) for i in rng.integers(0, len(matrix.device_ids), args.requests)]
+    cold = CatalogMatrix(products, stock, pricing)
+    print(f"device catalog (cold) : {per_call_us(cold.device_catalog, [(d,) for d in cold.device_ids]):10.2f} µs")
+    print(f"device catalog (warm) : {per_call_us(matrix.device_catalog, devices):10.2f} µs")
+    print(f"device body (warm)    : {per_call_us(matrix.device_catalog_json, devices):10.2f} µs")
+    print(f"fleet summary         : {per_call_us(matrix.fleet_summary, [(10,)] * 100):10.2f} µs")
+
+    # CATALOG_MATRIX=false: Postgres dựng body, request trùng nhau dùng chung 1 lần render
+    def simulated_render():
+        time.sleep(args.render_ms / 1000)
+        return matrix.device_catalog_json("VM00000")
+
+    single_flight_report(f"fallback ({args.render_ms:g} ms)", simulated_render, args.flight_threads, args.flight_rounds)
+
+    if args.sql:
+        from database import getDatabaseConnection
+        from routes.products import _DEVICE_CATALOG_JSON_SQL
+
+        conn = getDatabaseConnection()
+        try:
+            db_matrix = CatalogMatrix.load(conn)
+            sample = [(db_matrix.device_ids[i],) for i in rng.integers(0, max(1, len(db_matrix.device_ids)), 200)] \
+                if db_matrix.device_ids else [("VM00000",)] * 200
+            cursor = conn.cursor()
+
+            def sql_path(device_id):
+                cursor.execute(_SQL, (device_id, device_id))
+                cursor.fetchall()
+
+            def json_path(device_id):
+                cursor.execute(_DEVICE_CATALOG_JSON_SQL, (device_id, device_id))
+                cursor.fetchone()
+
+            print(f"SQL join (DB)         : {per_call_us(sql_path, sample):10.2f} µs  "
+                  f"({len(db_matrix.device_ids)} machines, {len(db_matrix.item_names)} products)")
+            print(f"SQL json_agg (DB)     : {per_call_us(json_path, sample):10.2f} µs")
+            print(f"matrix (same DB data) : {per_call_us(db_matrix.device_catalog_json, sample):10.2f} µs")
+        finally:
+            conn.close()
+
+        from routes.products import _render_catalog
+        device_id = sample[0][0]
+        # Mỗi luồng mở kết nối riêng như request thật (giới hạn DB_MAX_CONNECTIONS của database.py)
+        single_flight_report("fallback (DB)", lambda: _render_catalog(device_id),
+                             args.flight_threads, args.flight_rounds)
+
+
+if __name__ == "__main__":
+    main()
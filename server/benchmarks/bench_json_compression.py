@@ -0,0 +1,105 @@
+"""
+Benchmark: JSON encoding (Flask stdlib provider vs orjson) and response compression
+for GET /api/transactions?limit=10000 and GET /api/products.
+
+    python benchmarks/bench_json_compression.py --transactions 10000 --products 60
+"""
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+import compression
+import json_provider
+
+
+def synthetic_transactions(n, seed=3):
+    """Dòng giống dict_fetchall(SELECT * FROM transactions)."""
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for i in range(n):
+        items = [{"product_name": f"product_{rng.randrange(60):03d}", "quantity": rng.randint(1, 3),
+                  "price": rng.randrange(5, 40) * 1000} for _ in range(rng.randint(1, 3))]
+        created = (start + timedelta(seconds=37 * i)).isoformat()
+        rows.append({
+            "transaction_id": f"TX{i:08d}",
+            "total_amount": float(sum(it["price"] * it["quantity"] for it in items)),
+            "items": json.dumps(items),
+            "user_id": f"U{rng.randrange(5000):05d}" if rng.random() < 0.6 else None,
+            "device_id": f"VM{rng.randrange(500):05d}",
+            "payment_method": rng.choice(["cash", "qr", "card"]),
+            "payment_status": "completed",
+            "created_at": created,
+            "paid_at": created,
+        })
+    return {"success": True, "total": n * 3, "transactions": rows}
+
+
+def synthetic_products(n, seed=5):
+    rng = random.Random(seed)
+    now = datetime(2025, 1, 1, 8, 30)
+    return {"success": True, "products": [{
+        "item_name": f"product_{i:03d}",
+        "price": float(rng.randrange(5, 40) * 1000),
+        "description": "Nước giải khát đóng chai 330ml, uống lạnh ngon hơn",
+        "image_filename": f"product_{i:03d}.webp",
+        "image_url": f"/api/images/product_{i:03d}.webp",
+        "created_at": now,
+        "units_left": rng.randrange(0, 20),
+        "slot_number": i + 1 if rng.random() < 0.3 else None,
+    } for i in range(n)]}
+
+
+def per_call_ms(fn, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - t0) / repeat * 1000, result
+
+
+def report(name, payload, repeat):
+    app = Flask(__name__)
+    stdlib = DefaultJSONProvider(app)
+    stdlib.compact = True
+
+    print(f"\n{name}")
+    base_ms, base_body = per_call_ms(lambda: stdlib.dumps(payload).encode("utf-8"), repeat)
+    print(f"  {'stdlib json (jsonify)':<24}: {base_ms:9.3f} ms  {len(base_body):>10,} bytes")
+    fast_ms, body = per_call_ms(lambda: json_provider.dumps_bytes(payload), repeat)
+    label = "orjson" if json_provider.orjson is not None else "stdlib json (fallback)"
+    print(f"  {label:<24}: {fast_ms:9.3f} ms  {len(body):>10,} bytes  ({base_ms / fast_ms:.1f}x faster)")
+
+    variants = [("gzip", {"level": level}, f"gzip -{level}") for level in (1, compression.COMPRESS_LEVEL, 9)]
+    if compression.brotli is not None:
+        variants += [("br", {"quality": q}, f"brotli q{q}") for q in (1, compression.COMPRESS_BROTLI_QUALITY, 9)]
+    else:
+        print("  (brotli not installed, skipping br)")
+    for encoding, kwargs, label in variants:
+        ms, packed = per_call_ms(lambda: compression.compress(body, encoding, **kwargs), repeat)
+        print(f"  {label:<24}: {ms:9.3f} ms  {len(packed):>10,} bytes  ({len(packed) / len(body):6.1%} of JSON)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transactions", type=int, default=10000)
+    parser.add_argument("--products", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    report(f"GET /api/transactions ({args.transactions:,} rows)", synthetic_transactions(args.transactions),
+           args.repeat)
+    report(f"GET /api/products ({args.products} products, device view)", synthetic_products(args.products),
+           args.repeat * 50)
+
+
+if __name__ == "__main__":
+    main()
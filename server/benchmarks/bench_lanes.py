@@ -0,0 +1,119 @@
+"""
+Benchmark: device p99 while analytics load varies, with and without workload lanes.
+
+Starts gunicorn (gevent workers) on a synthetic app: the catalog poll waits
+--db-ms on I/O; an analytics request waits --query-s on I/O and then burns
+--cpu-ms of CPU, inline in the worker (--mode shared) or in the analytics
+process pool behind the lane limits (--mode lanes).
+
+    python benchmarks/bench_lanes.py --mode shared --dashboards 0 4 16
+    python benchmarks/bench_lanes.py --mode lanes  --dashboards 0 4 16
+"""
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import time
+
+from bench_worker_concurrency import run_load, report, _free_port
+
+
+def burn(ms):
+    """CPU-bound stand-in for the pandas / SciPy part of a report."""
+    deadline = time.process_time() + ms / 1000
+    n = 0
+    while time.process_time() < deadline:
+        n += 1
+    return n
+
+
+def _make_bench_app():
+    from flask import Blueprint, Flask, jsonify
+
+    db_seconds = float(os.environ["BENCH_DB_MS"]) / 1000
+    query_seconds = float(os.environ["BENCH_QUERY_S"])
+    cpu_ms = float(os.environ["BENCH_CPU_MS"])
+    use_lanes = os.environ["BENCH_MODE"] == "lanes"
+
+    app = Flask(__name__)
+    # Tên blueprint / endpoint giống app thật để lanes.classify() xếp đúng lane
+    products = Blueprint("products", __name__)
+    transactions = Blueprint("transactions", __name__)
+
+    @products.route("/api/products")
+    def getProducts():
+        time.sleep(db_seconds)
+        return jsonify({"success": True, "products": [{"item_name": f"product_{i}", "units_left": i} for i in range(60)]})
+
+    @transactions.route("/api/admin/analytics")
+    def get_advanced_analytics():
+        time.sleep(query_seconds)
+        if use_lanes:
+            from analytics import run_analytics
+            run_analytics(burn, cpu_ms)
+        else:
+            burn(cpu_ms)
+        return jsonify({"success": True, "data": {}})
+
+    app.register_blueprint(products)
+    app.register_blueprint(transactions)
+    if use_lanes:
+        from lanes import init_lanes
+        init_lanes(app)
+    return app
+
+
+if os.environ.get("BENCH_APP") == "1" and "BENCH_MODE" in os.environ:
+    bench_app = _make_bench_app()
+
+
+def serve(mode, workers, db_ms, query_s, cpu_ms):
+    import socket
+    import subprocess
+
+    port = _free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, BENCH_APP="1", BENCH_MODE=mode, BENCH_DB_MS=str(db_ms), BENCH_QUERY_S=str(query_s),
+               BENCH_CPU_MS=str(cpu_ms), PYTHONPATH=os.path.dirname(here))
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "--chdir", here,
+                             "--bind", f"127.0.0.1:{port}", "--workers", str(workers),
+                             "--worker-class", "gevent", "--worker-connections", "1000",
+                             "--backlog", "2048", "--timeout", "120", "--log-level", "warning",
+                             "bench_lanes:bench_app"], env=env, cwd=here)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return proc, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit("gunicorn did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("shared", "lanes"), default="lanes")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--db-ms", type=float, default=5)
+    parser.add_argument("--query-s", type=float, default=0.5, help="I/O part of an analytics request")
+    parser.add_argument("--cpu-ms", type=float, default=300, help="CPU part of an analytics request")
+    parser.add_argument("--pollers", type=int, default=50)
+    parser.add_argument("--dashboards", type=int, nargs="+", default=[0, 4, 16])
+    parser.add_argument("--duration", type=float, default=8)
+    parser.add_argument("--timeout", type=float, default=5)
+    args = parser.parse_args()
+
+    proc, url = serve(args.mode, args.workers, args.db_ms, args.query_s, args.cpu_ms)
+    try:
+        for dashboards in args.dashboards:
+            load = run_load(url, args.pollers, dashboards, args.duration, args.timeout)
+            report(f"{args.mode}: {args.pollers} pollers + {dashboards} dashboards "
+                   f"(analytics {args.query_s:g} s I/O + {args.cpu_ms:g} ms CPU)", load, args.duration)
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark: JSON vs compact (MessagePack, short field IDs) MQTT catalog payloads.
+
+    python benchmarks/bench_mqtt_payloads.py --slots 40 --repeat 20000
+"""
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import time
+
+import numpy as np
+
+from catalog import SNAPSHOT_COLUMNS, SNAPSHOT_VERSION
+from codec import ENCODING_COMPACT, ENCODING_JSON, decode, encode
+
+
+def synthetic_payloads(n_slots, seed=3):
+    """Một hot update, một batch_update cả máy và một snapshot, giống dữ liệu relay gửi đi."""
+    rng = np.random.default_rng(seed)
+    names = [f"Sản phẩm {i:03d}" for i in range(n_slots)]
+    prices = (rng.integers(5, 40, n_slots) * 1000).tolist()
+    units = rng.integers(0, 20, n_slots).tolist()
+
+    changes = [{"device_id": "VM00042", "old_name": name, "new_name": name, "price": price, "units_left": left}
+               for name, price, left in zip(names, prices, units)]
+    snapshot = {
+        "v": SNAPSHOT_VERSION, "ts": "2025-01-01T00:00:00+00:00", "cols": list(SNAPSHOT_COLUMNS),
+        "rows": [[name, slot, price, left, f"/api/images/{slot}.webp"]
+                 for slot, (name, price, left) in enumerate(zip(names, prices, units), start=1)],
+    }
+    return {
+        "hot_update":   changes[0],
+        "batch_update": {"event": "batch_update", "device_id": "VM00042", "changes": changes},
+        "snapshot":     snapshot,
+    }
+
+
+def time_per_call(fn, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slots", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(f"{'payload':<14} {'encoding':<8} {'bytes':>8} {'encode µs':>10} {'decode µs':>10}")
+    for name, payload in synthetic_payloads(args.slots).items():
+        baseline = None
+        for encoding in (ENCODING_JSON, ENCODING_COMPACT):
+            data = encode(payload, encoding)
+            wire = data.encode("utf-8") if isinstance(data, str) else data
+            assert decode(data, encoding) == payload
+            enc_us = time_per_call(lambda: encode(payload, encoding), args.repeat)
+            dec_us = time_per_call(lambda: decode(data, encoding), args.repeat)
+            baseline = baseline or len(wire)
+            print(f"{name:<14} {encoding:<8} {len(wire):>8,} {enc_us:>10.2f} {dec_us:>10.2f}"
+                  f"  ({len(wire) / baseline:.0%} of json)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Benchmark: restock forecasting over a synthetic fleet.
+
+    python benchmarks/bench_restock_plan.py --machines 5000 --slots 10
+"""
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from forecasting import forecast_stockout, restock_plan, to_records, DEFAULT_LOOKBACK_DAYS
+
+
+def synthetic_fleet(n_machines, n_slots, n_products, lookback_days, seed=7):
+    """Sinh tồn kho hiện tại và doanh số theo ngày cho cả đội máy (dạng đã gom nhóm như SQL trả về)."""
+    rng = np.random.default_rng(seed)
+    devices = np.array([f"VM{i:05d}" for i in range(n_machines)])
+    products = np.array([f"product_{i:03d}" for i in range(n_products)])
+
+    dev_idx = np.repeat(np.arange(n_machines), n_slots)
+    prod_idx = np.concatenate([rng.choice(n_products, n_slots, replace=False) for _ in range(n_machines)])
+    stock = pd.DataFrame({
+        "device_id": devices[dev_idx],
+        "item_name": products[prod_idx],
+        "slot_number": np.tile(np.arange(1, n_slots + 1), n_machines),
+        "units_left": rng.integers(0, 20, dev_idx.shape[0]),
+    })
+
+    days = np.repeat(np.arange(lookback_days), stock.shape[0])
+    sales = pd.DataFrame({
+        "device_id": np.tile(stock["device_id"].to_numpy(), lookback_days),
+        "item_name": np.tile(stock["item_name"].to_numpy(), lookback_days),
+        "days_ago": days,
+        "qty": rng.poisson(1.5, days.shape[0]),
+    })
+    return sales[sales["qty"] > 0], stock
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--machines", type=int, default=5000)
+    parser.add_argument("--slots", type=int, default=10)
+    parser.add_argument("--products", type=int, default=60)
+    parser.add_argument("--target-days", type=float, default=7)
+    args = parser.parse_args()
+
+    sales, stock = synthetic_fleet(args.machines, args.slots, args.products, DEFAULT_LOOKBACK_DAYS)
+    print(f"{args.machines:,} machines, {stock.shape[0]:,} slots, {sales.shape[0]:,} daily sales rows")
+
+    t0 = time.perf_counter()
+    forecast = forecast_stockout(sales, stock)
+    t1 = time.perf_counter()
+    per_machine, pick_list = restock_plan(forecast, target_days=args.target_days, max_units=20)
+    t2 = time.perf_counter()
+    to_records(pick_list)
+    t3 = time.perf_counter()
+
+    print(f"velocity + stock-out : {(t1 - t0) * 1000:8.1f} ms")
+    print(f"refill + pick list   : {(t2 - t1) * 1000:8.1f} ms  ({per_machine.shape[0]:,} refills)")
+    print(f"pick list to JSON    : {(t3 - t2) * 1000:8.1f} ms")
+    print(f"total                : {(t3 - t0) * 1000:8.1f} ms")
+    print(pick_list.head(5).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Benchmark: device polling while long dashboard requests run, sync vs gevent workers.
+
+Against a running server (real database):
+
+    python benchmarks/bench_worker_concurrency.py --url http://localhost:5000 --pollers 200 --dashboards 8
+
+Self-contained comparison: --serve starts gunicorn (4 workers of the given class)
+on a synthetic app whose "queries" wait on I/O for --db-ms (catalog) and
+--slow-s (analytics), the way a psycopg2 query waits on its socket:
+
+    python benchmarks/bench_worker_concurrency.py --serve sync
+    python benchmarks/bench_worker_concurrency.py --serve gevent
+"""
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import socket
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+DEVICE_PATH = "/api/products"
+DASHBOARD_PATH = "/api/admin/analytics"
+
+
+# ---------------------------------------------------------------------------
+# Synthetic app (only imported by the gunicorn started with --serve)
+# ---------------------------------------------------------------------------
+def _make_bench_app():
+    from flask import Flask, jsonify
+
+    db_seconds = float(os.environ.get("BENCH_DB_MS", 5)) / 1000
+    slow_seconds = float(os.environ.get("BENCH_SLOW_S", 2))
+    app = Flask(__name__)
+
+    @app.route(DEVICE_PATH)
+    def products():
+        time.sleep(db_seconds)
+        return jsonify({"success": True, "products": [{"item_name": f"product_{i}", "units_left": i} for i in range(60)]})
+
+    @app.route(DASHBOARD_PATH)
+    def analytics():
+        time.sleep(slow_seconds)
+        return jsonify({"success": True, "data": {}})
+
+    return app
+
+
+if os.environ.get("BENCH_APP") == "1":
+    bench_app = _make_bench_app()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(worker_class, workers, db_ms, slow_s):
+    port = _free_port()
+    env = dict(os.environ, BENCH_APP="1", BENCH_DB_MS=str(db_ms), BENCH_SLOW_S=str(slow_s))
+    here = os.path.dirname(os.path.abspath(__file__))
+    # cwd = benchmarks/: không nạp gunicorn.conf.py (hook của app thật) của server/
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "--chdir", here,
+                             "--bind", f"127.0.0.1:{port}", "--workers", str(workers),
+                             "--worker-class", worker_class, "--worker-connections", "1000",
+                             "--backlog", "2048", "--timeout", "120", "--log-level", "warning",
+                             "bench_worker_concurrency:bench_app"], env=env, cwd=here)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit(f"gunicorn ({worker_class}) did not start")
+
+
+# ---------------------------------------------------------------------------
+# Load generator
+# ---------------------------------------------------------------------------
+class Load:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {"device": [], "dashboard": []}
+        self.errors = {"device": 0, "dashboard": 0}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def run(self, session, kind, url, headers, timeout, stop):
+        while not stop.is_set():
+            with self.lock:
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            t0 = time.perf_counter()
+            ok = False
+            try:
+                ok = session.get(url, headers=headers, timeout=timeout).status_code == 200
+            except Exception:
+                pass
+            elapsed = time.perf_counter() - t0
+            with self.lock:
+                self.in_flight -= 1
+                if ok:
+                    self.latencies[kind].append(elapsed)
+                else:
+                    self.errors[kind] += 1
+
+
+def run_load(url, pollers, dashboards, duration, timeout):
+    import requests
+
+    load = Load()
+    stop = threading.Event()
+    threads = []
+    for i in range(pollers):
+        headers = {"X-Device-ID": f"VM{i % 500:05d}"}
+        threads.append(threading.Thread(target=load.run, daemon=True,
+                                        args=(requests.Session(), "device", url + DEVICE_PATH, headers, timeout, stop)))
+    for _ in range(dashboards):
+        threads.append(threading.Thread(target=load.run, daemon=True,
+                                        args=(requests.Session(), "dashboard", url + DASHBOARD_PATH, {}, timeout * 10, stop)))
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join(timeout * 10)
+    return load
+
+
+def report(label, load, duration):
+    print(f"\n{label}")
+    for kind in ("device", "dashboard"):
+        lat = np.array(load.latencies[kind]) * 1000
+        if len(lat):
+            p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+            print(f"  {kind:<9}: {len(lat) / duration:8.1f} req/s  p50 {p50:8.1f} ms  p95 {p95:8.1f} ms  "
+                  f"p99 {p99:8.1f} ms  errors/timeouts {load.errors[kind]}")
+        else:
+            print(f"  {kind:<9}: no successful requests, errors/timeouts {load.errors[kind]}")
+    print(f"  peak concurrent client connections: {load.peak_in_flight}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--serve", choices=("sync", "gevent"), help="start gunicorn on a synthetic app instead")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--db-ms", type=float, default=5, help="synthetic catalog query time")
+    parser.add_argument("--slow-s", type=float, default=2, help="synthetic analytics query time")
+    parser.add_argument("--pollers", type=int, default=100, help="concurrent device pollers")
+    parser.add_argument("--dashboards", type=int, default=8, help="concurrent dashboard clients")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--timeout", type=float, default=5, help="device request timeout (s)")
+    args = parser.parse_args()
+
+    proc = None
+    url = args.url
+    label = url
+    if args.serve:
+        proc, url = serve(args.serve, args.workers, args.db_ms, args.slow_s)
+        label = f"{args.workers} x {args.serve} workers (synthetic: catalog {args.db_ms:g} ms, analytics {args.slow_s:g} s)"
+    try:
+        load = run_load(url, args.pollers, args.dashboards, args.duration, args.timeout)
+        report(f"{label}: {args.pollers} pollers + {args.dashboards} dashboards, {args.duration:g}s", load, args.duration)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Compact per-device catalog snapshots.
+
+Each machine gets its own retained message on
+vending_machine/<device_id>/catalog/snapshot holding exactly what it sells:
+
+    {"v": 1, "ts": "...", "cols": ["item_name", "slot_number", "price", "units_left", "image_url"],
+     "rows": [["Coca", 1, 12000, 8, "/api/images/..."], ...]}
+
+Rows instead of objects keep the payload small for the RPi clients; "cols"
+keeps it self-describing. The snapshot is republished (via the outbox) by
+every change that touches the device, so a machine that (re)subscribes is
+current immediately, without an HTTP poll.
+"""
+
+from datetime import datetime, timezone
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_COLUMNS = ("item_name", "slot_number", "price", "units_left", "image_url")
+
+
+def devices_with_item(cursor, item_name):
+    cursor.execute("SELECT device_id FROM device_inventory WHERE item_name = %s", (item_name,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def load_snapshots(cursor, device_ids):
+    """{device_id: snapshot} for every requested device (empty rows if it sells nothing)."""
+    device_ids = list(dict.fromkeys(device_ids))
+    if not device_ids:
+        return {}
+    cursor.execute("""
+        SELECT d.device_id, d.item_name, d.slot_number,
+               COALESCE(dp.custom_price, i.price) AS price,
+               d.units_left, i.image_url
+        FROM device_inventory d
+        JOIN inventory i ON i.item_name = d.item_name
+        LEFT JOIN device_pricing dp ON dp.device_id = d.device_id AND dp.item_name = d.item_name
+        WHERE d.device_id = ANY(%s)
+        ORDER BY d.device_id, d.slot_number NULLS LAST, d.item_name
+    """, (device_ids,))
+    now_iso = datetime.now(timezone.utc).isoformat()
+    snapshots = {d: {"v": SNAPSHOT_VERSION, "ts": now_iso, "cols": list(SNAPSHOT_COLUMNS), "rows": []}
+                 for d in device_ids}
+    for device_id, *row in cursor.fetchall():
+        snapshots[device_id]["rows"].append(row)
+    return snapshots
@@ -0,0 +1,324 @@
+"""
+In-memory device x product catalog, one per API worker.
+
+The catalog is small (tens of products, hundreds of machines), so every
+worker keeps it as NumPy arrays indexed by integer device / product IDs:
+
+    base_price[P]            inventory.price
+    units[D, P], held[D, P]  device_inventory.units_left (held = the machine sells it)
+    slot[D, P]               device_inventory.slot_number (-1 = NULL)
+    price[D, P]              effective price: device_pricing.custom_price, else base_price
+
+GET /api/products and the fleet aggregates are answered from it without a
+query; the encoded response bodies are kept per snapshot too. A CatalogMatrix is immutable; CatalogCache swaps in a freshly loaded
+one when the invalidation bus (invalidation.py) reports a committed change:
+before the next request for prices / master data, in the background (at most
+every CATALOG_MATRIX_MIN_RELOAD seconds) for stock, and at least every
+CATALOG_MATRIX_MAX_AGE seconds. verify() compares it with Postgres.
+
+    python benchmarks/bench_catalog_matrix.py
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from database import getDatabaseConnection
+from json_provider import dumps_bytes
+
+logger = logging.getLogger(__name__)
+
+CATALOG_MATRIX_ENABLED    = os.environ.get("CATALOG_MATRIX", "true").lower() == "true"
+CATALOG_MATRIX_MAX_AGE    = float(os.environ.get("CATALOG_MATRIX_MAX_AGE", 30))       # seconds
+CATALOG_MATRIX_MIN_RELOAD = float(os.environ.get("CATALOG_MATRIX_MIN_RELOAD", 1.0))   # seconds, gộp các NOTIFY liên tiếp
+
+MASTER_COLUMNS = ("id", "item_name", "price", "cost_price", "description",
+                  "image_filename", "image_url", "created_at", "updated_at")
+_CLIENT_COLUMNS = ("item_name", "description", "image_filename", "image_url", "created_at")
+
+# Khoá cache dùng chung cho mọi device_id không có trong snapshot (không trùng được với chuỗi)
+_UNKNOWN_DEVICE = ("unknown",)
+
+
+class CatalogMatrix:
+    """Immutable array-backed snapshot of inventory, device_inventory and device_pricing."""
+
+    def __init__(self, products, stock, pricing, devices=()):
+        """
+        products: rows in MASTER_COLUMNS order (ORDER BY id)
+        stock   : (device_id, item_name, units_left, slot_number)
+        pricing : (device_id, item_name, custom_price)
+        devices : extra device_ids known to the server (devices table)
+        """
+        self.loaded_at = time.time()
+        self.master = [dict(zip(MASTER_COLUMNS, row)) for row in products]
+        self.item_names = [p["item_name"] for p in self.master]
+        self.product_index = {name: i for i, name in enumerate(self.item_names)}
+        self.device_ids = sorted(set(devices) | {row[0] for row in stock} | {row[0] for row in pricing})
+        self.device_index = {device_id: i for i, device_id in enumerate(self.device_ids)}
+        n_devices, n_products = len(self.device_ids), len(self.item_names)
+
+        self.base_price = np.array([p["price"] for p in self.master], dtype=np.float64)
+        self.units = np.zeros((n_devices, n_products), dtype=np.int32)
+        self.held = np.zeros((n_devices, n_products), dtype=bool)
+        self.slot = np.full((n_devices, n_products), -1, dtype=np.int32)
+        custom = np.full((n_devices, n_products), np.nan)
+
+        # Bỏ qua dòng trỏ tới sản phẩm đã xoá khỏi inventory (JOIN cũng bỏ qua chúng)
+        stock = [r for r in stock if r[1] in self.product_index]
+        if stock:
+            d = np.array([self.device_index[r[0]] for r in stock])
+            p = np.array([self.product_index[r[1]] for r in stock])
+            self.units[d, p] = [r[2] or 0 for r in stock]
+            self.held[d, p] = True
+            self.slot[d, p] = [-1 if r[3] is None else r[3] for r in stock]
+        pricing = [r for r in pricing if r[1] in self.product_index and r[2] is not None]
+        if pricing:
+            d = np.array([self.device_index[r[0]] for r in pricing])
+            p = np.array([self.product_index[r[1]] for r in pricing])
+            custom[d, p] = [r[2] for r in pricing]
+        self.price = np.where(np.isnan(custom), self.base_price[None, :], custom)
+
+        self._client_base = [{col: p[col] for col in _CLIENT_COLUMNS} for p in self.master]
+        # Chỉ cache máy có trong device_index: device_id lạ (client tự đặt) dùng chung 1 mục
+        self._device_lists = {}
+        self._bodies = {}   # device_id (None = admin, _UNKNOWN_DEVICE = máy lạ) -> body JSON đã mã hoá
+
+    @classmethod
+    def load(cls, conn):
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(MASTER_COLUMNS)} FROM inventory ORDER BY id")
+        products = cursor.fetchall()
+        cursor.execute("SELECT device_id, item_name, units_left, slot_number FROM device_inventory")
+        stock = cursor.fetchall()
+        cursor.execute("SELECT device_id, item_name, custom_price FROM device_pricing")
+        pricing = cursor.fetchall()
+        cursor.execute("SELECT device_id FROM devices")
+        devices = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        return cls(products, stock, pricing, devices)
+
+    def master_catalog(self):
+        """Admin view of GET /api/products (master data, no stock)."""
+        return self.master
+
+    def device_catalog(self, device_id):
+        """
+        Machine view of GET /api/products: every product with this machine's
+        effective price, units_left (0 if not stocked) and slot_number.
+        The returned list is shared; callers must not modify it.
+        """
+        row = self.device_index.get(device_id)
+        key = device_id if row is not None else _UNKNOWN_DEVICE
+        cached = self._device_lists.get(key)
+        if cached is not None:
+            return cached
+        if row is None:
+            prices = self.base_price.tolist()
+            units = [0] * len(prices)
+            slots = [None] * len(prices)
+        else:
+            prices = self.price[row].tolist()
+            units = self.units[row].tolist()
+            slots = [s if s >= 0 else None for s in self.slot[row].tolist()]
+        result = [dict(base, price=price, units_left=left, slot_number=slot)
+                  for base, price, left, slot in zip(self._client_base, prices, units, slots)]
+        self._device_lists[key] = result
+        return result
+
+    def _body(self, key, products):
+        body = self._bodies.get(key)
+        if body is None:
+            body = dumps_bytes({"success": True, "products": products})
+            self._bodies[key] = body
+        return body
+
+    def master_catalog_json(self):
+        """Encoded response body of the admin view; built once per snapshot."""
+        return self._body(None, self.master)
+
+    def device_catalog_json(self, device_id):
+        """Encoded response body of the machine view; built once per known device and snapshot."""
+        key = device_id if device_id in self.device_index else _UNKNOWN_DEVICE
+        return self._body(key, self.device_catalog(device_id))
+
+    def fleet_summary(self, threshold):
+        """Fleet-wide totals and the (device, product) pairs below threshold."""
+        units = np.where(self.held, self.units, 0)
+        low = self.held & (self.units < threshold)
+        low_d, low_p = np.nonzero(low)
+        order = np.argsort(self.units[low_d, low_p], kind="stable")
+        return {
+            "devices":            len(self.device_ids),
+            "products":           len(self.item_names),
+            "total_units":        int(units.sum()),
+            "stock_value":        round(float((units * self.price).sum()), 2),
+            "units_by_product":   dict(zip(self.item_names, units.sum(axis=0).tolist())),
+            "units_by_device":    dict(zip(self.device_ids, units.sum(axis=1).tolist())),
+            "low_stock_count":    int(low.sum()),
+            "out_of_stock_count": int((self.held & (self.units <= 0)).sum()),
+            "low_stock": [
+                {"device_id": self.device_ids[d], "item_name": self.item_names[p], "units_left": int(self.units[d, p])}
+                for d, p in zip(low_d[order].tolist(), low_p[order].tolist())
+            ],
+        }
+
+    def diff(self, other, limit=50):
+        """Human-readable differences between two snapshots (empty list = identical)."""
+        problems = []
+        if self.master != other.master:
+            problems.append("master product data differs")
+        for device_id in sorted(set(self.device_ids) | set(other.device_ids)):
+            if self.device_catalog(device_id) != other.device_catalog(device_id):
+                problems.append(f"catalog of device {device_id} differs")
+            if len(problems) >= limit:
+                break
+        return problems
+
+
+class CatalogCache:
+    """
+    Holds the worker's current CatalogMatrix; registered on the invalidation bus.
+
+    product / pricing invalidations mark the matrix stale and the next request
+    reloads it synchronously, so a changed price is never served. Stock
+    (device) invalidations arrive with every sale and are folded into a
+    background reload at most every min_reload seconds.
+    """
+
+    KINDS = ("product", "device", "pricing")
+
+    def __init__(self, connect=getDatabaseConnection, max_age=CATALOG_MATRIX_MAX_AGE,
+                 min_reload=CATALOG_MATRIX_MIN_RELOAD):
+        self._connect = connect
+        self._max_age = max_age
+        self._min_reload = min_reload
+        self._matrix = None
+        self._stale = True
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = Counter()   # reloads / invalidations / errors
+
+    def get(self) -> CatalogMatrix:
+        if self._stale:
+            with self._lock:
+                if self._stale:
+                    self.reload()
+                    self.start()
+        return self._matrix
+
+    def reload(self):
+        # Hạ cờ trước khi đọc: thay đổi commit trong lúc đang nạp sẽ bật lại cờ
+        self._stale = False
+        self._dirty.clear()
+        conn = self._connect()
+        try:
+            matrix = CatalogMatrix.load(conn)
+        except Exception:
+            self._stale = True
+            raise
+        finally:
+            conn.close()
+        self._matrix = matrix
+        self.stats["reloads"] += 1
+        return matrix
+
+    # --- cache region API (invalidation.py) ---
+    def invalidate(self, kind, keys):
+        self.stats["invalidations"] += 1
+        if kind == "device":
+            self._dirty.set()
+        else:
+            self._stale = True
+
+    def flush(self):
+        self._stale = True
+
+    def verify(self):
+        """Compare the in-memory matrix with a fresh load from Postgres."""
+        current = self.get()
+        conn = self._connect()
+        try:
+            fresh = CatalogMatrix.load(conn)
+        finally:
+            conn.close()
+        differences = current.diff(fresh)
+        return {
+            "consistent": not differences,
+            "differences": differences,
+            "age_seconds": round(time.time() - current.loaded_at, 3),
+        }
+
+    def _run(self):
+        """Background reload for stock changes; also refreshes at least every max_age seconds."""
+        while not self._stop.is_set():
+            if self._dirty.wait(self._max_age):
+                # Gộp cả loạt thay đổi tồn kho liên tiếp vào 1 lần nạp lại
+                if self._stop.wait(self._min_reload):
+                    return
+            if self._stop.is_set():
+                return
+            try:
+                with self._lock:
+                    self.reload()
+            except Exception as exc:
+                self.stats["errors"] += 1
+                logger.error("Catalog matrix reload failed: %s", exc)
+                self._stop.wait(self._min_reload)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="catalog-matrix", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._dirty.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+# ---------------------------------------------------------------------------
+# Per-worker singleton (created after fork, see lifecycle.py)
+# ---------------------------------------------------------------------------
+_cache: CatalogCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_catalog_cache() -> CatalogCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                from invalidation import get_bus
+                cache = CatalogCache()
+                get_bus().register(cache, CatalogCache.KINDS)
+                _cache = cache
+    return _cache
+
+
+def get_catalog() -> CatalogMatrix:
+    return get_catalog_cache().get()
+
+
+def shutdown_catalog():
+    global _cache
+    with _cache_lock:
+        cache, _cache = _cache, None
+    if cache is not None:
+        cache.stop()
+
+
+def _reset_after_fork():
+    global _cache, _cache_lock
+    _cache = None
+    _cache_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,92 @@
+"""
+Compact binary encoding for server -> device catalog messages.
+
+Machines that announce {"online": true, "encoding": "mp1"} in their status
+message (see presence.py) receive their catalog messages MessagePack-encoded
+with short integer field IDs instead of JSON:
+
+    vending_machine/<device_id>/catalog/update     ->  vending_machine/<device_id>/mp1/catalog/update
+    vending_machine/<device_id>/catalog/snapshot   ->  vending_machine/<device_id>/mp1/catalog/snapshot
+
+"mp1" in the topic is the schema version: a new FIELD_IDS table gets a new
+name (mp2, ...) so old clients never mis-decode a message. Keys not in the
+table are kept as strings, values are unchanged. Shared topics (legacy
+product/update, data_changed, admin/alerts) stay JSON.
+
+    python benchmarks/bench_mqtt_payloads.py
+"""
+
+import json
+
+ENCODING_JSON    = "json"
+ENCODING_COMPACT = "mp1"
+ENCODINGS        = (ENCODING_JSON, ENCODING_COMPACT)
+
+# Schema mp1 -- chỉ được THÊM khoá mới, không đổi số đã dùng
+FIELD_IDS = {
+    "event":       0,
+    "device_id":   1,
+    "product_id":  2,
+    "old_name":    3,
+    "new_name":    4,
+    "price":       5,
+    "units_left":  6,
+    "changes":     7,
+    "v":           8,
+    "ts":          9,
+    "cols":        10,
+    "rows":        11,
+    "added":       12,
+    "removed":     13,
+    "moved":       14,
+    "restocked":   15,
+    "item_name":   16,
+    "slot_number": 17,
+    "image_url":   18,
+}
+FIELD_NAMES = {field_id: name for name, field_id in FIELD_IDS.items()}
+
+
+def _shorten(value):
+    if isinstance(value, dict):
+        return {FIELD_IDS.get(k, k): _shorten(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_shorten(v) for v in value]
+    return value
+
+
+def _expand(value):
+    if isinstance(value, dict):
+        return {FIELD_NAMES.get(k, k): _expand(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_expand(v) for v in value]
+    return value
+
+
+def encode(payload, encoding=ENCODING_JSON):
+    """dict -> bytes (compact) or str (json)."""
+    if encoding == ENCODING_COMPACT:
+        import msgpack
+        return msgpack.packb(_shorten(payload), use_bin_type=True)
+    return json.dumps(payload, ensure_ascii=False)
+
+
+def decode(data, encoding=ENCODING_JSON):
+    """Inverse of encode(); used by the benchmark and by Python clients."""
+    if encoding == ENCODING_COMPACT:
+        import msgpack
+        return _expand(msgpack.unpackb(data, raw=False, strict_map_key=False))
+    return json.loads(data)
+
+
+def device_topic(topic, encoding):
+    """
+    Topic a per-device catalog message is published on for the given encoding.
+    Returns (device_id, topic), device_id None when the topic is not per-device.
+    """
+    parts = topic.split("/")
+    if len(parts) != 4 or parts[0] != "vending_machine" or parts[2] != "catalog":
+        return None, topic
+    if encoding == ENCODING_JSON:
+        return parts[1], topic
+    return parts[1], "/".join([parts[0], parts[1], encoding, parts[2], parts[3]])
@@ -0,0 +1,85 @@
+"""
+Negotiated response compression (gzip / brotli) for the API.
+
+JSON and text responses of at least COMPRESS_MIN_SIZE bytes are compressed
+with the best encoding the client accepts (Accept-Encoding): br if the
+optional brotli package is installed, else gzip. Images (already
+compressed), streamed / file responses and responses that already carry a
+Content-Encoding are left alone.
+
+    COMPRESS_MIN_SIZE        bytes, smaller bodies are sent as-is
+    COMPRESS_LEVEL           gzip level 1-9
+    COMPRESS_BROTLI_QUALITY  brotli quality 0-11
+
+    python benchmarks/bench_json_compression.py
+"""
+
+import gzip
+import logging
+import os
+
+from flask import request
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:   # brotli là tuỳ chọn, thiếu thì chỉ dùng gzip
+    brotli = None
+
+COMPRESS_ENABLED        = os.environ.get("COMPRESS_RESPONSES", "true").lower() == "true"
+COMPRESS_MIN_SIZE       = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+COMPRESS_LEVEL          = int(os.environ.get("COMPRESS_LEVEL", 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 4))
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/html", "text/plain", "text/csv", "text/css",
+                          "application/javascript"}
+
+
+def available_encodings():
+    """Encodings this server can produce, in order of preference."""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def compress(data, encoding, level=COMPRESS_LEVEL, quality=COMPRESS_BROTLI_QUALITY):
+    if encoding == "br":
+        return brotli.compress(data, quality=quality)
+    if encoding == "gzip":
+        # mtime=0: cùng body -> cùng bytes nén (ETag / cache ổn định)
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    raise ValueError(f"unsupported encoding {encoding!r}")
+
+
+def _negotiate(accept_encodings):
+    for encoding in available_encodings():
+        if accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+def compress_response(response):
+    """after_request hook."""
+    if (response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+
+    encoding = _negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app):
+    if not COMPRESS_ENABLED:
+        return
+    app.after_request(compress_response)
+    logger.info("Response compression: %s (min %d bytes)", "/".join(available_encodings()), COMPRESS_MIN_SIZE)
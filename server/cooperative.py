@@ -0,0 +1,65 @@
+"""
+Cooperative (gevent) worker mode.
+
+With GUNICORN_WORKER_CLASS=gevent every worker serves up to
+GUNICORN_WORKER_CONNECTIONS requests concurrently as greenlets, so a slow
+analytics query or image transfer only parks one greenlet instead of a whole
+sync worker. For that, everything that blocks must yield to the gevent hub:
+
+    sockets, select, threading, time.sleep   gevent.monkey.patch_all()
+    psycopg2 queries                         wait callback below (psycopg2 "green" mode)
+    paho MQTT client / sidecar socket        plain sockets + threads, covered by patch_all
+
+patch() must run before anything else imports socket / threading, i.e. at
+the top of gunicorn.conf.py, which gunicorn executes before --preload
+imports the app. Connections per worker are bounded by DB_MAX_CONNECTIONS
+(database.py) so that hundreds of greenlets do not exhaust Postgres.
+
+    python benchmarks/bench_worker_concurrency.py --serve gevent
+"""
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+WORKER_CLASS       = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+WORKER_CONNECTIONS = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 200))
+
+_patched = False
+
+
+def is_cooperative():
+    return WORKER_CLASS == "gevent"
+
+
+def _gevent_wait(conn, timeout=None):
+    """psycopg2 wait callback: wait for the socket through the gevent hub instead of blocking."""
+    import psycopg2
+    from psycopg2 import extensions
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        if state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
+
+
+def patch():
+    """Monkey-patch the process for gevent workers; no-op in sync mode."""
+    global _patched
+    if _patched or not is_cooperative():
+        return
+    from gevent import monkey
+    monkey.patch_all()
+
+    from psycopg2 import extensions
+    extensions.set_wait_callback(_gevent_wait)
+    _patched = True
+    logger.info("Cooperative mode: gevent workers, %d connections each", WORKER_CONNECTIONS)
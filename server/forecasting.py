@@ -0,0 +1,116 @@
+"""
+Restock forecasting and pick-list engine.
+
+Computes sales velocity for every device × product pair at once from the
+transaction history, predicts time to stock-out and derives per-machine
+refill quantities plus an aggregated warehouse pick list.
+
+All heavy lifting is vectorized pandas/NumPy over the whole fleet; the
+database only returns pre-aggregated daily sales and the current stock.
+"""
+
+import logging
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOOKBACK_DAYS = 28
+DEFAULT_RECENT_DAYS = 7
+DEFAULT_TARGET_DAYS = 7
+# Trọng số của tốc độ bán gần đây so với cả cửa sổ (0 = chỉ dùng cả cửa sổ)
+RECENT_WEIGHT = 0.5
+
+_KEYS = ["device_id", "item_name"]
+
+
+# ---------------------------------------------------------------------------
+# Loading
+# ---------------------------------------------------------------------------
+
+def load_daily_sales(cursor, lookback_days=DEFAULT_LOOKBACK_DAYS, now=None):
+    """Số lượng bán theo (device, product, ngày) trong cửa sổ lookback — gom nhóm ngay trong Postgres."""
+    now = now or datetime.now(timezone.utc)
+    since = (now - timedelta(days=lookback_days)).isoformat()
+    cursor.execute("""
+        SELECT t.device_id,
+               COALESCE(elem->>'product_name', elem->>'name', elem->>'item_name') AS item_name,
+               (now()::date - t.created_at::timestamptz::date) AS days_ago,
+               SUM(COALESCE((elem->>'quantity')::int, 1)) AS qty
+        FROM transactions t, json_array_elements(t.items::json) AS elem
+        WHERE t.payment_status = 'completed' AND t.created_at >= %s
+        GROUP BY 1, 2, 3
+    """, (since,))
+    return pd.DataFrame(cursor.fetchall(), columns=["device_id", "item_name", "days_ago", "qty"])
+
+
+def load_stock(cursor):
+    """Tồn kho hiện tại của tất cả các máy."""
+    cursor.execute("SELECT device_id, item_name, slot_number, units_left FROM device_inventory")
+    return pd.DataFrame(cursor.fetchall(), columns=["device_id", "item_name", "slot_number", "units_left"])
+
+
+# ---------------------------------------------------------------------------
+# Model
+# ---------------------------------------------------------------------------
+
+def forecast_stockout(sales, stock, lookback_days=DEFAULT_LOOKBACK_DAYS,
+                      recent_days=DEFAULT_RECENT_DAYS, recent_weight=RECENT_WEIGHT):
+    """
+    Estimate daily velocity and days to stock-out for every stocked device × product.
+
+    velocity = (1 - w) * sold_in_window / lookback_days + w * sold_recently / recent_days
+
+    recent_days is capped at lookback_days: only lookback_days of sales are loaded.
+    """
+    recent_days = min(recent_days, lookback_days)
+    sales = sales.astype({"qty": "float64", "days_ago": "int64"})
+    recent_qty = sales["qty"].where(sales["days_ago"] < recent_days, 0.0)
+
+    totals = (sales.assign(recent_qty=recent_qty)
+                   .groupby(_KEYS, sort=False)[["qty", "recent_qty"]].sum())
+
+    df = stock.join(totals, on=_KEYS, how="left")
+    qty = df["qty"].fillna(0.0).to_numpy()
+    recent = df["recent_qty"].fillna(0.0).to_numpy()
+    units = df["units_left"].fillna(0).clip(lower=0).to_numpy(dtype="float64")
+
+    velocity = (1 - recent_weight) * qty / lookback_days + recent_weight * recent / recent_days
+    with np.errstate(divide="ignore"):
+        days_left = np.where(velocity > 0, units / velocity, np.inf)
+
+    return df.drop(columns=["qty", "recent_qty"]).assign(
+        units_left=units.astype("int64"),
+        velocity=velocity,
+        days_to_stockout=days_left,
+    )
+
+
+def restock_plan(forecast, target_days=DEFAULT_TARGET_DAYS, max_units=None):
+    """
+    Refill quantities to cover *target_days* of demand, capped by slot capacity.
+
+    Returns (per_machine, pick_list) DataFrames; only rows that need refilling are kept.
+    """
+    need = np.ceil(forecast["velocity"].to_numpy() * target_days) - forecast["units_left"].to_numpy()
+    if max_units is not None:
+        need = np.minimum(need, max_units - forecast["units_left"].to_numpy())
+    refill = np.clip(need, 0, None).astype("int64")
+
+    per_machine = forecast.assign(refill_units=refill)
+    per_machine = per_machine[per_machine["refill_units"] > 0].sort_values(
+        ["days_to_stockout", "device_id"], kind="stable")
+
+    pick_list = (per_machine.groupby("item_name", sort=False)
+                 .agg(total_units=("refill_units", "sum"), machines=("device_id", "nunique"))
+                 .reset_index()
+                 .sort_values("total_units", ascending=False, kind="stable"))
+    return per_machine, pick_list
+
+
+def to_records(df):
+    """DataFrame -> list of dict, đổi NaN/inf thành None để jsonify được."""
+    df = df.replace([np.inf, -np.inf], np.nan).round(3)
+    return df.astype(object).where(df.notna(), None).to_dict("records")
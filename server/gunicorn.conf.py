@@ -0,0 +1,78 @@
+"""
+Gunicorn hooks: worker slots for stable MQTT client IDs, clean worker shutdown
+and, in sidecar mode, the shared MQTT sidecar process (see lifecycle.py).
+The worker class comes from GUNICORN_WORKER_CLASS (sync | gevent, see
+cooperative.py) and the Prometheus multiprocess directory is prepared here
+(metrics.py); command-line flags in the Dockerfile still set bind / workers /
+timeout.
+"""
+
+# gevent phải patch trước khi --preload import app (socket, threading, psycopg2)
+import cooperative
+cooperative.patch()
+
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+
+preload_app = True
+worker_class = cooperative.WORKER_CLASS
+worker_connections = cooperative.WORKER_CONNECTIONS
+
+# Prometheus multiprocess: mỗi process ghi số liệu vào file trong thư mục này, /metrics gộp lại.
+# Phải đặt trước khi app (prometheus_client) được import, và dọn sạch số liệu của lần chạy trước.
+# (Chỉ lần nạp config đầu tiên: SIGHUP nạp lại file này khi các worker vẫn đang ghi.)
+if os.environ.get("_METRICS_DIR_OWNER") != str(os.getpid()):
+    os.environ["_METRICS_DIR_OWNER"] = str(os.getpid())
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def on_starting(server):
+    if os.environ.get("MQTT_CONNECTION_MODE", "worker") == "sidecar":
+        _start_sidecar(server)
+
+
+def _start_sidecar(server):
+    server.mqtt_sidecar = subprocess.Popen([sys.executable, "mqtt_sidecar.py"],
+                                           cwd=os.path.dirname(os.path.abspath(__file__)))
+    server.log.info("Started MQTT sidecar (pid %s)", server.mqtt_sidecar.pid)
+
+
+def pre_fork(server, worker):
+    # Slot nhỏ nhất còn trống: worker thay thế dùng lại slot (và client ID) của worker cũ
+    used = {getattr(w, "slot", None) for w in server.WORKERS.values()}
+    worker.slot = next(i for i in itertools.count() if i not in used)
+
+    sidecar = getattr(server, "mqtt_sidecar", None)
+    if sidecar is not None and sidecar.poll() is not None:
+        server.log.warning("MQTT sidecar exited with %s, restarting", sidecar.returncode)
+        _start_sidecar(server)
+
+
+def post_fork(server, worker):
+    import lifecycle
+    lifecycle.post_fork(worker.slot)
+
+
+def worker_exit(server, worker):
+    import lifecycle
+    lifecycle.shutdown()
+
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    sidecar = getattr(server, "mqtt_sidecar", None)
+    if sidecar is not None and sidecar.poll() is None:
+        sidecar.terminate()
+        try:
+            sidecar.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            sidecar.kill()
@@ -0,0 +1,164 @@
+"""
+Cache invalidation bus shared by all API workers (Postgres LISTEN / NOTIFY).
+
+Writers call notify(cursor, kind, keys) inside their transaction; Postgres
+delivers the message to every listener when (and only if) the transaction
+commits:
+
+    NOTIFY cache_invalidation, '{"kind": "pricing", "keys": ["VM001"]}'
+
+    kind     keys
+    product  item_name   (master data: name, price, image, ...)
+    device   device_id   (device_inventory: stock, slots, planogram)
+    pricing  device_id   (device_pricing overrides)
+    user     user_id
+
+keys = null means "every entry of that kind". Each worker runs one listener
+thread that dispatches messages to the cache regions registered for the
+kind. A region implements invalidate(kind, keys) and flush(); flush() is
+called after every (re)connect because notifications sent while the
+listener was disconnected are lost.
+"""
+
+import json
+import logging
+import os
+import select
+import threading
+from collections import Counter
+
+import psycopg2
+import psycopg2.extensions
+
+from database import getDatabaseConnection
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "cache_invalidation"
+KINDS = ("product", "device", "pricing", "user")
+
+_MAX_PAYLOAD   = 7000   # NOTIFY payload phải < 8000 bytes
+_POLL_INTERVAL = 5.0    # seconds, để kiểm tra cờ dừng
+_BACKOFF_MAX   = 30.0
+
+
+def notify(cursor, kind, keys=None):
+    """Queue an invalidation for kind (keys None = all); delivered when the transaction commits."""
+    if kind not in KINDS:
+        raise ValueError(f"unknown invalidation kind {kind!r}")
+    if keys is not None:
+        keys = sorted({key for key in keys if key is not None})
+        if not keys:
+            return
+    payload = json.dumps({"kind": kind, "keys": keys}, ensure_ascii=False)
+    if len(payload.encode("utf-8")) > _MAX_PAYLOAD:
+        payload = json.dumps({"kind": kind, "keys": None})   # quá dài -> huỷ cả loại
+    cursor.execute("SELECT pg_notify(%s, %s)", (CHANNEL, payload))
+
+
+class InvalidationBus:
+    """Per-worker listener that fans invalidations out to registered cache regions."""
+
+    def __init__(self, connect=getDatabaseConnection):
+        self._connect = connect
+        self._regions = []
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = Counter()   # messages / flushes / errors
+
+    def register(self, region, kinds=KINDS):
+        """region.invalidate(kind, keys) for every message of kinds; region.flush() after a reconnect."""
+        self._regions.append((frozenset(kinds), region))
+
+    def dispatch(self, payload):
+        try:
+            message = json.loads(payload)
+            kind, keys = message["kind"], message.get("keys")
+        except (ValueError, KeyError, TypeError) as exc:
+            logger.warning("Ignored invalidation %r: %s", payload, exc)
+            return
+        self.stats["messages"] += 1
+        for kinds, region in self._regions:
+            if kind in kinds:
+                try:
+                    region.invalidate(kind, keys)
+                except Exception as exc:
+                    logger.error("Cache region %s failed to invalidate %s: %s", type(region).__name__, kind, exc)
+
+    def flush_all(self):
+        self.stats["flushes"] += 1
+        for _, region in self._regions:
+            try:
+                region.flush()
+            except Exception as exc:
+                logger.error("Cache region %s failed to flush: %s", type(region).__name__, exc)
+
+    def _listen(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f"LISTEN {CHANNEL}")
+                self.flush_all()   # có thể đã lỡ thông báo trước khi LISTEN
+                backoff = 1.0
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], _POLL_INTERVAL)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self.dispatch(conn.notifies.pop(0).payload)
+            except psycopg2.Error as exc:
+                self.stats["errors"] += 1
+                logger.error("Invalidation listener error: %s", exc)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, _BACKOFF_MAX)
+            finally:
+                if conn is not None and not conn.closed:
+                    conn.close()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._listen, name="cache-invalidation", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+# ---------------------------------------------------------------------------
+# Per-worker singleton (created after fork, see lifecycle.py)
+# ---------------------------------------------------------------------------
+_bus: InvalidationBus | None = None
+_bus_lock = threading.Lock()
+
+
+def get_bus() -> InvalidationBus:
+    """This worker's bus; the listener starts on first use."""
+    global _bus
+    if _bus is None:
+        with _bus_lock:
+            if _bus is None:
+                bus = InvalidationBus()
+                bus.start()
+                _bus = bus
+    return _bus
+
+
+def shutdown_bus():
+    global _bus
+    with _bus_lock:
+        bus, _bus = _bus, None
+    if bus is not None:
+        bus.stop()
+
+
+def _reset_after_fork():
+    global _bus, _bus_lock
+    _bus = None
+    _bus_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
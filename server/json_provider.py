@@ -0,0 +1,88 @@
+"""
+Fast JSON for every API response (Flask JSON provider backed by orjson).
+
+jsonify() and request.get_json() go through app.json; with orjson installed
+the body is encoded straight to bytes in C:
+
+    datetime / date / time   ISO 8601 ("2025-01-01T08:30:00", like .isoformat())
+    Decimal                  number (float)
+    numpy scalars / arrays   numbers / lists
+    dict keys                converted to str (int, datetime, ...)
+
+Keys keep insertion order (JSON_SORT_KEYS=true to sort). Without orjson the
+stdlib provider is used with the same datetime / Decimal rules.
+
+    python benchmarks/bench_json_compression.py
+"""
+
+import datetime
+import decimal
+import json
+import logging
+import os
+import uuid
+
+from flask.json.provider import DefaultJSONProvider
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:   # orjson là tuỳ chọn
+    orjson = None
+
+JSON_SORT_KEYS = os.environ.get("JSON_SORT_KEYS", "false").lower() == "true"
+
+
+def _default(obj):
+    """Types neither encoder handles natively."""
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if hasattr(obj, "tolist"):   # numpy scalar / ndarray
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    if JSON_SORT_KEYS:
+        _OPTIONS |= orjson.OPT_SORT_KEYS
+
+    def dumps_bytes(obj):
+        """Encode obj to UTF-8 JSON bytes."""
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+else:
+    def dumps_bytes(obj):
+        """Encode obj to UTF-8 JSON bytes."""
+        return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":"),
+                          sort_keys=JSON_SORT_KEYS).encode("utf-8")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """app.json for the API: orjson when available, compact output, unsorted keys."""
+
+    sort_keys = JSON_SORT_KEYS
+    compact = True
+
+    def dumps(self, obj, **kwargs):
+        return dumps_bytes(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if orjson is not None:
+            return orjson.loads(s)
+        return json.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
+
+
+def init_json(app):
+    app.json = FastJSONProvider(app)
+    logger.info("JSON provider: %s", "orjson" if orjson is not None else "stdlib json")
@@ -0,0 +1,224 @@
+"""
+Workload lanes: device traffic keeps its capacity while admins load dashboards.
+
+Every request is classified into a lane before it runs:
+
+    device     machine calls: catalog polls, sales, batch sync, images, user login at the machine
+    admin      dashboard CRUD, uploads, fleet operations
+    analytics  reports and large listings: /api/admin/analytics, restock plan,
+               related-products rebuild, fleet inventory, /api/transactions with
+               limit > LARGE_LISTING_ROWS
+
+Classification uses the endpoint only; a request for an endpoint outside the
+tables goes to the device lane only with a verified device token, never on
+the strength of an X-Device-ID header.
+
+Each lane has its own concurrency limit per worker (LANE_<NAME>_LIMIT, 0 =
+unlimited). A request that finds its lane full waits up to
+LANE_QUEUE_TIMEOUT seconds and is then rejected with 503 + Retry-After.
+The device lane is unlimited by default, so admin and analytics load can
+only take the greenlets and DB connections their own limits allow. CPU-heavy
+analytics work runs in a separate process pool (analytics.py). Lanes isolate
+load inside a worker, so they need cooperative workers
+(GUNICORN_WORKER_CLASS=gevent); a sync worker runs one request at a time anyway.
+
+Per-lane queue depth and latency: GET /api/admin/lanes (this worker) and the
+lane_* series on /metrics (all workers).
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+from flask import g, jsonify, request
+
+from auth_tokens import TokenError, current_identity
+from metrics import LANE_IN_FLIGHT, LANE_QUEUED, LANE_REJECTED
+
+logger = logging.getLogger(__name__)
+
+LANES = ("device", "admin", "analytics")
+
+LANE_LIMITS = {
+    "device":    int(os.environ.get("LANE_DEVICE_LIMIT", 0)),
+    "admin":     int(os.environ.get("LANE_ADMIN_LIMIT", 8)),
+    "analytics": int(os.environ.get("LANE_ANALYTICS_LIMIT", 2)),
+}
+LANE_QUEUE_TIMEOUT = float(os.environ.get("LANE_QUEUE_TIMEOUT", 10))   # seconds
+LARGE_LISTING_ROWS = int(os.environ.get("LARGE_LISTING_ROWS", 1000))
+
+_LATENCY_WINDOW = 2048   # số request gần nhất để tính p50 / p99
+
+# Endpoint Flask -> lane; endpoint không có trong bảng thuộc lane admin, trừ khi request
+# mang device token đã verify (header X-Device-ID thì ai cũng gửi được, kể cả dashboard)
+_DEVICE_ENDPOINTS = {
+    "healthCheck",
+    "products.getProducts",
+    "products.batchSyncProducts",
+    "products.getRelatedProducts",
+    "products.serve_image",
+    "transactions.recordTransaction",
+    "devices.issue_device_token",
+    "users.registerUser",
+    "users.loginUser",
+    "users.logoutUser",
+    "users.get_user_by_id",
+    "users.get_user_recommendation",
+    "users.sync_user_profile",
+}
+_ANALYTICS_ENDPOINTS = {
+    "transactions.get_advanced_analytics",
+    "devices.get_restock_plan",
+    "devices.get_fleet_inventory",
+    "products.admin_rebuild_related",
+}
+
+
+def classify(endpoint, args=None, identity=None):
+    """Lane of a request from its Flask endpoint, query args and verified token claims (if any)."""
+    args = args or {}
+    if endpoint in _ANALYTICS_ENDPOINTS:
+        return "analytics"
+    if endpoint == "transactions.list_transactions":
+        try:
+            if int(args.get("limit", 20)) > LARGE_LISTING_ROWS:
+                return "analytics"
+        except (TypeError, ValueError):
+            pass
+        return "admin"
+    if endpoint in _DEVICE_ENDPOINTS or (identity or {}).get("typ") == "device":
+        return "device"
+    return "admin"
+
+
+class Lane:
+    """Concurrency limit, queue depth and latency of one lane in this worker."""
+
+    def __init__(self, name, limit, queue_timeout=LANE_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(limit) if limit > 0 else None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.latencies = deque(maxlen=_LATENCY_WINDOW)    # giây, từ lúc vào hàng đợi tới khi xong
+        self.queue_waits = deque(maxlen=_LATENCY_WINDOW)
+        self.stats = Counter()   # completed / rejected
+
+    def enter(self):
+        """Take a slot (waiting up to queue_timeout); False if the lane stayed full."""
+        started = time.perf_counter()
+        if self._slots is not None and not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.waiting += 1
+                self.peak_waiting = max(self.peak_waiting, self.waiting)
+            LANE_QUEUED.labels(self.name).inc()
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+                LANE_QUEUED.labels(self.name).dec()
+            if not acquired:
+                self.stats["rejected"] += 1
+                LANE_REJECTED.labels(self.name).inc()
+                return False
+        with self._lock:
+            self.in_flight += 1
+        LANE_IN_FLIGHT.labels(self.name).inc()
+        self.queue_waits.append(time.perf_counter() - started)
+        return True
+
+    def exit(self, elapsed):
+        with self._lock:
+            self.in_flight -= 1
+        LANE_IN_FLIGHT.labels(self.name).dec()
+        if self._slots is not None:
+            self._slots.release()
+        self.latencies.append(elapsed)
+        self.stats["completed"] += 1
+
+    def snapshot(self):
+        def percentiles(values):
+            if not values:
+                return None
+            p50, p99 = np.percentile(np.fromiter(values, dtype=float), [50, 99]) * 1000
+            return {"p50_ms": round(float(p50), 2), "p99_ms": round(float(p99), 2)}
+
+        return {
+            "limit": self.limit or None,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "peak_queue_depth": self.peak_waiting,
+            "completed": self.stats["completed"],
+            "rejected": self.stats["rejected"],
+            "latency": percentiles(list(self.latencies)),
+            "queue_wait": percentiles(list(self.queue_waits)),
+        }
+
+
+# ---------------------------------------------------------------------------
+# Per-worker lanes + Flask hooks
+# ---------------------------------------------------------------------------
+_lanes = {name: Lane(name, LANE_LIMITS[name]) for name in LANES}
+
+
+def get_lane(name) -> Lane:
+    return _lanes[name]
+
+
+def lane_stats():
+    return {name: lane.snapshot() for name, lane in _lanes.items()}
+
+
+def _verified_identity():
+    try:
+        return current_identity()
+    except TokenError:
+        # Token sai: view sẽ trả 401, ở đây chỉ không được ưu tiên
+        return None
+
+
+def _enter_lane():
+    name = classify(request.endpoint, request.args, _verified_identity())
+    g.lane = name
+    g.lane_started = time.perf_counter()
+    if not _lanes[name].enter():
+        g.lane_acquired = False
+        response = jsonify({'success': False, 'message': f'Server busy ({name} lane full), retry later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(max(1, int(LANE_QUEUE_TIMEOUT)))
+        return response
+    g.lane_acquired = True
+    return None
+
+
+def _exit_lane(exc):
+    if g.get("lane_acquired"):
+        g.lane_acquired = False
+        _lanes[g.lane].exit(time.perf_counter() - g.lane_started)
+
+
+def init_lanes(app):
+    app.before_request(_enter_lane)
+    app.teardown_request(_exit_lane)
+
+    @app.route('/api/admin/lanes')
+    def laneStats():
+        """Hàng đợi / độ trễ từng lane của worker này."""
+        from analytics import pool_stats
+        return jsonify({'success': True, 'pid': os.getpid(), 'lanes': lane_stats(),
+                        'analytics_pool': pool_stats()})
+
+
+def _reset_after_fork():
+    global _lanes
+    _lanes = {name: Lane(name, LANE_LIMITS[name]) for name in LANES}
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,58 @@
+"""
+Process lifecycle of the API workers (called from gunicorn.conf.py).
+
+gunicorn runs with --preload, so the app is imported once in the master and
+then forked. Long-lived MQTT clients and listener threads must therefore only
+be created in the workers: mqtt_publisher, presence, invalidation and catalog_matrix drop
+anything inherited through fork() (os.register_at_fork) and create their
+clients lazily on first use (the catalog is preloaded in post_fork).
+
+Each worker gets a slot (0..workers-1) from the master; a replacement worker
+reuses the slot of the one it replaces, so broker client IDs stay stable and
+the broker takes over the old session instead of piling up new ones.
+"""
+
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+CLIENT_ID_PREFIX = os.environ.get("MQTT_CLIENT_ID", "vending_server")
+
+_worker_slot = None
+
+
+def client_id(role=None):
+    """Stable MQTT client ID of this process: <prefix>_<host>_w<slot> (pid outside gunicorn)."""
+    suffix = role or (f"w{_worker_slot}" if _worker_slot is not None else str(os.getpid()))
+    return f"{CLIENT_ID_PREFIX}_{socket.gethostname()}_{suffix}"
+
+
+def post_fork(slot):
+    """Worker side, right after fork."""
+    global _worker_slot
+    _worker_slot = slot
+    logger.info("Worker %s started in slot %s (MQTT client %s)", os.getpid(), slot, client_id())
+
+    from catalog_matrix import CATALOG_MATRIX_ENABLED, get_catalog
+    if CATALOG_MATRIX_ENABLED:
+        try:
+            get_catalog()   # nạp sẵn để request đầu tiên không phải chờ
+        except Exception as exc:
+            logger.warning("Could not preload catalog matrix: %s", exc)
+
+
+def shutdown():
+    """Worker side, on exit: stop the listeners and the analytics pool, then flush and close the publisher."""
+    from analytics import shutdown_analytics
+    from catalog_matrix import shutdown_catalog
+    from invalidation import shutdown_bus
+    from mqtt_publisher import shutdown_publisher
+    from presence import shutdown_presence
+
+    shutdown_bus()
+    shutdown_catalog()
+    shutdown_analytics()
+    shutdown_presence()
+    shutdown_publisher()
@@ -0,0 +1,181 @@
+"""
+Prometheus metrics, scraped from GET /metrics.
+
+    http_requests_total{blueprint, endpoint, method, status, lane}
+    http_request_duration_seconds{blueprint, endpoint, method}    histogram
+    http_request_db_seconds{blueprint, endpoint}                  histogram, DB time per request
+    db_queries_total{blueprint, endpoint}
+    db_connections_in_use / db_connections_max                   gauges (in use: summed, max: per process)
+    db_connection_wait_seconds                                    histogram
+    mqtt_messages_total{result}                                   enqueued / published / dropped / failed
+    mqtt_publish_latency_seconds                                  histogram, enqueue -> handed to the broker
+    mqtt_publish_queue_depth                                      gauge
+    vending_transactions_total{device_id, source}                 source = http | mqtt, unverified ids -> "unknown"
+    lane_in_flight{lane} / lane_queue_depth{lane}                 gauges (lanes.py)
+    lane_rejected_total{lane}
+
+Under gunicorn every worker (and the MQTT sidecar) writes its samples to
+PROMETHEUS_MULTIPROC_DIR (set up in gunicorn.conf.py); /metrics merges them,
+so counters and histograms are totals for the whole container whichever
+worker answers the scrape. Gauges are summed over live processes (the
+per-process limits report their maximum). The
+ingestor service exposes its own metrics on INGEST_METRICS_PORT.
+
+prometheus_client is optional: without it every metric is a no-op and
+/metrics answers 503.
+"""
+
+import logging
+import os
+import time
+
+from flask import Response, g, has_request_context, jsonify, request
+
+logger = logging.getLogger(__name__)
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+except ImportError:   # prometheus_client là tuỳ chọn
+    prometheus_client = None
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true" and prometheus_client is not None
+
+_LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+_DB_BUCKETS      = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5, 30)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _counter(name, doc, labels=()):
+    return Counter(name, doc, labels) if METRICS_ENABLED else _NoopMetric()
+
+
+def _histogram(name, doc, labels=(), buckets=_LATENCY_BUCKETS):
+    return Histogram(name, doc, labels, buckets=buckets) if METRICS_ENABLED else _NoopMetric()
+
+
+def _gauge(name, doc, labels=(), mode="livesum"):
+    # livesum: cộng giá trị của các process còn sống
+    return Gauge(name, doc, labels, multiprocess_mode=mode) if METRICS_ENABLED else _NoopMetric()
+
+
+HTTP_REQUESTS = _counter("http_requests_total", "HTTP requests",
+                         ("blueprint", "endpoint", "method", "status", "lane"))
+HTTP_LATENCY  = _histogram("http_request_duration_seconds", "HTTP request latency",
+                           ("blueprint", "endpoint", "method"))
+HTTP_DB_TIME  = _histogram("http_request_db_seconds", "Time spent in database queries per HTTP request",
+                           ("blueprint", "endpoint"), buckets=_DB_BUCKETS)
+DB_QUERIES    = _counter("db_queries_total", "Database queries executed by HTTP requests", ("blueprint", "endpoint"))
+
+DB_CONNECTIONS_IN_USE = _gauge("db_connections_in_use", "Open database connections")
+DB_CONNECTIONS_MAX    = _gauge("db_connections_max", "Database connection limit per process (DB_MAX_CONNECTIONS)",
+                               mode="livemax")
+DB_CONNECTION_WAIT    = _histogram("db_connection_wait_seconds", "Wait for a free database connection slot",
+                                   buckets=_DB_BUCKETS)
+
+MQTT_MESSAGES        = _counter("mqtt_messages_total", "MQTT publisher messages by result", ("result",))
+MQTT_PUBLISH_LATENCY = _histogram("mqtt_publish_latency_seconds", "MQTT enqueue -> publish latency")
+MQTT_QUEUE_DEPTH     = _gauge("mqtt_publish_queue_depth", "Messages waiting in the MQTT publish queue")
+
+# device_id chỉ là nhãn khi đã xác minh (device_label); còn lại gộp vào "unknown"
+TRANSACTIONS = _counter("vending_transactions_total", "Recorded sales transactions", ("device_id", "source"))
+
+LANE_IN_FLIGHT = _gauge("lane_in_flight", "Requests running per lane", ("lane",))
+LANE_QUEUED    = _gauge("lane_queue_depth", "Requests waiting for a lane slot", ("lane",))
+LANE_REJECTED  = _counter("lane_rejected_total", "Requests rejected because their lane stayed full", ("lane",))
+
+
+UNKNOWN_DEVICE = "unknown"
+
+
+def device_label(device_id, verified):
+    """
+    Label value for a device: its id only when verified (device token subject,
+    or a machine with a layout in device_inventory), so a client making up
+    device ids cannot create unbounded series.
+    """
+    return device_id if verified and device_id else UNKNOWN_DEVICE
+
+
+def record_db_query(elapsed):
+    """Add one query's time to the current request (no-op outside a request)."""
+    if has_request_context():
+        g.metrics_db_seconds = g.get("metrics_db_seconds", 0.0) + elapsed
+        g.metrics_db_queries = g.get("metrics_db_queries", 0) + 1
+
+
+def _route_labels():
+    endpoint = request.endpoint or "<unmatched>"
+    return request.blueprint or "", endpoint
+
+
+def _start_timer():
+    g.metrics_started = time.perf_counter()
+
+
+def _observe_request(response):
+    started = g.get("metrics_started")
+    if started is None:
+        return response
+    blueprint, endpoint = _route_labels()
+    HTTP_REQUESTS.labels(blueprint, endpoint, request.method, str(response.status_code), g.get("lane", "")).inc()
+    HTTP_LATENCY.labels(blueprint, endpoint, request.method).observe(time.perf_counter() - started)
+    HTTP_DB_TIME.labels(blueprint, endpoint).observe(g.get("metrics_db_seconds", 0.0))
+    queries = g.get("metrics_db_queries", 0)
+    if queries:
+        DB_QUERIES.labels(blueprint, endpoint).inc(queries)
+    return response
+
+
+def _registry():
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return prometheus_client.REGISTRY
+
+
+def init_metrics(app):
+    if not METRICS_ENABLED:
+        @app.route('/metrics')
+        def prometheusMetrics():
+            return jsonify({'success': False, 'message': 'Metrics disabled (prometheus_client not installed)'}), 503
+        return
+
+    app.before_request(_start_timer)
+    app.after_request(_observe_request)
+
+    @app.route('/metrics')
+    def prometheusMetrics():
+        """Prometheus: số liệu gộp của mọi worker."""
+        return Response(prometheus_client.generate_latest(_registry()),
+                        content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def start_exporter(port):
+    """Serve /metrics on its own port (processes without Flask, e.g. the ingestor)."""
+    if METRICS_ENABLED and port:
+        prometheus_client.start_http_server(port, registry=_registry())
+        logger.info("Prometheus metrics on :%s", port)
+
+
+def mark_process_dead(pid):
+    """gunicorn child_exit: drop the live gauges of a dead worker."""
+    if METRICS_ENABLED and os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
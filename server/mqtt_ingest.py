@@ -0,0 +1,580 @@
+"""
+MQTT telemetry ingestion service.
+
+Machines publish sales and stock reports over their existing broker
+connection instead of HTTP POSTs through the tunnel:
+
+- vending_machine/<device_id>/sales : {"message_id", "total_amount", "items", "customer_info"?, "created_at"?}
+- vending_machine/<device_id>/stock : {"message_id", "items": [{"item_name", "units_left"}]}
+
+Messages are deduplicated by message_id, buffered and written to Postgres in
+micro-batches (one transaction per batch). After the commit every device gets
+one acknowledgement on vending_machine/<device_id>/ack listing its message ids.
+Malformed messages are acknowledged right away with status "rejected" so the
+machine stops resending them; a batch that fails in Postgres is retried one
+message at a time.
+
+Runs as its own process (see docker-compose ``ingestor``) so that gunicorn
+workers never process the same message twice:
+
+    python mqtt_ingest.py
+"""
+
+import json
+import logging
+import math
+import os
+import queue
+import signal
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+from database import getDatabaseConnection
+from alerts import evaluate_stock
+from outbox import Outbox
+from invalidation import notify
+from metrics import TRANSACTIONS, device_label, start_exporter
+
+logger = logging.getLogger(__name__)
+
+# --- Topics ---
+TOPIC_SALES = "vending_machine/+/sales"
+TOPIC_STOCK = "vending_machine/+/stock"
+TOPIC_ACK   = "vending_machine/{device_id}/ack"
+
+# --- Batching ---
+BATCH_SIZE      = int(os.environ.get("INGEST_BATCH_SIZE", 500))
+FLUSH_INTERVAL  = float(os.environ.get("INGEST_FLUSH_INTERVAL", 0.5))   # seconds
+DEDUP_CAPACITY  = int(os.environ.get("INGEST_DEDUP_CAPACITY", 100_000))
+QUEUE_MAXSIZE   = int(os.environ.get("INGEST_QUEUE_MAXSIZE", 50_000))
+INGEST_METRICS_PORT = int(os.environ.get("INGEST_METRICS_PORT", 0))        # 0 = không mở /metrics
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """MQTT wildcard match ('+' = one level, '#' = the rest)."""
+    p_parts, t_parts = pattern.split("/"), topic.split("/")
+    for i, part in enumerate(p_parts):
+        if part == "#":
+            return True
+        if i >= len(t_parts) or (part != "+" and part != t_parts[i]):
+            return False
+    return len(p_parts) == len(t_parts)
+
+
+# ---------------------------------------------------------------------------
+# Transports
+# ---------------------------------------------------------------------------
+
+class InProcessBroker:
+    """
+    Minimal in-memory broker with the same subscribe/publish surface as
+    PahoTransport. Delivery is synchronous; every publish is also recorded in
+    ``published`` so tests can assert on acknowledgements.
+    """
+
+    def __init__(self):
+        self._subs = []
+        self._lock = threading.Lock()
+        self.published = []
+
+    def subscribe(self, pattern, callback):
+        with self._lock:
+            self._subs.append((pattern, callback))
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self._lock:
+            self.published.append((topic, payload))
+            targets = [cb for pattern, cb in self._subs if topic_matches(pattern, topic)]
+        for callback in targets:
+            callback(topic, payload)
+        return True
+
+    def publish_batch(self, messages, timeout=10):
+        """Publish (topic, payload, qos, retain) tuples; returns how many leading ones were delivered."""
+        for topic, payload, qos, retain in messages:
+            self.publish(topic, payload, qos=qos, retain=retain)
+        return len(messages)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class PahoTransport:
+    """paho-mqtt client wrapper; re-subscribes automatically after reconnects."""
+
+    def __init__(self, client_id=None, clean_session=False):
+        import paho.mqtt.client as mqtt
+
+        self.host     = os.environ.get("MQTT_BROKER_HOST", "localhost")
+        self.port     = int(os.environ.get("MQTT_BROKER_PORT", 1883))
+        self._subs    = []
+        client_id = client_id or os.environ.get("MQTT_INGEST_CLIENT_ID", "vending_server_ingest")
+        # clean_session=False: broker giữ tin QoS1 khi service khởi động lại
+        self._client = mqtt.Client(client_id=client_id, clean_session=clean_session)
+        username = os.environ.get("MQTT_USERNAME", "")
+        if username:
+            self._client.username_pw_set(username, os.environ.get("MQTT_PASSWORD", ""))
+        self._client.on_connect = self._on_connect
+        self._client.on_message = self._on_message
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.warning("MQTT ingest failed to connect, return code: %s", rc)
+            return
+        logger.info("MQTT ingest connected to broker %s:%s", self.host, self.port)
+        for pattern, _ in self._subs:
+            client.subscribe(pattern, qos=1)
+
+    def _on_message(self, client, userdata, msg):
+        for pattern, callback in self._subs:
+            if topic_matches(pattern, msg.topic):
+                # Lỗi của một callback không được làm chết network loop chung (ingest + presence)
+                try:
+                    callback(msg.topic, msg.payload)
+                except Exception:
+                    logger.exception("MQTT callback for %s failed", msg.topic)
+
+    def subscribe(self, pattern, callback):
+        self._subs.append((pattern, callback))
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        return self._client.publish(topic, payload, qos=qos, retain=retain).rc == 0
+
+    def publish_batch(self, messages, timeout=10):
+        """
+        Publish (topic, payload, qos, retain) tuples back to back, then wait for
+        the broker acknowledgements (PUBACK for QoS 1). Returns how many leading
+        messages were confirmed, so callers can mark exactly those as delivered.
+        """
+        infos = []
+        for topic, payload, qos, retain in messages:
+            info = self._client.publish(topic, payload, qos=qos, retain=retain)
+            if info.rc != 0:
+                break
+            infos.append(info)
+        deadline = time.monotonic() + timeout
+        confirmed = 0
+        for info in infos:
+            try:
+                info.wait_for_publish(max(0.0, deadline - time.monotonic()))
+            except (RuntimeError, ValueError):
+                break
+            if not info.is_published():
+                break
+            confirmed += 1
+        return confirmed
+
+    def start(self):
+        self._client.connect_async(self.host, self.port, keepalive=60)
+        self._client.loop_start()
+
+    def stop(self):
+        self._client.loop_stop()
+        self._client.disconnect()
+
+
+# ---------------------------------------------------------------------------
+# Validation
+# ---------------------------------------------------------------------------
+
+def _as_int(value, field):
+    """int, or an integral float / digit string; bool and anything else raise ValueError."""
+    if isinstance(value, bool):
+        raise ValueError(f"{field} must be an integer")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value)
+    raise ValueError(f"{field} must be an integer")
+
+
+def _as_amount(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError("total_amount must be a number")
+    amount = float(value)
+    if not math.isfinite(amount) or amount < 0:
+        raise ValueError("total_amount must be a non-negative number")
+    return amount
+
+
+def _item_list(items):
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ValueError("items must be a list of objects")
+    for item in items:
+        name = _item_name(item)
+        if name is not None and not isinstance(name, str):
+            raise ValueError("item name must be a string")
+    return items
+
+
+def normalize_message(kind, msg):
+    """
+    Validate a decoded sales / stock message and coerce every field
+    write_batch reads to the type it expects. Raises ValueError / KeyError /
+    TypeError for messages that could never be written.
+    """
+    if not isinstance(msg, dict):
+        raise ValueError("message must be an object")
+    msg = dict(msg, message_id=str(msg["message_id"]))
+    if kind == "sales":
+        msg["total_amount"] = _as_amount(msg["total_amount"])
+        msg["items"] = [dict(item, quantity=_as_int(item.get("quantity", 1), "quantity"))
+                        for item in _item_list(msg["items"])]
+        customer = msg.get("customer_info")
+        if customer is not None:
+            if not isinstance(customer, dict):
+                raise ValueError("customer_info must be an object")
+            user_id = customer.get("user_id")
+            if user_id is not None:
+                if isinstance(user_id, bool) or not isinstance(user_id, (str, int)):
+                    raise ValueError("customer_info.user_id must be a string")
+                msg["customer_info"] = dict(customer, user_id=str(user_id))
+        created_at = msg.get("created_at")
+        if created_at is not None:
+            if not isinstance(created_at, str):
+                raise ValueError("created_at must be an ISO 8601 string")
+            datetime.fromisoformat(created_at)
+    elif kind == "stock":
+        items = []
+        for item in _item_list(msg.get("items", [])):
+            if item.get("units_left") is not None:
+                item = dict(item, units_left=_as_int(item["units_left"], "units_left"))
+            items.append(item)
+        msg["items"] = items
+    else:
+        raise ValueError(f"unknown message kind {kind!r}")
+    return msg
+
+
+# ---------------------------------------------------------------------------
+# Batch writer
+# ---------------------------------------------------------------------------
+
+def _item_name(item):
+    return item.get('product_name') or item.get('name') or item.get('item_name')
+
+
+def _transaction_id(device_id, msg):
+    return f"mqtt_{device_id}_{msg['message_id']}"
+
+
+def write_batch(conn, sales, stock_reports):
+    """
+    Persist one micro-batch in a single transaction.
+
+    sales         : list of (device_id, message) — each becomes a transaction row
+                    keyed by "mqtt_<device_id>_<message_id>", so replays are no-ops.
+    stock_reports : list of (device_id, message) — absolute units_left per item.
+    Returns (inserted, alert_events): the sales transaction ids that were newly
+    inserted and the low-stock alerts opened / resolved by this batch.
+    """
+    now_iso = datetime.now(timezone.utc).isoformat()
+    cursor = conn.cursor()
+    inserted = set()
+    touched = []
+    provisioned = set()   # máy có bố cục trong device_inventory -> được dùng làm nhãn metrics
+
+    if sales:
+        rows = []
+        for device_id, msg in sales:
+            user_id = (msg.get('customer_info') or {}).get('user_id')
+            rows.append((_transaction_id(device_id, msg), msg['total_amount'], json.dumps(msg['items']),
+                         user_id, device_id, msg.get('created_at') or now_iso))
+        result = execute_values(cursor, """
+            INSERT INTO transactions (transaction_id, total_amount, items, user_id, device_id, payment_status, created_at)
+            VALUES %s
+            ON CONFLICT(transaction_id) DO NOTHING
+            RETURNING transaction_id
+        """, rows, template="(%s, %s, %s, %s, %s, 'completed', %s)", fetch=True)
+        inserted = {row[0] for row in result}
+
+        # Gom số lượng theo (máy, sản phẩm), theo sản phẩm và điểm theo khách -> mỗi loại 1 câu UPDATE
+        per_slot, per_item, points = Counter(), Counter(), Counter()
+        for device_id, msg in sales:
+            if _transaction_id(device_id, msg) not in inserted:
+                continue
+            for item in msg['items']:
+                name = _item_name(item)
+                if name:
+                    qty = int(item.get('quantity', 1))
+                    per_slot[(device_id, name)] += qty
+                    per_item[name] += qty
+            user_id = (msg.get('customer_info') or {}).get('user_id')
+            if user_id:
+                points[user_id] += int(msg['total_amount'] / 1000)
+
+        if per_slot:
+            keys = list(per_slot)
+            touched.extend(keys)
+            cursor.execute("""
+                UPDATE device_inventory d
+                SET units_left = d.units_left - t.qty
+                FROM unnest(%s::text[], %s::text[], %s::int[]) AS t(device_id, item_name, qty)
+                WHERE d.device_id = t.device_id AND d.item_name = t.item_name
+                RETURNING d.device_id
+            """, ([k[0] for k in keys], [k[1] for k in keys], [per_slot[k] for k in keys]))
+            provisioned = {row[0] for row in cursor.fetchall()}
+            cursor.execute("""
+                UPDATE inventory i
+                SET units_sold = i.units_sold + t.qty
+                FROM unnest(%s::text[], %s::int[]) AS t(item_name, qty)
+                WHERE i.item_name = t.item_name
+            """, (list(per_item), list(per_item.values())))
+        if points:
+            cursor.execute("""
+                UPDATE users u
+                SET points = u.points + t.pts, updated_at = %s
+                FROM unnest(%s::text[], %s::int[]) AS t(user_id, pts)
+                WHERE u.user_id = t.user_id
+            """, (now_iso, list(points), list(points.values())))
+
+    if stock_reports:
+        # Báo cáo sau cùng của mỗi (máy, sản phẩm) trong lô là giá trị đúng
+        latest = {}
+        for device_id, msg in stock_reports:
+            for item in msg.get('items', []):
+                name = _item_name(item)
+                if name is not None and item.get('units_left') is not None:
+                    latest[(device_id, name)] = int(item['units_left'])
+        if latest:
+            keys = list(latest)
+            touched.extend(keys)
+            cursor.execute("""
+                UPDATE device_inventory d
+                SET units_left = t.units_left, last_updated = %s
+                FROM unnest(%s::text[], %s::text[], %s::int[]) AS t(device_id, item_name, units_left)
+                WHERE d.device_id = t.device_id AND d.item_name = t.item_name
+            """, (now_iso, [k[0] for k in keys], [k[1] for k in keys], [latest[k] for k in keys]))
+
+    devices = sorted({d for d, _ in sales} | {d for d, _ in stock_reports})
+    cursor.execute("""
+        INSERT INTO devices (device_id, last_active)
+        SELECT t.device_id, %s FROM unnest(%s::text[]) AS t(device_id)
+        ON CONFLICT(device_id) DO UPDATE SET last_active = EXCLUDED.last_active
+    """, (now_iso, devices))
+    alert_events = evaluate_stock(cursor, pairs=touched, now_iso=now_iso)
+    # Ảnh chụp catalog giữ lại (retained) của mỗi máy có tồn kho thay đổi, 1 lần cho cả lô
+    Outbox(cursor).publish_catalog_snapshots(sorted({device_id for device_id, _ in touched}))
+    notify(cursor, 'device', {device_id for device_id, _ in touched})
+    if sales:
+        notify(cursor, 'user', points)
+    conn.commit()
+    sold = Counter(device_label(device_id, device_id in provisioned)
+                   for device_id, msg in sales if _transaction_id(device_id, msg) in inserted)
+    for label, count in sold.items():
+        TRANSACTIONS.labels(label, 'mqtt').inc(count)
+    return inserted, alert_events
+
+
+# ---------------------------------------------------------------------------
+# Ingestor
+# ---------------------------------------------------------------------------
+
+class TelemetryIngestor:
+    """Subscribes to device telemetry, buffers it and flushes micro-batches to Postgres."""
+
+    def __init__(self, transport, connect=getDatabaseConnection,
+                 batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self._transport = transport
+        self._connect = connect
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=QUEUE_MAXSIZE)
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = Counter()
+
+    # --- receiving -------------------------------------------------------
+
+    def _remember(self, key):
+        """Returns False if (device_id, message_id) was already seen (duplicate)."""
+        with self._seen_lock:
+            if key in self._seen:
+                self._seen.move_to_end(key)
+                return False
+            self._seen[key] = True
+            if len(self._seen) > DEDUP_CAPACITY:
+                self._seen.popitem(last=False)
+            return True
+
+    def _forget(self, keys):
+        with self._seen_lock:
+            for key in keys:
+                self._seen.pop(key, None)
+
+    def _ack(self, device_id, message_ids, status="ok"):
+        payload = json.dumps({"status": status, "message_ids": message_ids})
+        self._transport.publish(TOPIC_ACK.format(device_id=device_id), payload, qos=1)
+
+    def handle_message(self, topic, payload):
+        """Transport callback: validate, dedupe and enqueue one message."""
+        parts = topic.split("/")
+        if len(parts) != 3:
+            return
+        device_id, kind = parts[1], parts[2]
+        message_id = None
+        try:
+            msg = json.loads(payload)
+            message_id = str(msg["message_id"]) if isinstance(msg, dict) and "message_id" in msg else None
+            msg = normalize_message(kind, msg)
+        except (ValueError, KeyError, TypeError) as exc:
+            self.stats["rejected"] += 1
+            logger.warning("Rejected %s message from %s: %s", kind, device_id, exc)
+            # Ack "rejected": máy bỏ tin hỏng thay vì gửi lại mãi
+            if message_id is not None:
+                self._ack(device_id, [message_id], status="rejected")
+            return
+
+        if not self._remember((device_id, message_id)):
+            self.stats["duplicates"] += 1
+            self._ack(device_id, [message_id], status="duplicate")
+            return
+        try:
+            self._queue.put_nowait((kind, device_id, msg))
+        except queue.Full:
+            # Không ack -> máy sẽ gửi lại
+            self._forget([(device_id, message_id)])
+            self.stats["dropped"] += 1
+            logger.warning("Ingest queue full, dropped %s from %s", message_id, device_id)
+
+    # --- flushing --------------------------------------------------------
+
+    def _drain(self):
+        """Collect up to batch_size messages, waiting at most flush_interval."""
+        batch = []
+        deadline = time.monotonic() + self._flush_interval
+        while len(batch) < self._batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, conn, batch):
+        sales = [(d, m) for kind, d, m in batch if kind == "sales"]
+        stock = [(d, m) for kind, d, m in batch if kind == "stock"]
+        _, alert_events = write_batch(conn, sales, stock)
+        # Cảnh báo tồn kho đã nằm trong outbox của cùng transaction
+        self.stats["alerts"] += len(alert_events)
+        self.stats["sales"] += len(sales)
+        self.stats["stock"] += len(stock)
+
+    def _write_one_by_one(self, conn, batch):
+        """Retry a failed batch message by message; returns (written, failed)."""
+        written, failed = [], []
+        for i, entry in enumerate(batch):
+            if conn.closed:
+                # Mất kết nối: phần còn lại để máy gửi lại
+                failed.extend(batch[i:])
+                break
+            try:
+                self._write(conn, [entry])
+                written.append(entry)
+            except Exception as exc:
+                if not conn.closed:
+                    conn.rollback()
+                failed.append(entry)
+                _, device_id, msg = entry
+                logger.error("Ingest of %s from %s failed: %s", msg["message_id"], device_id, exc)
+        return written, failed
+
+    def flush(self, batch):
+        """
+        Write one batch and acknowledge it per device. If the batch fails it is
+        retried one message at a time, so one bad message cannot block the
+        others. Returns True if every message was written.
+        """
+        if not batch:
+            return True
+        conn = self._connect()
+        try:
+            try:
+                self._write(conn, batch)
+                written, failed = batch, []
+            except Exception as exc:
+                if not conn.closed:
+                    conn.rollback()
+                self.stats["failed_batches"] += 1
+                logger.error("Ingest batch of %s failed: %s", len(batch), exc)
+                written, failed = self._write_one_by_one(conn, batch) if len(batch) > 1 else ([], batch)
+        finally:
+            conn.close()
+
+        if failed:
+            # Cho phép máy gửi lại: bỏ id khỏi bộ nhớ chống trùng và không ack
+            self._forget([(d, m["message_id"]) for _, d, m in failed])
+            self.stats["failed"] += len(failed)
+        by_device = {}
+        for _, device_id, msg in written:
+            by_device.setdefault(device_id, []).append(msg["message_id"])
+        for device_id, ids in by_device.items():
+            self._ack(device_id, ids)
+        if written:
+            self.stats["batches"] += 1
+        return not failed
+
+    def _run(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            self.flush(self._drain())
+
+    # --- lifecycle -------------------------------------------------------
+
+    def start(self):
+        self._transport.subscribe(TOPIC_SALES, self.handle_message)
+        self._transport.subscribe(TOPIC_STOCK, self.handle_message)
+        self._thread = threading.Thread(target=self._run, name="mqtt-ingest", daemon=True)
+        self._thread.start()
+        self._transport.start()
+
+    def stop(self, timeout=10):
+        """Stop receiving, flush what is buffered, then disconnect."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._transport.stop()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    from presence import PresenceTracker
+
+    transport = PahoTransport()
+    ingestor = TelemetryIngestor(transport)
+    # Tiến trình duy nhất ghi trạng thái online/offline xuống DB
+    presence = PresenceTracker(transport, persist=True)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+
+    try:
+        presence.seed()
+    except Exception as exc:
+        logger.warning("Could not seed presence table: %s", exc)
+    presence.start()
+    ingestor.start()
+    start_exporter(INGEST_METRICS_PORT)
+    logger.info("MQTT telemetry ingestor running (batch=%s, interval=%ss)", BATCH_SIZE, FLUSH_INTERVAL)
+    while not stopped.wait(60):
+        logger.info("Ingest stats: %s", dict(ingestor.stats))
+    presence.stop()
+    ingestor.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,128 +2,95 @@
 MQTT Publisher Module for Vending Machine Server.
 
 Publishes product update notifications to clients in real-time:
-- vending_machine/product/update       : price / stock hot-updates
-- vending_machine/product/data_changed : new product created or details modified
+- vending_machine/<device_id>/catalog/update   : price / stock hot-updates for one machine
+- vending_machine/<device_id>/catalog/snapshot : retained compact catalog of one machine (catalog.py)
+- vending_machine/product/data_changed         : new product created or details modified
+- vending_machine/product/update               : legacy shared hot-update topic (MQTT_LEGACY_SHARED_TOPICS)
+
+Publishing never blocks the request thread: messages are put on a bounded
+in-memory queue and a dedicated sender thread delivers them to the broker,
+backing off while the broker is unreachable. When the queue is full the
+overflow policy (MQTT_QUEUE_OVERFLOW) drops the oldest or the newest message.
+disconnect() flushes what is still queued before closing.
+
+Under gunicorn (MQTT_CONNECTION_MODE):
+- worker  : each worker owns one connection with a stable client ID
+            (<MQTT_CLIENT_ID>_<host>_w<slot>, see lifecycle.py), shared by
+            publishing and the presence subscription;
+- sidecar : workers talk to mqtt_sidecar.py over a Unix socket and the
+            container keeps a single broker connection however many workers run.
+A publisher inherited through fork() is discarded in the child (its network
+thread does not exist there) and recreated on first use.
 """
 
+import atexit
 import json
 import os
 import logging
+import queue
 import time
 import threading
+from collections import Counter, deque
 
 import paho.mqtt.client as mqtt
 
+from metrics import MQTT_MESSAGES, MQTT_PUBLISH_LATENCY, MQTT_QUEUE_DEPTH
+
 logger = logging.getLogger(__name__)
 
 # --- Topics ---
-TOPIC_PRODUCT_UPDATE = "vending_machine/product/update"
-TOPIC_DATA_CHANGED   = "vending_machine/product/data_changed"
-
-# --- Retry settings ---
-_MAX_RETRIES = 3
-_RETRY_DELAY = 1  # seconds between retries
+TOPIC_PRODUCT_UPDATE  = "vending_machine/product/update"
+TOPIC_DATA_CHANGED    = "vending_machine/product/data_changed"
+TOPIC_DEVICE_UPDATE   = "vending_machine/{device_id}/catalog/update"
+TOPIC_DEVICE_SNAPSHOT = "vending_machine/{device_id}/catalog/snapshot"
 
+# Máy đời cũ vẫn nghe topic chung: tắt khi toàn bộ máy đã chuyển sang topic riêng
+LEGACY_SHARED_TOPICS = os.environ.get("MQTT_LEGACY_SHARED_TOPICS", "true").lower() == "true"
 
-class MQTTPublisher:
-    """Thread-safe MQTT publisher with graceful error handling."""
+# Các sự kiện broadcast (data_changed) kèm refetch_window_ms: mỗi máy chờ ngẫu nhiên
+# trong [0, refetch_window_ms) rồi mới gọi lại GET /api/products, tránh cả đội máy cùng gọi 1 lúc
+CATALOG_REFETCH_WINDOW_MS = int(os.environ.get("CATALOG_REFETCH_WINDOW_MS", 5000))   # tối thiểu
+CATALOG_REFETCH_RATE      = float(os.environ.get("CATALOG_REFETCH_RATE", 50))       # request/s mục tiêu
 
-    def __init__(self):
-        self.host     = os.environ.get("MQTT_BROKER_HOST", "localhost")
-        self.port     = int(os.environ.get("MQTT_BROKER_PORT", 1883))
-        self.username = os.environ.get("MQTT_USERNAME", "")
-        self.password = os.environ.get("MQTT_PASSWORD", "")
-        self._client  = None
-        self._lock    = threading.Lock()
-        self._connected = False
-        self._connect()
+# worker | sidecar (mqtt_sidecar.py)
+MQTT_CONNECTION_MODE = os.environ.get("MQTT_CONNECTION_MODE", "worker")
 
-    # ------------------------------------------------------------------
-    # Internal helpers
-    # ------------------------------------------------------------------
+# --- Queue / retry settings ---
+_QUEUE_MAXSIZE   = int(os.environ.get("MQTT_PUBLISH_QUEUE_SIZE", 10_000))
+_OVERFLOW_POLICY = os.environ.get("MQTT_QUEUE_OVERFLOW", "drop_oldest")   # drop_oldest | drop_newest
+_MAX_RETRIES     = 3      # lần thử khi ĐANG kết nối mà broker vẫn từ chối
+_BACKOFF_MIN     = 0.5    # seconds
+_BACKOFF_MAX     = 30.0   # seconds
+_FLUSH_TIMEOUT   = float(os.environ.get("MQTT_FLUSH_TIMEOUT", 5))   # seconds, khi tắt worker
+_LATENCY_SAMPLES = 1000
 
-    def _on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            self._connected = True
-            logger.info("MQTT publisher connected to broker %s:%s", self.host, self.port)
-        else:
-            self._connected = False
-            logger.warning("MQTT publisher failed to connect, return code: %s", rc)
 
-    def _on_disconnect(self, client, userdata, rc):
-        self._connected = False
-        if rc != 0:
-            logger.warning("MQTT publisher unexpectedly disconnected (rc=%s). Will retry on next publish.", rc)
+class ChangeNotifier:
+    """
+    Payload builders for every change notification. Subclasses decide how a
+    message leaves: MQTTPublisher sends it to the broker, outbox.Outbox writes
+    it to the outbox table inside the caller's transaction.
+    """
 
-    def _connect(self):
-        """Attempt to connect to the MQTT broker. Errors are non-fatal."""
-        try:
-            client = mqtt.Client()
-            client.on_connect    = self._on_connect
-            client.on_disconnect = self._on_disconnect
-            if self.username:
-                client.username_pw_set(self.username, self.password)
-            client.connect_async(self.host, self.port, keepalive=60)
-            client.loop_start()
-            self._client = client
-        except Exception as exc:
-            logger.warning("MQTT broker unavailable, publisher disabled: %s", exc)
-            self._client = None
+    def _publish(self, topic: str, payload: dict, qos: int = 1, retain: bool = False) -> bool:
+        raise NotImplementedError
 
-    def _ensure_connected(self):
-        """Re-connect if the broker connection was lost."""
-        if self._client is None:
-            self._connect()
-        elif not self._connected:
-            try:
-                self._client.reconnect()
-                time.sleep(0.5)
-            except Exception as exc:
-                logger.debug("MQTT reconnect attempt failed: %s", exc)
-
-    def _publish(self, topic: str, payload: dict) -> bool:
-        """
-        Publish *payload* (dict) to *topic* with retry logic.
-        Returns True on success, False on failure.
-        """
-        message = json.dumps(payload, ensure_ascii=False)
-        for attempt in range(1, _MAX_RETRIES + 1):
-            with self._lock:
-                self._ensure_connected()
-                if self._client is None or not self._connected:
-                    logger.warning(
-                        "MQTT not connected (attempt %s/%s), skipping publish to %s",
-                        attempt, _MAX_RETRIES, topic,
-                    )
-                    time.sleep(_RETRY_DELAY)
-                    continue
-                try:
-                    result = self._client.publish(topic, message, qos=1)
-                    if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                        logger.info("MQTT published to %s: %s", topic, message)
-                        return True
-                    logger.warning(
-                        "MQTT publish returned rc=%s (attempt %s/%s)",
-                        result.rc, attempt, _MAX_RETRIES,
-                    )
-                except Exception as exc:
-                    logger.warning(
-                        "MQTT publish error on attempt %s/%s: %s",
-                        attempt, _MAX_RETRIES, exc,
-                    )
-            time.sleep(_RETRY_DELAY)
-        logger.error("MQTT publish failed after %s attempts for topic %s", _MAX_RETRIES, topic)
-        return False
+    def _refetch_window_ms(self) -> int:
+        """Spread window for fleet-wide refetches; Outbox widens it with the fleet size."""
+        return CATALOG_REFETCH_WINDOW_MS
 
-    # ------------------------------------------------------------------
-    # Public API
-    # ------------------------------------------------------------------
+    def _publish_device(self, device_id: str, payload: dict, legacy_topic: str) -> bool:
+        """Per-device topic; also the old shared topic while MQTT_LEGACY_SHARED_TOPICS is on."""
+        ok = self._publish(TOPIC_DEVICE_UPDATE.format(device_id=device_id), payload)
+        if LEGACY_SHARED_TOPICS:
+            ok = self._publish(legacy_topic, payload) and ok
+        return ok
 
     def publish_product_update(self, device_id: str, product_id: str, price: float, units_left: int) -> bool:
         """
         Publish a hot-update (price or stock change) for a product.
 
-        Topic : vending_machine/product/update
+        Topic : vending_machine/<device_id>/catalog/update
         Payload: {"device_id": "...", "product_id": "...", "price": 12000, "units_left": 45}
         """
         payload = {
@@ -133,18 +100,19 @@ class MQTTPublisher:
             "units_left": units_left,
         }
         logger.info(f"Publishing product update for '{product_id}' (Target: {device_id})")
-        return self._publish(TOPIC_PRODUCT_UPDATE, payload)
+        return self._publish_device(device_id, payload, TOPIC_PRODUCT_UPDATE)
 
     def publish_new_product(self, product_id: str) -> bool:
         """
         Notify clients that a brand-new product was added.
 
         Topic : vending_machine/product/data_changed
-        Payload: {"event": "new_product_added", "product_id": "..."}
+        Payload: {"event": "new_product_added", "product_id": "...", "refetch_window_ms": 5000}
         """
         payload = {
             "event":      "new_product_added",
             "product_id": product_id,
+            "refetch_window_ms": self._refetch_window_ms(),
         }
         logger.info("Publishing new_product event for '%s'", product_id)
         return self._publish(TOPIC_DATA_CHANGED, payload)
@@ -154,11 +122,12 @@ class MQTTPublisher:
         Notify clients that an existing product's details were changed.
 
         Topic : vending_machine/product/data_changed
-        Payload: {"event": "product_updated", "product_id": "..."}
+        Payload: {"event": "product_updated", "product_id": "...", "refetch_window_ms": 5000}
         """
         payload = {
             "event":      "product_updated",
             "product_id": product_id,
+            "refetch_window_ms": self._refetch_window_ms(),
         }
         logger.info("Publishing product_updated event for '%s'", product_id)
         return self._publish(TOPIC_DATA_CHANGED, payload)
@@ -172,13 +141,249 @@ class MQTTPublisher:
             "price": price,
             "units_left": units_left
         }
-        # Sử dụng biến TOPIC_PRODUCT_UPDATE ("vending_machine/product/update") 
-        # và hàm _publish có sẵn để có retry và in log đầy đủ
+        # Topic riêng của máy (vending_machine/<device_id>/catalog/update), kèm topic chung nếu còn máy cũ
         logger.info(f"Publishing HOT UPDATE for '{old_name}' -> '{new_name}' (Target: {device_id})")
-        return self._publish(TOPIC_PRODUCT_UPDATE, payload)
+        return self._publish_device(device_id, payload, TOPIC_PRODUCT_UPDATE)
+
+    def publish_planogram_changed(self, device_id: str, changes: dict) -> bool:
+        """
+        One coalesced notification for a whole-planogram update of a device.
+
+        Topic : vending_machine/<device_id>/catalog/update
+        Payload: {"event": "planogram_updated", "device_id": "...",
+                  "changes": {"added": [...], "removed": [...], "moved": [...], "restocked": [...]}}
+        """
+        payload = {
+            "event":     "planogram_updated",
+            "device_id": device_id,
+            "changes":   changes,
+        }
+        logger.info("Publishing planogram_updated event for '%s'", device_id)
+        return self._publish_device(device_id, payload, TOPIC_DATA_CHANGED)
+
+    def publish_catalog_snapshot(self, device_id: str, snapshot: dict) -> bool:
+        """
+        Retained compact catalog of one machine (see catalog.py for the format).
+
+        Topic : vending_machine/<device_id>/catalog/snapshot  (retain=True)
+        """
+        logger.info("Publishing catalog snapshot for '%s' (%s items)", device_id, len(snapshot.get("rows", ())))
+        return self._publish(TOPIC_DEVICE_SNAPSHOT.format(device_id=device_id), snapshot, retain=True)
+
+    def publish_fleet_changed(self, action: str, device_ids: list, product_ids: list) -> bool:
+        """
+        Single fan-out notification for a bulk fleet operation (assign / remove / clone).
+
+        Topic : vending_machine/product/data_changed
+        Payload: {"event": "fleet_updated", "action": "assign", "device_ids": [...], "product_ids": [...],
+                  "refetch_window_ms": 5000}
+        """
+        payload = {
+            "event":       "fleet_updated",
+            "action":      action,
+            "device_ids":  device_ids,
+            "product_ids": product_ids,
+            "refetch_window_ms": self._refetch_window_ms(),
+        }
+        logger.info("Publishing fleet_updated (%s) for %s devices", action, len(device_ids))
+        return self._publish(TOPIC_DATA_CHANGED, payload)
+
+    def publish_stock_alerts(self, events: list) -> bool:
+        """
+        Push opened / resolved low-stock alerts to admin subscribers.
+
+        Topic : vending_machine/admin/alerts
+        Payload: {"event": "stock_alerts", "alerts": [{"event": "opened", "device_id": "...",
+                  "item_name": "...", "units_left": 0, "threshold": 10, "severity": "out", ...}]}
+        """
+        from alerts import TOPIC_ALERTS, alerts_payload
+        logger.info("Publishing %s stock alert events", len(events))
+        return self._publish(TOPIC_ALERTS, alerts_payload(events))
+
 
-    def disconnect(self):
-        """Cleanly stop the MQTT loop and disconnect."""
+class MQTTPublisher(ChangeNotifier):
+    """Thread-safe, non-blocking MQTT publisher backed by a bounded queue and a sender thread."""
+
+    def __init__(self, client_id: str = ""):
+        self.client_id = client_id
+        self.host     = os.environ.get("MQTT_BROKER_HOST", "localhost")
+        self.port     = int(os.environ.get("MQTT_BROKER_PORT", 1883))
+        self.username = os.environ.get("MQTT_USERNAME", "")
+        self.password = os.environ.get("MQTT_PASSWORD", "")
+        self._client  = None
+        self._connected = False
+        self._queue   = queue.Queue(maxsize=_QUEUE_MAXSIZE)
+        self._stop    = threading.Event()
+        self._stats   = Counter()
+        self._stats_lock = threading.Lock()
+        self._latencies  = deque(maxlen=_LATENCY_SAMPLES)
+        self._busy    = False
+        self._subs    = []
+        self._connect()
+        self._sender = threading.Thread(target=self._run_sender, name="mqtt-publisher", daemon=True)
+        self._sender.start()
+
+    # ------------------------------------------------------------------
+    # Internal helpers
+    # ------------------------------------------------------------------
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self._connected = True
+            logger.info("MQTT publisher %s connected to broker %s:%s", self.client_id, self.host, self.port)
+            for pattern, _ in self._subs:
+                client.subscribe(pattern, qos=1)
+        else:
+            self._connected = False
+            logger.warning("MQTT publisher failed to connect, return code: %s", rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected = False
+        if rc != 0:
+            logger.warning("MQTT publisher unexpectedly disconnected (rc=%s). Reconnecting in background.", rc)
+
+    def _on_message(self, client, userdata, msg):
+        for pattern, callback in self._subs:
+            if mqtt.topic_matches_sub(pattern, msg.topic):
+                try:
+                    callback(msg.topic, msg.payload.decode("utf-8"))
+                except Exception as exc:
+                    logger.error("MQTT subscriber callback failed for %s: %s", msg.topic, exc)
+
+    def subscribe(self, pattern, callback):
+        """Share this connection with a subscriber (e.g. the presence tracker); survives reconnects."""
+        self._subs.append((pattern, callback))
+        if self._client is not None and self._connected:
+            self._client.subscribe(pattern, qos=1)
+
+    def _connect(self):
+        """Attempt to connect to the MQTT broker. Errors are non-fatal; paho reconnects on its own."""
+        try:
+            client = mqtt.Client(client_id=self.client_id)
+            client.on_connect    = self._on_connect
+            client.on_disconnect = self._on_disconnect
+            client.on_message    = self._on_message
+            if self.username:
+                client.username_pw_set(self.username, self.password)
+            client.reconnect_delay_set(min_delay=1, max_delay=int(_BACKOFF_MAX))
+            client.connect_async(self.host, self.port, keepalive=60)
+            client.loop_start()
+            self._client = client
+        except Exception as exc:
+            logger.warning("MQTT broker unavailable, will retry from sender thread: %s", exc)
+            self._client = None
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+        MQTT_MESSAGES.labels(key).inc(n)
+
+    def _publish(self, topic: str, payload: dict, qos: int = 1, retain: bool = False) -> bool:
+        """
+        Queue *payload* (dict) for *topic* and return immediately.
+        Returns True if the message was accepted for delivery, False if it was dropped.
+        """
+        item = (topic, json.dumps(payload, ensure_ascii=False), qos, retain, time.monotonic())
+        if self._stop.is_set():
+            self._count("dropped")
+            return False
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if _OVERFLOW_POLICY != "drop_oldest":
+                self._count("dropped")
+                logger.warning("MQTT publish queue full, dropped new message for %s", topic)
+                return False
+            try:
+                dropped_topic = self._queue.get_nowait()[0]
+                self._count("dropped")
+                logger.warning("MQTT publish queue full, dropped oldest message for %s", dropped_topic)
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._count("dropped")
+                return False
+        self._count("enqueued")
+        MQTT_QUEUE_DEPTH.set(self._queue.qsize())
+        return True
+
+    def _deliver(self, topic, message, qos, retain, enqueued_at) -> bool:
+        """Send one message, backing off while the broker is unreachable."""
+        attempts = 0
+        delay = _BACKOFF_MIN
+        while True:
+            if self._client is None:
+                self._connect()
+            if self._client is not None and self._connected:
+                try:
+                    rc = self._client.publish(topic, message, qos=qos, retain=retain).rc
+                except Exception as exc:
+                    logger.warning("MQTT publish error for %s: %s", topic, exc)
+                    rc = None
+                if rc == mqtt.MQTT_ERR_SUCCESS:
+                    latency = time.monotonic() - enqueued_at
+                    with self._stats_lock:
+                        self._stats["published"] += 1
+                        self._latencies.append(latency)
+                    MQTT_MESSAGES.labels("published").inc()
+                    MQTT_PUBLISH_LATENCY.observe(latency)
+                    logger.info("MQTT published to %s: %s", topic, message)
+                    return True
+                attempts += 1
+                if attempts >= _MAX_RETRIES:
+                    self._count("failed")
+                    logger.error("MQTT publish failed after %s attempts for topic %s (rc=%s)", attempts, topic, rc)
+                    return False
+            # Chờ có backoff; dừng hẳn nếu publisher đang tắt
+            if self._stop.wait(delay):
+                self._count("dropped")
+                return False
+            delay = min(delay * 2, _BACKOFF_MAX)
+
+    def _run_sender(self):
+        while not self._stop.is_set():
+            try:
+                item = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self._busy = True
+            MQTT_QUEUE_DEPTH.set(self._queue.qsize())
+            try:
+                self._deliver(*item)
+            finally:
+                self._busy = False
+
+    def metrics(self) -> dict:
+        """Queue depth, counters and enqueue->publish latency (ms) of recent messages."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+            samples = sorted(self._latencies)
+
+        def pct(p):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 2) if samples else None
+
+        return {
+            "connected":      self._connected,
+            "queue_depth":    self._queue.qsize(),
+            "queue_capacity": _QUEUE_MAXSIZE,
+            "enqueued":       stats.get("enqueued", 0),
+            "published":      stats.get("published", 0),
+            "dropped":        stats.get("dropped", 0),
+            "failed":         stats.get("failed", 0),
+            "latency_ms":     {"p50": pct(0.5), "p95": pct(0.95), "max": pct(1.0)},
+        }
+
+    def disconnect(self, flush_timeout: float = _FLUSH_TIMEOUT):
+        """Deliver what is still queued (up to *flush_timeout* seconds), then stop and disconnect."""
+        deadline = time.monotonic() + flush_timeout
+        while (self._busy or not self._queue.empty()) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stop.set()
+        self._sender.join(timeout=1)
+        if self._queue.qsize():
+            logger.warning("MQTT publisher closed with %s undelivered messages", self._queue.qsize())
         if self._client:
             try:
                 self._client.loop_stop()
@@ -192,15 +397,44 @@ class MQTTPublisher:
 # ---------------------------------------------------------------------------
 # Module-level singleton — lazily created so that import never crashes.
 # ---------------------------------------------------------------------------
-_publisher_instance: MQTTPublisher | None = None
+_publisher_instance: ChangeNotifier | None = None
 _publisher_lock = threading.Lock()
 
 
-def get_publisher() -> MQTTPublisher:
-    """Return (or create) the global MQTTPublisher singleton."""
+def get_publisher() -> ChangeNotifier:
+    """Return (or create) this process's publisher: MQTTPublisher, or SidecarPublisher in sidecar mode."""
     global _publisher_instance
     if _publisher_instance is None:
         with _publisher_lock:
             if _publisher_instance is None:
-                _publisher_instance = MQTTPublisher()
+                if MQTT_CONNECTION_MODE == "sidecar":
+                    from mqtt_sidecar import SidecarPublisher
+                    _publisher_instance = SidecarPublisher()
+                else:
+                    from lifecycle import client_id
+                    _publisher_instance = MQTTPublisher(client_id=client_id())
+                atexit.register(_publisher_instance.disconnect)
     return _publisher_instance
+
+
+def shutdown_publisher():
+    """Flush and close this process's publisher (gunicorn worker_exit)."""
+    global _publisher_instance
+    with _publisher_lock:
+        publisher, _publisher_instance = _publisher_instance, None
+    if publisher is not None:
+        atexit.unregister(publisher.disconnect)
+        publisher.disconnect()
+
+
+def _reset_after_fork():
+    """Child side of fork(): drop the parent's publisher without touching its (shared) socket."""
+    global _publisher_instance, _publisher_lock
+    if _publisher_instance is not None:
+        logger.warning("MQTT publisher was created before fork; discarding the inherited instance")
+        atexit.unregister(_publisher_instance.disconnect)
+    _publisher_instance = None
+    _publisher_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
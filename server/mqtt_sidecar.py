@@ -0,0 +1,213 @@
+"""
+Shared MQTT connection for the API workers (MQTT_CONNECTION_MODE=sidecar).
+
+In worker mode every gunicorn worker holds its own broker connection, so the
+connection count grows with --workers. In sidecar mode the gunicorn master
+starts this process next to the workers (gunicorn.conf.py); it owns the only
+connection of the container (publisher + presence subscription) and serves the
+workers over a Unix socket (MQTT_SIDECAR_SOCKET), one JSON request per line:
+
+    {"op": "publish", "topic": "...", "payload": {...}, "qos": 1, "retain": false}   (no reply)
+    {"op": "presence"}   -> {"devices": {device_id: {"online", "since", "last_seen", "encoding"}}}
+    {"op": "metrics"}    -> MQTTPublisher.metrics()
+
+    python mqtt_sidecar.py
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+
+from lifecycle import client_id
+from mqtt_publisher import ChangeNotifier, MQTTPublisher
+from presence import PresenceTracker
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_SOCKET   = os.environ.get("MQTT_SIDECAR_SOCKET", "/tmp/vending_mqtt.sock")
+_REQUEST_TIMEOUT = 2.0   # seconds, phía worker
+
+
+# ---------------------------------------------------------------------------
+# Sidecar process
+# ---------------------------------------------------------------------------
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.server.sidecar.handle(json.loads(line))
+            except (ValueError, KeyError, TypeError) as exc:
+                logger.warning("Rejected sidecar request: %s", exc)
+                reply = {"error": str(exc)}
+            if reply is not None:
+                self.wfile.write((json.dumps(reply, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+class MQTTSidecar:
+    """One broker connection shared by every worker of the container."""
+
+    def __init__(self, path=SIDECAR_SOCKET):
+        self._path = path
+        self.publisher = MQTTPublisher(client_id=client_id("sidecar"))
+        self.tracker = PresenceTracker(self.publisher)
+        self._server = None
+        self._stopped = threading.Event()
+
+    def handle(self, request):
+        op = request["op"]
+        if op == "publish":
+            self.publisher._publish(request["topic"], request["payload"],
+                                    qos=request.get("qos", 1), retain=request.get("retain", False))
+            return None
+        if op == "presence":
+            return {"devices": self.tracker.table.snapshot()}
+        if op == "metrics":
+            return self.publisher.metrics()
+        raise ValueError(f"unknown op {op!r}")
+
+    def start(self):
+        try:
+            self.tracker.seed()
+        except Exception as exc:
+            logger.warning("Could not seed presence table: %s", exc)
+        self.tracker.start()
+
+        if os.path.exists(self._path):
+            os.unlink(self._path)   # socket cũ của lần chạy trước
+        self._server = socketserver.ThreadingUnixStreamServer(self._path, _RequestHandler)
+        self._server.daemon_threads = True
+        self._server.sidecar = self
+        threading.Thread(target=self._server.serve_forever, name="mqtt-sidecar", daemon=True).start()
+        logger.info("MQTT sidecar listening on %s", self._path)
+
+    def wait(self):
+        self._stopped.wait()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+        self.tracker.stop()
+        self.publisher.disconnect()
+        self._stopped.set()
+
+
+# ---------------------------------------------------------------------------
+# Worker side
+# ---------------------------------------------------------------------------
+class SidecarClient:
+    """Line-oriented connection to the sidecar; reconnects once per request on failure."""
+
+    def __init__(self, path=SIDECAR_SOCKET, timeout=_REQUEST_TIMEOUT):
+        self._path = path
+        self._timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout)
+        sock.connect(self._path)
+        self._sock, self._reader = sock, sock.makefile("rb")
+
+    def request(self, message, reply=True):
+        data = (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._open()
+                    self._sock.sendall(data)
+                    if not reply:
+                        return None
+                    line = self._reader.readline()
+                    if not line:
+                        raise ConnectionError("sidecar closed the connection")
+                    return json.loads(line)
+                except OSError:
+                    self._close()
+                    if attempt:
+                        raise
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._reader.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = self._reader = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+class SidecarPublisher(ChangeNotifier):
+    """Worker-side publisher: hands every message to the sidecar, which queues and sends it."""
+
+    def __init__(self, path=SIDECAR_SOCKET):
+        self._client = SidecarClient(path)
+
+    def _publish(self, topic: str, payload: dict, qos: int = 1, retain: bool = False) -> bool:
+        try:
+            self._client.request({"op": "publish", "topic": topic, "payload": payload,
+                                  "qos": qos, "retain": retain}, reply=False)
+            return True
+        except OSError as exc:
+            logger.warning("MQTT sidecar unavailable, dropped message for %s: %s", topic, exc)
+            return False
+
+    def metrics(self) -> dict:
+        try:
+            return dict(self._client.request({"op": "metrics"}), mode="sidecar")
+        except OSError as exc:
+            return {"mode": "sidecar", "error": str(exc)}
+
+    def disconnect(self, flush_timeout: float = 0):
+        self._client.close()
+
+
+class SidecarPresenceTable:
+    """Read-only PresenceTable look-alike answered by the sidecar."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def snapshot(self):
+        return self._client.request({"op": "presence"})["devices"]
+
+    def get(self, device_id):
+        return self.snapshot().get(device_id)
+
+
+class SidecarPresenceTracker:
+    def __init__(self, path=SIDECAR_SOCKET):
+        self._client = SidecarClient(path)
+        self.table = SidecarPresenceTable(self._client)
+
+    def stop(self, timeout=0):
+        self._client.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    sidecar = MQTTSidecar()
+    # stop() chờ serve_forever kết thúc nên phải chạy ở thread khác
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=sidecar.stop).start())
+    signal.signal(signal.SIGINT, lambda *_: threading.Thread(target=sidecar.stop).start())
+
+    sidecar.start()
+    sidecar.wait()
+    logger.info("MQTT sidecar stopped: %s", sidecar.publisher.metrics())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""
+Transactional outbox for MQTT change notifications.
+
+Route handlers write notifications with Outbox(cursor).publish_*() in the same
+transaction as the change they describe, so a notification exists if and only
+if the change was committed. The relay (this module's main) publishes pending
+rows in id order, waits for the broker acknowledgements and only then marks
+them delivered: delivery is at-least-once and survives worker crashes and
+broker outages.
+
+The relay wakes up on NOTIFY outbox (sent by the writer at commit) with a
+polling fallback, publishes in batches while catching up, and holds a
+Postgres advisory lock so that only one relay is active at a time (a second
+instance waits as a hot standby).
+
+Bursts are coalesced: after a NOTIFY the relay waits MQTT_COALESCE_WINDOW
+seconds so the whole burst lands in one batch, then keeps only the latest hot
+update per (device, product) and sends one batch_update message per device
+(see coalesce_messages). The rows merged away are still marked delivered.
+
+Rows are stored as JSON; machines that negotiated the compact encoding
+(device_presence.encoding, see codec.py) get their catalog messages re-encoded
+on the versioned compact topic at publish time.
+
+    python outbox.py
+"""
+
+import json
+import logging
+import math
+import os
+import select
+import signal
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import psycopg2.extensions
+
+from catalog import devices_with_item, load_snapshots
+from codec import ENCODING_JSON, device_topic, encode
+from database import getDatabaseConnection
+from mqtt_publisher import (ChangeNotifier, CATALOG_REFETCH_RATE, CATALOG_REFETCH_WINDOW_MS,
+                            TOPIC_DEVICE_SNAPSHOT, TOPIC_DEVICE_UPDATE, TOPIC_PRODUCT_UPDATE)
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_CHANNEL        = "outbox"
+RELAY_BATCH_SIZE      = int(os.environ.get("OUTBOX_BATCH_SIZE", 500))
+RELAY_POLL_INTERVAL   = float(os.environ.get("OUTBOX_POLL_INTERVAL", 5))        # seconds, fallback khi không có NOTIFY
+RELAY_ACK_TIMEOUT     = float(os.environ.get("OUTBOX_ACK_TIMEOUT", 10))         # seconds chờ PUBACK cho 1 lô
+RETENTION_HOURS       = int(os.environ.get("OUTBOX_RETENTION_HOURS", 24))
+COALESCE_WINDOW       = float(os.environ.get("MQTT_COALESCE_WINDOW", 0.5))     # seconds, 0 = không gộp
+_PURGE_EVERY          = 600     # seconds
+_BACKOFF_MAX          = 30.0    # seconds
+_RELAY_LOCK_ID        = 0x0B0C  # pg advisory lock: chỉ 1 relay hoạt động
+
+
+class Outbox(ChangeNotifier):
+    """ChangeNotifier that writes to the outbox table through the caller's cursor (no commit)."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._notified = False
+        self._refetch_window = None
+
+    def _publish(self, topic: str, payload: dict, qos: int = 1, retain: bool = False) -> bool:
+        self._cursor.execute("""
+            INSERT INTO outbox (topic, payload, qos, retain, created_at)
+            VALUES (%s, %s, %s, %s, %s)
+        """, (topic, json.dumps(payload, ensure_ascii=False), qos, retain,
+              datetime.now(timezone.utc).isoformat()))
+        if not self._notified:
+            # NOTIFY chỉ được gửi khi transaction commit
+            self._cursor.execute(f"NOTIFY {OUTBOX_CHANNEL}")
+            self._notified = True
+        return True
+
+    def _refetch_window_ms(self) -> int:
+        """Wide enough for the whole fleet to refetch at about CATALOG_REFETCH_RATE requests/s."""
+        if self._refetch_window is None:
+            self._cursor.execute("SELECT COUNT(*) FROM devices")
+            fleet_size = self._cursor.fetchone()[0]
+            self._refetch_window = max(CATALOG_REFETCH_WINDOW_MS, math.ceil(fleet_size * 1000 / CATALOG_REFETCH_RATE))
+        return self._refetch_window
+
+    def publish_catalog_snapshots(self, device_ids=(), item_name=None):
+        """
+        Rebuild and queue the retained catalog snapshot of every affected device:
+        the given device_ids and/or every device currently holding item_name.
+        Call after the change, before commit, so the snapshot reflects it.
+        """
+        device_ids = list(device_ids)
+        if item_name is not None:
+            device_ids += devices_with_item(self._cursor, item_name)
+        for device_id, snapshot in load_snapshots(self._cursor, device_ids).items():
+            self.publish_catalog_snapshot(device_id, snapshot)
+
+
+def _hot_update_key(payload):
+    """(device_id, product) of a price / stock hot update, None for any other message."""
+    if not isinstance(payload, dict) or "event" in payload or "device_id" not in payload:
+        return None
+    product = payload.get("new_name") or payload.get("product_id")
+    return (payload["device_id"], product) if product else None
+
+
+def _merge_change(changes, key, payload):
+    """Keep only the latest state of key; a rename keeps the name the machine still knows."""
+    old_name = payload.get("old_name")
+    previous = changes.pop(key, None)
+    if previous is None and old_name and old_name != key[1]:
+        previous = changes.pop((key[0], old_name), None)
+    if previous is not None and "old_name" in previous:
+        payload = dict(payload, old_name=previous["old_name"])
+    changes[key] = payload
+
+
+def coalesce_messages(rows):
+    """
+    Merge one batch of outbox rows (id, topic, payload, qos, retain) before publishing:
+
+    - hot updates on vending_machine/<device_id>/catalog/update: latest state
+      per (device, product); several products become one
+      {"event": "batch_update", "device_id": "...", "changes": [...]} message;
+    - hot updates on the legacy shared topic: latest state per (device, product),
+      same format as before (old clients do not know batch_update);
+    - retained snapshots: only the last one per device.
+
+    Everything else passes through untouched. A merged message takes the
+    position of its newest row so ordering with other messages is preserved.
+    Returns [(topic, payload, qos, retain, row_ids)].
+    """
+    device_update_prefix, device_update_suffix = TOPIC_DEVICE_UPDATE.split("{device_id}")
+    snapshot_suffix = TOPIC_DEVICE_SNAPSHOT.split("{device_id}")[1]
+    groups = {}
+    for position, (row_id, topic, payload, qos, retain) in enumerate(rows):
+        key = None
+        if retain and topic.endswith(snapshot_suffix):
+            group_key = ("snapshot", topic)
+        else:
+            try:
+                key = _hot_update_key(json.loads(payload))
+            except ValueError:
+                pass
+            if key and topic == TOPIC_PRODUCT_UPDATE:
+                group_key = ("legacy", topic, key)
+            elif key and topic.startswith(device_update_prefix) and topic.endswith(device_update_suffix):
+                group_key = ("device", topic)
+            else:
+                group_key = ("row", row_id)
+
+        group = groups.setdefault(group_key, {"ids": [], "changes": {}})
+        group.update(position=position, topic=topic, payload=payload, qos=max(qos, group.get("qos", 0)),
+                     retain=retain)
+        group["ids"].append(row_id)
+        if key:
+            _merge_change(group["changes"], key, json.loads(payload))
+
+    messages = []
+    for group_key, group in sorted(groups.items(), key=lambda item: item[1]["position"]):
+        payload = group["payload"]
+        if len(group["ids"]) > 1 and group_key[0] in ("device", "legacy"):
+            changes = list(group["changes"].values())
+            if len(changes) == 1:
+                payload = json.dumps(changes[0], ensure_ascii=False)
+            else:
+                payload = json.dumps({"event": "batch_update", "device_id": changes[0]["device_id"],
+                                      "changes": changes}, ensure_ascii=False)
+        messages.append((group["topic"], payload, group["qos"], group["retain"], group["ids"]))
+    return messages
+
+
+class OutboxRelay:
+    """Publishes committed outbox rows in order and marks them delivered once acknowledged."""
+
+    def __init__(self, transport, connect=getDatabaseConnection,
+                 batch_size=RELAY_BATCH_SIZE, poll_interval=RELAY_POLL_INTERVAL,
+                 coalesce_window=COALESCE_WINDOW):
+        self._transport = transport
+        self._connect = connect
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._coalesce_window = coalesce_window
+        self._stop = threading.Event()
+        self._last_purge = 0.0
+        # delivered = số dòng outbox; published = số message thực gửi; saved = delivered - published
+        self.stats = {"delivered": 0, "published": 0, "saved": 0, "compact": 0, "batches": 0, "failed_batches": 0}
+
+    def relay_once(self, conn):
+        """Publish one batch of pending rows. Returns (fetched, delivered)."""
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, topic, payload, qos, retain
+            FROM outbox
+            WHERE delivered_at IS NULL
+            ORDER BY id
+            LIMIT %s
+        """, (self._batch_size,))
+        rows = cursor.fetchall()
+        if not rows:
+            conn.commit()
+            return 0, 0
+
+        if self._coalesce_window > 0:
+            messages = coalesce_messages(rows)
+        else:
+            messages = [(topic, payload, qos, retain, [row_id]) for row_id, topic, payload, qos, retain in rows]
+        messages = self._encode_for_devices(cursor, messages)
+
+        published = self._transport.publish_batch(
+            [message[:4] for message in messages], timeout=RELAY_ACK_TIMEOUT)
+        # Một dòng chỉ được đánh dấu khi message chứa nó đã được broker xác nhận
+        delivered_ids = [row_id for message in messages[:published] for row_id in message[4]]
+        delivered = len(delivered_ids)
+        if delivered:
+            cursor.execute("UPDATE outbox SET delivered_at = %s WHERE id = ANY(%s)",
+                           (datetime.now(timezone.utc).isoformat(), delivered_ids))
+        conn.commit()
+
+        self.stats["delivered"] += delivered
+        self.stats["published"] += published
+        self.stats["saved"] += delivered - published
+        self.stats["batches"] += 1
+        if delivered < len(rows):
+            self.stats["failed_batches"] += 1
+        return len(rows), delivered
+
+    def _encode_for_devices(self, cursor, messages):
+        """Re-encode per-device catalog messages for machines that negotiated a compact encoding."""
+        device_ids = {device_topic(message[0], ENCODING_JSON)[0] for message in messages} - {None}
+        if not device_ids:
+            return messages
+        cursor.execute("SELECT device_id, encoding FROM device_presence WHERE device_id = ANY(%s) AND encoding <> %s",
+                       (list(device_ids), ENCODING_JSON))
+        encodings = dict(cursor.fetchall())
+        if not encodings:
+            return messages
+
+        encoded = []
+        for topic, payload, qos, retain, row_ids in messages:
+            device_id, _ = device_topic(topic, ENCODING_JSON)
+            encoding = encodings.get(device_id)
+            if encoding:
+                _, topic = device_topic(topic, encoding)
+                payload = encode(json.loads(payload), encoding)
+                self.stats["compact"] += 1
+            encoded.append((topic, payload, qos, retain, row_ids))
+        return encoded
+
+    def purge(self, conn):
+        """Xoá các dòng đã gửi cũ hơn OUTBOX_RETENTION_HOURS."""
+        cutoff = (datetime.now(timezone.utc) - timedelta(hours=RETENTION_HOURS)).isoformat()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM outbox WHERE delivered_at IS NOT NULL AND delivered_at < %s", (cutoff,))
+        conn.commit()
+        if cursor.rowcount:
+            logger.info("Purged %s delivered outbox rows", cursor.rowcount)
+
+    def _wait_for_notify(self, listen_conn, timeout):
+        if select.select([listen_conn], [], [], timeout)[0]:
+            listen_conn.poll()
+            listen_conn.notifies.clear()
+            if self._coalesce_window > 0:
+                # Gom cả đợt thay đổi (VD: sửa giá hàng loạt) vào cùng một lô
+                self._stop.wait(self._coalesce_window)
+
+    def _serve(self, listen_conn, work_conn):
+        """Main loop while holding the relay lock."""
+        backoff = 0.5
+        while not self._stop.is_set():
+            fetched, delivered = self.relay_once(work_conn)
+            if fetched and delivered < fetched:
+                # Broker chưa xác nhận -> thử lại lô đó sau, giữ nguyên thứ tự
+                logger.warning("Outbox relay: %s/%s messages confirmed, retrying in %.1fs",
+                               delivered, fetched, backoff)
+                if self._stop.wait(backoff):
+                    return
+                backoff = min(backoff * 2, _BACKOFF_MAX)
+                continue
+            backoff = 0.5
+            if fetched == self._batch_size:
+                continue  # đang bắt kịp tồn đọng
+            if time.monotonic() - self._last_purge > _PURGE_EVERY:
+                self.purge(work_conn)
+                self._last_purge = time.monotonic()
+                logger.info("Outbox relay stats: %s", self.stats)
+            self._wait_for_notify(listen_conn, self._poll_interval)
+
+    def run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            listen_conn = work_conn = None
+            try:
+                listen_conn = self._connect()
+                listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = listen_conn.cursor()
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (_RELAY_LOCK_ID,))
+                if not cursor.fetchone()[0]:
+                    logger.info("Another outbox relay is active, standing by")
+                    listen_conn.close()
+                    self._stop.wait(self._poll_interval)
+                    continue
+                cursor.execute(f"LISTEN {OUTBOX_CHANNEL}")
+                work_conn = self._connect()
+                logger.info("Outbox relay active (batch=%s)", self._batch_size)
+                backoff = 1.0
+                self._serve(listen_conn, work_conn)
+            except psycopg2.Error as exc:
+                logger.error("Outbox relay database error: %s", exc)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, _BACKOFF_MAX)
+            finally:
+                for conn in (work_conn, listen_conn):
+                    if conn is not None and not conn.closed:
+                        conn.close()
+
+    def stop(self):
+        self._stop.set()
+
+
+def main():
+    from mqtt_ingest import PahoTransport
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    transport = PahoTransport(client_id=os.environ.get("MQTT_OUTBOX_CLIENT_ID", "vending_server_outbox"))
+    relay = OutboxRelay(transport)
+    signal.signal(signal.SIGTERM, lambda *_: relay.stop())
+    signal.signal(signal.SIGINT, lambda *_: relay.stop())
+
+    transport.start()
+    relay.run()
+    logger.info("Outbox relay stopped: %s", relay.stats)
+    transport.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Device presence tracking (online / offline) over MQTT.
+
+Protocol for machines:
+
+- On connect, register a last-will on vending_machine/<device_id>/status with
+  payload {"online": false}, QoS 1, retain=True.
+- Right after connecting publish {"online": true} (retain=True) on the same
+  topic, and repeat it every PRESENCE_HEARTBEAT seconds as a heartbeat.
+- Optionally add "encoding": "mp1" to receive catalog messages in the compact
+  MessagePack encoding (codec.py) instead of JSON; the choice is remembered
+  until the machine announces another one.
+
+The broker publishes the will when a machine drops off (keepalive timeout,
+power loss), so the server learns about it without polling. Because status
+messages are retained, a freshly started subscriber receives the current
+state of the whole fleet immediately.
+
+Every API worker keeps an in-memory PresenceTable fed by a subscriber on its
+own publisher connection, so /api/devices can report online / since /
+last_seen without any query. In sidecar mode (MQTT_CONNECTION_MODE) the table
+lives in mqtt_sidecar.py and workers read it over the local socket.
+The ingestor process (mqtt_ingest.py) runs the persisting tracker that writes
+changes to device_presence in batches; workers seed their table from it once
+on start-up.
+"""
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+from codec import ENCODINGS, ENCODING_JSON
+from database import getDatabaseConnection
+
+logger = logging.getLogger(__name__)
+
+TOPIC_STATUS = "vending_machine/+/status"
+
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get("PRESENCE_FLUSH_INTERVAL", 5))   # seconds
+PRESENCE_HEARTBEAT      = int(os.environ.get("PRESENCE_HEARTBEAT", 60))         # seconds, documented for machines
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class PresenceTable:
+    """Thread-safe device_id -> {"online", "since", "last_seen", "encoding"} map with a dirty set."""
+
+    def __init__(self):
+        self._rows = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def update(self, device_id, online, seen_at=None, encoding=None):
+        """Record a status message (encoding None = unchanged). Returns True if the online state changed."""
+        seen_at = seen_at or _now_iso()
+        with self._lock:
+            row = self._rows.get(device_id)
+            changed = row is None or row["online"] != online
+            if changed:
+                previous = row["encoding"] if row else ENCODING_JSON
+                row = {"online": online, "since": seen_at, "last_seen": seen_at, "encoding": previous}
+                self._rows[device_id] = row
+            elif online:
+                row["last_seen"] = seen_at
+            if encoding:
+                row["encoding"] = encoding
+            self._dirty.add(device_id)
+            return changed
+
+    def load(self, rows):
+        """Seed from persisted rows (device_id, online, since, last_seen, encoding); live data wins."""
+        with self._lock:
+            for device_id, online, since, last_seen, encoding in rows:
+                self._rows.setdefault(device_id, {"online": online, "since": since, "last_seen": last_seen,
+                                                  "encoding": encoding})
+
+    def get(self, device_id):
+        with self._lock:
+            row = self._rows.get(device_id)
+            return dict(row) if row else None
+
+    def snapshot(self):
+        with self._lock:
+            return {device_id: dict(row) for device_id, row in self._rows.items()}
+
+    def take_dirty(self):
+        """Rows changed since the last call, as (device_id, online, since, last_seen, encoding) tuples."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            return [(d, self._rows[d]["online"], self._rows[d]["since"], self._rows[d]["last_seen"],
+                     self._rows[d]["encoding"])
+                    for d in dirty if d in self._rows]
+
+    def mark_dirty(self, device_ids):
+        with self._lock:
+            self._dirty.update(device_ids)
+
+
+def load_presence(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT device_id, online, since, last_seen, encoding FROM device_presence")
+    return cursor.fetchall()
+
+
+def persist_presence(conn, rows):
+    """Upsert a batch of presence rows in one statement; never moves last_seen backwards."""
+    if not rows:
+        return
+    cursor = conn.cursor()
+    execute_values(cursor, """
+        INSERT INTO device_presence (device_id, online, since, last_seen, encoding)
+        VALUES %s
+        ON CONFLICT(device_id) DO UPDATE SET
+            online = EXCLUDED.online,
+            since = EXCLUDED.since,
+            last_seen = EXCLUDED.last_seen,
+            encoding = EXCLUDED.encoding
+        WHERE device_presence.last_seen <= EXCLUDED.last_seen
+    """, rows)
+    conn.commit()
+
+
+class PresenceTracker:
+    """
+    Subscribes to vending_machine/+/status and keeps a PresenceTable current.
+
+    persist=True additionally flushes changed rows to device_presence every
+    flush_interval seconds (only the ingestor process should do this).
+    """
+
+    def __init__(self, transport, connect=getDatabaseConnection, persist=False,
+                 flush_interval=PRESENCE_FLUSH_INTERVAL):
+        self.table = PresenceTable()
+        self._transport = transport
+        self._connect = connect
+        self._persist = persist
+        self._flush_interval = flush_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def handle_message(self, topic, payload):
+        parts = topic.split("/")
+        if len(parts) != 3 or not payload:
+            return
+        device_id = parts[1]
+        try:
+            status = json.loads(payload)
+            online = bool(status["online"])
+            encoding = status.get("encoding")
+            if encoding is not None and encoding not in ENCODINGS:
+                raise ValueError(f"unknown encoding {encoding!r}")
+        except (ValueError, KeyError, TypeError, AttributeError) as exc:
+            logger.warning("Rejected status message from %s: %s", device_id, exc)
+            return
+        if self.table.update(device_id, online, encoding=encoding):
+            logger.info("Device %s is now %s", device_id, "online" if online else "offline")
+
+    def seed(self):
+        """Load the last persisted state once so devices without a retained status still show up."""
+        conn = self._connect()
+        try:
+            self.table.load(load_presence(conn))
+        finally:
+            conn.close()
+        self.table.take_dirty()
+
+    def flush(self):
+        rows = self.table.take_dirty()
+        if not rows:
+            return
+        conn = self._connect()
+        try:
+            persist_presence(conn, rows)
+        except Exception as exc:
+            conn.rollback()
+            self.table.mark_dirty([row[0] for row in rows])
+            logger.error("Presence flush of %s rows failed: %s", len(rows), exc)
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.wait(self._flush_interval):
+            self.flush()
+        self.flush()
+
+    def start(self):
+        """Subscribe (the caller starts the transport) and start the flush thread if persisting."""
+        self._transport.subscribe(TOPIC_STATUS, self.handle_message)
+        if self._persist:
+            self._thread = threading.Thread(target=self._run, name="presence-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+# ---------------------------------------------------------------------------
+# Per-worker singleton for the API (read-only: never persists)
+# ---------------------------------------------------------------------------
+_tracker: PresenceTracker | None = None
+_tracker_lock = threading.Lock()
+
+
+def get_presence():
+    """
+    Return this worker's presence table (PresenceTable, or the sidecar's table
+    in sidecar mode), subscribing on the worker's publisher connection on first use.
+    """
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                from mqtt_publisher import MQTT_CONNECTION_MODE, get_publisher
+
+                if MQTT_CONNECTION_MODE == "sidecar":
+                    from mqtt_sidecar import SidecarPresenceTracker
+                    _tracker = SidecarPresenceTracker()
+                else:
+                    tracker = PresenceTracker(get_publisher())
+                    try:
+                        tracker.seed()
+                    except Exception as exc:
+                        logger.warning("Could not seed presence table: %s", exc)
+                    tracker.start()
+                    _tracker = tracker
+    return _tracker.table
+
+
+def shutdown_presence():
+    global _tracker
+    with _tracker_lock:
+        tracker, _tracker = _tracker, None
+    if tracker is not None:
+        tracker.stop()
+
+
+def _reset_after_fork():
+    global _tracker, _tracker_lock
+    _tracker = None
+    _tracker_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,165 @@
+"""
+"Frequently bought together" batch model.
+
+Builds an item-to-item co-purchase matrix from transaction baskets and stores
+the top-K neighbours of every product in the ``product_related`` table, so
+that ``GET /api/products/<name>/related`` is a single indexed lookup.
+
+Run periodically (cron / docker exec):
+
+    python recommendations.py --top-k 10 --metric lift
+"""
+
+import argparse
+import logging
+from datetime import datetime, timezone
+
+import numpy as np
+import scipy.sparse as sp
+from psycopg2.extras import execute_values
+
+from database import getDatabaseConnection
+
+logger = logging.getLogger(__name__)
+
+METRICS = ("lift", "cosine")
+DEFAULT_TOP_K = 10
+DEFAULT_MIN_SUPPORT = 2
+
+
+def build_incidence(basket_ids, item_names):
+    """
+    Build the binary basket × item incidence matrix from (basket, item) pairs.
+
+    Returns (X, item_labels) where X is a CSR matrix of shape
+    (n_baskets, n_items) and item_labels maps column index -> item name.
+    """
+    basket_ids = np.asarray(basket_ids)
+    item_names = np.asarray(item_names)
+    _, rows = np.unique(basket_ids, return_inverse=True)
+    item_labels, cols = np.unique(item_names, return_inverse=True)
+
+    data = np.ones(rows.shape[0], dtype=np.float64)
+    X = sp.csr_matrix((data, (rows, cols)),
+                      shape=(int(rows.max()) + 1 if rows.size else 0, item_labels.shape[0]))
+    # Một món mua 2 lần trong cùng giỏ vẫn chỉ tính 1 lần
+    X.sum_duplicates()
+    X.data[:] = 1.0
+    return X, item_labels
+
+
+def cooccurrence_scores(X, metric="lift", min_support=DEFAULT_MIN_SUPPORT):
+    """
+    Compute the normalized item × item co-occurrence matrix.
+
+    - lift   : P(a, b) / (P(a) * P(b))
+    - cosine : C(a, b) / sqrt(C(a) * C(b))
+
+    Pairs seen together in fewer than *min_support* baskets are dropped.
+    Returns parallel arrays (rows, cols, scores, support), diagonal removed.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric '{metric}'. Allowed: {', '.join(METRICS)}")
+
+    n_baskets = X.shape[0]
+    C = (X.T @ X).tocoo()
+    item_freq = np.asarray(X.sum(axis=0)).ravel()
+
+    keep = (C.row != C.col) & (C.data >= min_support)
+    rows, cols, support = C.row[keep], C.col[keep], C.data[keep]
+
+    if metric == "lift":
+        scores = support * n_baskets / (item_freq[rows] * item_freq[cols])
+    else:
+        scores = support / np.sqrt(item_freq[rows] * item_freq[cols])
+
+    return rows, cols, scores, support
+
+
+def top_k_neighbours(rows, cols, vals, sup, k=DEFAULT_TOP_K):
+    """
+    Select the *k* best-scoring neighbours of every row.
+
+    Fully vectorized: sort all non-zeros by (row, -score, -support) once,
+    then rank within each row from the position of the row's first entry.
+    Returns parallel arrays (rows, cols, ranks, scores, support).
+    """
+    order = np.lexsort((-sup, -vals, rows))
+    rows, cols, vals, sup = rows[order], cols[order], vals[order], sup[order]
+
+    # Vị trí phần tử đầu tiên của mỗi hàng sau khi sắp xếp
+    first = np.searchsorted(rows, rows, side="left")
+    ranks = np.arange(rows.shape[0]) - first
+
+    keep = ranks < k
+    return rows[keep], cols[keep], ranks[keep] + 1, vals[keep], sup[keep]
+
+
+def compute_related(basket_ids, item_names, top_k=DEFAULT_TOP_K,
+                    metric="lift", min_support=DEFAULT_MIN_SUPPORT):
+    """
+    End-to-end model: (basket, item) pairs -> list of
+    (item_name, related_name, rank, score, support) tuples.
+    """
+    if len(basket_ids) == 0:
+        return []
+    X, labels = build_incidence(basket_ids, item_names)
+    pairs = cooccurrence_scores(X, metric=metric, min_support=min_support)
+    rows, cols, ranks, vals, sup = top_k_neighbours(*pairs, k=top_k)
+    return list(zip(labels[rows].tolist(), labels[cols].tolist(), ranks.tolist(),
+                    vals.astype(float).tolist(), sup.astype(int).tolist()))
+
+
+def _fetch_basket_pairs(cursor):
+    """Tách JSON items của giao dịch thành cặp (transaction_id, item_name) ngay trong Postgres."""
+    cursor.execute("""
+        SELECT t.transaction_id,
+               COALESCE(elem->>'product_name', elem->>'name', elem->>'item_name') AS item_name
+        FROM transactions t, json_array_elements(t.items::json) AS elem
+        WHERE t.payment_status = 'completed'
+    """)
+    pairs = [(tid, name) for tid, name in cursor.fetchall() if name]
+    if not pairs:
+        return [], []
+    basket_ids, item_names = zip(*pairs)
+    return basket_ids, item_names
+
+
+def rebuild_related_products(top_k=DEFAULT_TOP_K, metric="lift", min_support=DEFAULT_MIN_SUPPORT):
+    """
+    Recompute the model from all completed transactions and replace the
+    contents of ``product_related`` atomically. Returns the number of rows stored.
+    """
+    conn = getDatabaseConnection()
+    try:
+        cursor = conn.cursor()
+        basket_ids, item_names = _fetch_basket_pairs(cursor)
+        related = compute_related(basket_ids, item_names, top_k=top_k,
+                                  metric=metric, min_support=min_support)
+
+        now_iso = datetime.now(timezone.utc).isoformat()
+        cursor.execute("DELETE FROM product_related")
+        if related:
+            execute_values(cursor, """
+                INSERT INTO product_related (item_name, related_name, rank, score, support, computed_at)
+                VALUES %s
+            """, [row + (now_iso,) for row in related], page_size=5000)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    logger.info("Rebuilt product_related: %s rows (metric=%s, top_k=%s)", len(related), metric, top_k)
+    return len(related)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Rebuild the frequently-bought-together table.")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K)
+    parser.add_argument("--metric", choices=METRICS, default="lift")
+    parser.add_argument("--min-support", type=int, default=DEFAULT_MIN_SUPPORT)
+    args = parser.parse_args()
+    rebuild_related_products(top_k=args.top_k, metric=args.metric, min_support=args.min_support)
@@ -0,0 +1,155 @@
+from flask import Blueprint, request, jsonify
+import logging
+
+from database import getDatabaseConnection, dict_fetchall
+from utils import logSystemEvent
+from alerts import evaluate_stock, LOW_STOCK_THRESHOLD, LOW_STOCK_CLEAR_MARGIN
+
+logger = logging.getLogger(__name__)
+
+alerts_bp = Blueprint('alerts', __name__)
+
+
+@alerts_bp.route('/api/admin/alerts', methods=['GET'])
+def list_alerts():
+    """
+    Admin: Danh sách cảnh báo tồn kho thấp.
+    Query: status = open (mặc định) | resolved | all, device_id, item_name, limit (200).
+    units_left là tồn kho hiện tại; units_at_open là tồn kho lúc mở cảnh báo.
+    """
+    try:
+        status = request.args.get('status', 'open')
+        if status not in ('open', 'resolved', 'all'):
+            return jsonify({'success': False, 'message': 'status phải là open | resolved | all'}), 400
+        limit = min(int(request.args.get('limit', 200)), 1000)
+
+        conditions, params = [], []
+        if status == 'open':
+            conditions.append("a.resolved_at IS NULL")
+        elif status == 'resolved':
+            conditions.append("a.resolved_at IS NOT NULL")
+        if request.args.get('device_id'):
+            conditions.append("a.device_id = %s")
+            params.append(request.args['device_id'])
+        if request.args.get('item_name'):
+            conditions.append("a.item_name = %s")
+            params.append(request.args['item_name'])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        conn = getDatabaseConnection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT a.alert_id, a.device_id, a.item_name, di.units_left, a.units_left AS units_at_open,
+                       a.threshold, a.opened_at, a.resolved_at,
+                       CASE WHEN di.units_left IS NULL THEN NULL
+                            WHEN di.units_left <= 0 THEN 'out' ELSE 'low' END AS severity
+                FROM stock_alerts a
+                LEFT JOIN device_inventory di ON di.device_id = a.device_id AND di.item_name = a.item_name
+                {where}
+                ORDER BY a.resolved_at IS NULL DESC, di.units_left ASC NULLS LAST, a.opened_at DESC
+                LIMIT %s
+            """, params + [limit])
+            alerts = dict_fetchall(cursor)
+        finally:
+            conn.close()
+
+        return jsonify({'success': True, 'alerts': alerts})
+    except ValueError as ve:
+        return jsonify({'success': False, 'message': str(ve)}), 400
+    except Exception as e:
+        logger.error(f"List Alerts Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@alerts_bp.route('/api/admin/alerts/thresholds', methods=['GET'])
+def list_alert_thresholds():
+    """Admin: Các ngưỡng đã cấu hình ('' = mọi máy / mọi sản phẩm) và giá trị mặc định."""
+    try:
+        conn = getDatabaseConnection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT device_id, item_name, threshold FROM alert_thresholds ORDER BY device_id, item_name")
+            thresholds = dict_fetchall(cursor)
+        finally:
+            conn.close()
+
+        return jsonify({'success': True, 'thresholds': thresholds,
+                        'default_threshold': LOW_STOCK_THRESHOLD, 'clear_margin': LOW_STOCK_CLEAR_MARGIN})
+    except Exception as e:
+        logger.error(f"List Alert Thresholds Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@alerts_bp.route('/api/admin/alerts/thresholds', methods=['PUT'])
+def set_alert_threshold():
+    """
+    Admin: Đặt ngưỡng cảnh báo toàn hệ thống, theo sản phẩm, theo máy hoặc theo (máy, sản phẩm).
+    Body: {"device_id"?, "item_name"?, "threshold": 5}  -- threshold = null để xoá ngưỡng.
+    Các cảnh báo bị ảnh hưởng được đánh giá lại ngay.
+    """
+    try:
+        data = request.get_json() or {}
+        device_id = data.get('device_id') or ''
+        item_name = data.get('item_name') or ''
+        threshold = data.get('threshold')
+        try:
+            threshold = int(threshold) if threshold is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'threshold phải là số nguyên'}), 400
+        if threshold is not None and threshold < 0:
+            return jsonify({'success': False, 'message': 'threshold không được âm'}), 400
+
+        conn = getDatabaseConnection()
+        try:
+            cursor = conn.cursor()
+            if threshold is None:
+                cursor.execute("DELETE FROM alert_thresholds WHERE device_id = %s AND item_name = %s",
+                               (device_id, item_name))
+            else:
+                cursor.execute("""
+                    INSERT INTO alert_thresholds (device_id, item_name, threshold)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT(device_id, item_name) DO UPDATE SET threshold = EXCLUDED.threshold
+                """, (device_id, item_name, threshold))
+
+            if device_id and item_name:
+                alert_events = evaluate_stock(cursor, pairs=[(device_id, item_name)])
+            elif device_id:
+                alert_events = evaluate_stock(cursor, device_ids=[device_id])
+            else:
+                alert_events = evaluate_stock(cursor, everything=True)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        logSystemEvent('alert_threshold', f'Threshold {device_id or "*"}/{item_name or "*"} = {threshold}')
+
+        return jsonify({'success': True, 'events': alert_events})
+    except Exception as e:
+        logger.error(f"Set Alert Threshold Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@alerts_bp.route('/api/admin/alerts/evaluate', methods=['POST'])
+def evaluate_all_alerts():
+    """Admin: Đánh giá lại toàn bộ hệ thống (dùng lần đầu hoặc sau khi sửa tồn kho trực tiếp trong DB)."""
+    try:
+        conn = getDatabaseConnection()
+        try:
+            cursor = conn.cursor()
+            alert_events = evaluate_stock(cursor, everything=True)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        return jsonify({'success': True, 'events': alert_events})
+    except Exception as e:
+        logger.error(f"Evaluate Alerts Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
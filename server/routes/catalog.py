@@ -0,0 +1,41 @@
+from flask import Blueprint, request, jsonify
+import logging
+
+from alerts import LOW_STOCK_THRESHOLD
+from catalog_matrix import get_catalog, get_catalog_cache
+from invalidation import get_bus
+
+logger = logging.getLogger(__name__)
+
+catalog_bp = Blueprint('catalog', __name__)
+
+
+@catalog_bp.route('/api/admin/catalog/summary', methods=['GET'])
+def catalog_summary():
+    """
+    Admin: Tổng hợp toàn hệ thống từ catalog trong bộ nhớ (không query DB):
+    tổng tồn kho, giá trị hàng, tồn theo sản phẩm / theo máy, các ô dưới ngưỡng.
+    Query: threshold (mặc định LOW_STOCK_THRESHOLD).
+    """
+    try:
+        threshold = int(request.args.get('threshold', LOW_STOCK_THRESHOLD))
+        matrix = get_catalog()
+        return jsonify({'success': True, 'loaded_at': matrix.loaded_at, 'summary': matrix.fleet_summary(threshold)})
+    except ValueError as ve:
+        return jsonify({'success': False, 'message': str(ve)}), 400
+    except Exception as e:
+        logger.error(f"Catalog Summary Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@catalog_bp.route('/api/admin/catalog/verify', methods=['GET'])
+def catalog_verify():
+    """Admin: So sánh catalog trong bộ nhớ của worker này với Postgres."""
+    try:
+        cache = get_catalog_cache()
+        result = cache.verify()
+        return jsonify({'success': True, **result, 'stats': dict(cache.stats),
+                        'invalidation': dict(get_bus().stats)})
+    except Exception as e:
+        logger.error(f"Catalog Verify Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
@@ -1,9 +1,16 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify
 from datetime import datetime, timezone
+import hmac
 import logging
 
 from database import getDatabaseConnection, dict_fetchall, dict_fetchone
 from utils import logSystemEvent
+from auth_tokens import issue_token, revoke_token, DEVICE_PROVISION_KEY, DEVICE_SCOPES
+from presence import get_presence
+from alerts import evaluate_stock
+from outbox import Outbox
+from invalidation import notify
+from analytics import run_analytics, restock_plan
 
 logger = logging.getLogger(__name__)
 
@@ -12,7 +19,7 @@ device_bp = Blueprint('devices', __name__)
 
 @device_bp.route('/api/devices', methods=['GET'])
 def get_devices():
-    """Admin: Lấy danh sách thiết bị từ bảng devices."""
+    """Admin: Lấy danh sách thiết bị từ bảng devices, kèm online / since / last_seen."""
     try:
         conn = getDatabaseConnection()
         try:
@@ -32,12 +39,142 @@ def get_devices():
         finally:
             conn.close()
 
+        # Trạng thái online lấy từ bảng presence trong bộ nhớ của worker, không tốn thêm query
+        try:
+            presence = get_presence().snapshot()
+        except Exception as presence_err:
+            logger.warning(f"Presence unavailable: {presence_err}")
+            presence = {}
+        for device in devices:
+            status = presence.get(device['device_id'])
+            device['online'] = status['online'] if status else None
+            device['since'] = status['since'] if status else None
+            device['last_seen'] = status['last_seen'] if status else device['last_sync']
+
         return jsonify({'success': True, 'devices': devices})
     except Exception as e:
         logger.error(f"Get Devices Error: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+@device_bp.route('/api/devices/token', methods=['POST'])
+def issue_device_token():
+    """Máy đổi khoá cấp phát (DEVICE_PROVISION_KEY) lấy token ký HMAC dùng cho các request sau."""
+    try:
+        data = request.get_json() or {}
+        device_id = data.get('device_id')
+        provision_key = str(data.get('provision_key', ''))
+
+        if not device_id:
+            return jsonify({'success': False, 'message': 'Thiếu device_id'}), 400
+        if not DEVICE_PROVISION_KEY or not hmac.compare_digest(provision_key, DEVICE_PROVISION_KEY):
+            return jsonify({'success': False, 'message': 'Invalid provision key'}), 401
+
+        token, claims = issue_token(device_id, 'device', DEVICE_SCOPES)
+        logSystemEvent('device_token_issued', f'Issued token for {device_id}', metadata={'jti': claims['jti']})
+        return jsonify({'success': True, 'token': token, 'expires_at': claims['exp'], 'jti': claims['jti']})
+    except Exception as e:
+        logger.error(f"Issue Device Token Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@device_bp.route('/api/admin/tokens/revoke', methods=['POST'])
+def admin_revoke_token():
+    """Admin: Thu hồi một token (theo jti), ví dụ khi máy bị mất hoặc thay thế."""
+    try:
+        data = request.get_json() or {}
+        jti = data.get('jti')
+        if not jti:
+            return jsonify({'success': False, 'message': 'Thiếu jti'}), 400
+
+        revoke_token(jti, data.get('subject'), data.get('expires_at'))
+        logSystemEvent('token_revoked', f'Revoked token {jti}', metadata={'subject': data.get('subject')})
+        return jsonify({'success': True})
+    except Exception as e:
+        logger.error(f"Revoke Token Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@device_bp.route('/api/devices/inventory', methods=['GET'])
+def get_fleet_inventory():
+    """
+    Admin: Tồn kho của TOÀN BỘ máy trong một truy vấn (thay cho gọi /api/devices/<id>/inventory từng máy).
+    Query: device_id (lặp được), item_name (lặp được), units_left_below (int).
+    Trả kèm tổng hợp theo sản phẩm và theo máy (body JSON do Postgres dựng).
+    """
+    try:
+        device_ids = request.args.getlist('device_id')
+        item_names = request.args.getlist('item_name')
+        units_left_below = request.args.get('units_left_below', type=int)
+
+        conditions = []
+        params = []
+        if device_ids:
+            conditions.append("di.device_id = ANY(%s)")
+            params.append(device_ids)
+        if item_names:
+            conditions.append("di.item_name = ANY(%s)")
+            params.append(item_names)
+        if units_left_below is not None:
+            conditions.append("di.units_left < %s")
+            params.append(units_left_below)
+        where_clause = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+
+        # Postgres dựng sẵn cả body (dòng tồn kho + tổng hợp) trong một truy vấn, worker trả nguyên chuỗi
+        conn = getDatabaseConnection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                WITH inv AS (
+                    SELECT di.device_id,
+                           di.slot_number,
+                           di.item_name,
+                           di.units_left,
+                           di.last_updated,
+                           i.price,
+                           dp.custom_price,
+                           COALESCE(dp.custom_price, i.price) AS effective_price,
+                           i.description,
+                           i.image_url
+                    FROM device_inventory di
+                    JOIN inventory i ON di.item_name = i.item_name
+                    LEFT JOIN device_pricing dp ON dp.device_id = di.device_id AND dp.item_name = di.item_name
+                    {where_clause}
+                ),
+                by_product AS (
+                    SELECT item_name,
+                           SUM(COALESCE(units_left, 0)) AS total_units,
+                           COUNT(*) AS devices,
+                           SUM(COALESCE(units_left, 0) * COALESCE(effective_price, 0)) AS stock_value
+                    FROM inv GROUP BY item_name
+                ),
+                by_device AS (
+                    SELECT device_id,
+                           SUM(COALESCE(units_left, 0)) AS total_units,
+                           COUNT(*) AS products,
+                           SUM(COALESCE(units_left, 0) * COALESCE(effective_price, 0)) AS stock_value
+                    FROM inv GROUP BY device_id
+                )
+                SELECT json_build_object(
+                    'success', true,
+                    'inventory', COALESCE((SELECT json_agg(r ORDER BY r.device_id, r.slot_number NULLS LAST, r.item_name)
+                                           FROM inv r), '[]'::json),
+                    'totals_by_product', COALESCE((SELECT json_agg(p ORDER BY p.total_units DESC, p.item_name)
+                                                   FROM by_product p), '[]'::json),
+                    'totals_by_device', COALESCE((SELECT json_agg(d ORDER BY d.device_id)
+                                                  FROM by_device d), '[]'::json)
+                )::text
+            """, params)
+            body = cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+        return Response(body, mimetype='application/json')
+    except Exception as e:
+        logger.error(f"Get Fleet Inventory Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
 @device_bp.route('/api/devices/<string:device_id>/inventory', methods=['GET'])
 def get_device_inventory(device_id):
     """Admin: Lấy toàn bộ tồn kho của một máy."""
@@ -46,25 +183,26 @@ def get_device_inventory(device_id):
         try:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT di.item_name,
-                       di.units_left,
-                       di.last_updated,
-                       di.slot_number,
-                       i.price,
-                       i.description,
-                       i.image_url,
-                       dp.custom_price
+                SELECT json_build_object('success', true, 'device_id', %s, 'inventory', COALESCE(json_agg(json_build_object(
+                           'item_name',    di.item_name,
+                           'units_left',   di.units_left,
+                           'last_updated', di.last_updated,
+                           'slot_number',  di.slot_number,
+                           'price',        i.price,
+                           'description',  i.description,
+                           'image_url',    i.image_url,
+                           'custom_price', dp.custom_price
+                       ) ORDER BY di.item_name), '[]'::json))::text
                 FROM device_inventory di
                 JOIN inventory i ON di.item_name = i.item_name
                 LEFT JOIN device_pricing dp ON di.item_name = dp.item_name AND dp.device_id = %s
                 WHERE di.device_id = %s
-                ORDER BY di.item_name
-            """, (device_id, device_id))
-            rows = dict_fetchall(cursor)
+            """, (device_id, device_id, device_id))
+            body = cursor.fetchone()[0]
         finally:
             conn.close()
 
-        return jsonify({'success': True, 'device_id': device_id, 'inventory': rows})
+        return Response(body, mimetype='application/json')
     except Exception as e:
         logger.error(f"Get Device Inventory Error: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -118,33 +256,34 @@ def update_device_inventory(device_id, item_name):
                     INSERT INTO device_inventory (device_id, item_name, units_left, slot_number, last_updated)
                     VALUES (%s, %s, %s, %s, %s)
                 """, (device_id, item_name, units_left, slot_number, now_iso))
-                
-            conn.commit()
-            logSystemEvent('inventory_update', f'{device_id}: {item_name} set to {units_left}')
 
-            # ======== ĐỒNG BỘ CLIENT (MQTT) ĐÃ CẬP NHẬT LOGIC ========
-            try:
-                cursor.execute("""
-                    SELECT i.price, dp.custom_price 
-                    FROM inventory i
-                    LEFT JOIN device_pricing dp ON dp.item_name = i.item_name AND dp.device_id = %s
-                    WHERE i.item_name = %s
-                """, (device_id, item_name))
-                row_price = cursor.fetchone()
-                final_price = row_price[1] if row_price and row_price[1] is not None else (row_price[0] if row_price else 0)
-                
-                from mqtt_publisher import get_publisher
-                
-                # KIỂM TRA: Đổi ô hoặc thêm mới -> Vẽ lại toàn bộ 10 ô
-                if old_slot != slot_number:
-                    get_publisher().publish_product_modified(item_name)
-                # Giữ nguyên ô, chỉ đổi số lượng -> Bắn Hot Update cho nhẹ
-                else:
-                    get_publisher().publish_hot_update(device_id, item_name, item_name, final_price, int(units_left))
-            except Exception as mqtt_err:
-                logger.warning(f"MQTT publish failed in PUT inventory: {mqtt_err}")
+            # Có thể vừa gỡ sản phẩm khác khỏi ô -> đánh giá lại cả máy
+            evaluate_stock(cursor, device_ids=[device_id], now_iso=now_iso)
+
+            # ======== ĐỒNG BỘ CLIENT (MQTT qua outbox, cùng transaction) ========
+            cursor.execute("""
+                SELECT i.price, dp.custom_price 
+                FROM inventory i
+                LEFT JOIN device_pricing dp ON dp.item_name = i.item_name AND dp.device_id = %s
+                WHERE i.item_name = %s
+            """, (device_id, item_name))
+            row_price = cursor.fetchone()
+            final_price = row_price[1] if row_price and row_price[1] is not None else (row_price[0] if row_price else 0)
+
+            outbox = Outbox(cursor)
+            # KIỂM TRA: Đổi ô hoặc thêm mới -> Vẽ lại toàn bộ 10 ô
+            if old_slot != slot_number:
+                outbox.publish_product_modified(item_name)
+            # Giữ nguyên ô, chỉ đổi số lượng -> Bắn Hot Update cho nhẹ
+            else:
+                outbox.publish_hot_update(device_id, item_name, item_name, final_price, int(units_left))
+            outbox.publish_catalog_snapshots([device_id])
+            notify(cursor, 'device', [device_id])
             # =======================================
 
+            conn.commit()
+            logSystemEvent('inventory_update', f'{device_id}: {item_name} set to {units_left}')
+
         except Exception:
             conn.rollback()
             raise
@@ -155,6 +294,154 @@ def update_device_inventory(device_id, item_name):
     except Exception as e:
         logger.error(f"Update Device Inventory Error: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
+
+
+def _parse_planogram(raw):
+    """
+    Chuẩn hoá planogram về list (slot_number, item_name, units_left).
+    Nhận list [{"slot_number", "item_name", "units_left"}] hoặc map {"<slot>": {"item_name", "units_left"}}.
+    Raises ValueError khi dữ liệu sai hoặc trùng ô / trùng sản phẩm.
+    """
+    if isinstance(raw, dict):
+        raw = [dict(v, slot_number=k) if isinstance(v, dict) else v for k, v in raw.items()]
+    if not isinstance(raw, list):
+        raise ValueError('slots phải là list hoặc map slot -> sản phẩm')
+
+    layout = []
+    for entry in raw:
+        if not isinstance(entry, dict):
+            raise ValueError(f'Ô không hợp lệ: {entry}')
+        try:
+            slot = int(entry['slot_number'])
+            item = str(entry['item_name'])
+            units = int(entry.get('units_left', 0))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'Ô không hợp lệ: {entry}')
+        if units < 0:
+            raise ValueError(f'units_left âm tại ô {slot}')
+        layout.append((slot, item, units))
+
+    slots = [s for s, _, _ in layout]
+    items = [i for _, i, _ in layout]
+    if len(set(slots)) != len(slots):
+        raise ValueError('Trùng số ô trong planogram')
+    if len(set(items)) != len(items):
+        raise ValueError('Một sản phẩm chỉ được nằm ở 1 ô')
+    return layout
+
+
+def _planogram_changes(before, layout):
+    """So sánh bố cục cũ {item: (slot, units)} với layout mới -> added / removed / moved / restocked."""
+    changes = {'added': [], 'removed': [], 'moved': [], 'restocked': []}
+    for slot, item, unit in layout:
+        if item not in before:
+            changes['added'].append({'item_name': item, 'slot_number': slot, 'units_left': unit})
+            continue
+        old_slot, old_units = before[item]
+        if old_slot != slot:
+            changes['moved'].append({'item_name': item, 'from_slot': old_slot, 'slot_number': slot, 'units_left': unit})
+        elif old_units != unit:
+            changes['restocked'].append({'item_name': item, 'slot_number': slot, 'units_left': unit})
+    changes['removed'] = sorted(set(before) - {item for _, item, _ in layout})
+    return changes
+
+
+@device_bp.route('/api/devices/<string:device_id>/planogram', methods=['PUT'])
+def put_device_planogram(device_id):
+    """
+    Admin: Ghi đè TOÀN BỘ bố cục ô của một máy trong 1 transaction.
+    Body: {"slots": [{"slot_number": 1, "item_name": "...", "units_left": 10}, ...]}
+    Sản phẩm không có trong planogram sẽ bị gỡ khỏi máy (giá riêng được giữ lại).
+    Làm trống máy phải ghi rõ: {"slots": [], "clear": true}.
+    Chỉ bắn 1 sự kiện MQTT cho cả lần thay đổi.
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or 'slots' not in data:
+            return jsonify({'success': False, 'message': 'Thiếu slots'}), 400
+        try:
+            layout = _parse_planogram(data['slots'])
+        except ValueError as ve:
+            return jsonify({'success': False, 'message': str(ve)}), 400
+        # Typo / client lỗi gửi planogram rỗng không được xoá sạch máy
+        if not layout and data.get('clear') is not True:
+            return jsonify({'success': False, 'message': 'slots rỗng sẽ gỡ mọi sản phẩm khỏi máy; gửi kèm "clear": true để xác nhận'}), 400
+
+        slots = [s for s, _, _ in layout]
+        items = [i for _, i, _ in layout]
+        units = [u for _, _, u in layout]
+        now_iso = datetime.now(timezone.utc).isoformat()
+
+        conn = getDatabaseConnection()
+        try:
+            cursor = conn.cursor()
+
+            # 1. Khoá và đọc trạng thái hiện tại của máy (để so sánh)
+            cursor.execute("""
+                SELECT item_name, slot_number, units_left
+                FROM device_inventory WHERE device_id = %s
+                FOR UPDATE
+            """, (device_id,))
+            before = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+            # 2. Sản phẩm phải tồn tại trong master data
+            cursor.execute("SELECT item_name FROM inventory WHERE item_name = ANY(%s)", (items,))
+            unknown = set(items) - {row[0] for row in cursor.fetchall()}
+            if unknown:
+                conn.rollback()
+                return jsonify({'success': False, 'message': f'Sản phẩm không tồn tại: {", ".join(sorted(unknown))}'}), 400
+
+            # 3. Kiểm tra trùng ô ở cuối transaction -> cho phép hoán đổi ô giữa các sản phẩm
+            #    (init_db có thể đã bỏ qua constraint nếu dữ liệu cũ trùng ô)
+            cursor.execute("SELECT 1 FROM pg_constraint WHERE conname = 'uq_device_slot'")
+            if cursor.fetchone():
+                cursor.execute("SET CONSTRAINTS uq_device_slot DEFERRED")
+
+            # 4. Gỡ sản phẩm không còn trong planogram
+            cursor.execute("""
+                DELETE FROM device_inventory
+                WHERE device_id = %s AND NOT (item_name = ANY(%s))
+            """, (device_id, items))
+
+            # 5. Upsert cả bố cục trong 1 câu lệnh, bỏ qua dòng không đổi
+            cursor.execute("""
+                INSERT INTO device_inventory (device_id, item_name, units_left, slot_number, last_updated)
+                SELECT %s, t.item_name, t.units_left, t.slot_number, %s
+                FROM unnest(%s::text[], %s::int[], %s::int[]) AS t(item_name, units_left, slot_number)
+                ON CONFLICT(device_id, item_name) DO UPDATE SET
+                    units_left = EXCLUDED.units_left,
+                    slot_number = EXCLUDED.slot_number,
+                    last_updated = EXCLUDED.last_updated
+                WHERE device_inventory.units_left IS DISTINCT FROM EXCLUDED.units_left
+                   OR device_inventory.slot_number IS DISTINCT FROM EXCLUDED.slot_number
+            """, (device_id, now_iso, items, units, slots))
+
+            evaluate_stock(cursor, device_ids=[device_id], now_iso=now_iso)
+
+            changes = _planogram_changes(before, layout)
+            changed = any(changes.values())
+            if changed:
+                outbox = Outbox(cursor)
+                outbox.publish_planogram_changed(device_id, changes)
+                outbox.publish_catalog_snapshots([device_id])
+                notify(cursor, 'device', [device_id])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        if changed:
+            logSystemEvent('planogram_update', f'{device_id}: planogram replaced',
+                           metadata={k: len(v) for k, v in changes.items()})
+
+        return jsonify({'success': True, 'changed': changed, 'changes': changes})
+    except Exception as e:
+        logger.error(f"Put Planogram Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
 @device_bp.route('/api/devices/<string:device_id>/inventory/<string:item_name>', methods=['DELETE'])
 def remove_device_inventory(device_id, item_name):
     """Admin: Gỡ hoàn toàn một sản phẩm khỏi một máy cụ thể."""
@@ -174,7 +461,14 @@ def remove_device_inventory(device_id, item_name):
                 DELETE FROM device_pricing 
                 WHERE device_id = %s AND item_name = %s
             """, (device_id, item_name))
-            
+
+            evaluate_stock(cursor, pairs=[(device_id, item_name)])
+            # Bắn MQTT update để máy trạm cập nhật lại UI ngay lập tức
+            outbox = Outbox(cursor)
+            outbox.publish_product_modified(item_name)
+            outbox.publish_catalog_snapshots([device_id])
+            notify(cursor, 'device', [device_id])
+            notify(cursor, 'pricing', [device_id])
             conn.commit()
             logSystemEvent('inventory_removed', f'Removed {item_name} from {device_id}')
         except Exception:
@@ -183,14 +477,43 @@ def remove_device_inventory(device_id, item_name):
         finally:
             conn.close()
 
-        # (Tùy chọn) Bắn MQTT update để máy trạm cập nhật lại UI ngay lập tức
-        try:
-            from mqtt_publisher import get_publisher
-            get_publisher().publish_product_modified(item_name)
-        except Exception as mqtt_err:
-            logger.warning(f"MQTT publish failed: {mqtt_err}")
-
         return jsonify({'success': True, 'message': f'Đã gỡ {item_name} khỏi {device_id}'})
     except Exception as e:
         logger.error(f"Remove Device Inventory Error: {e}")
-        return jsonify({'success': False, 'message': str(e)}), 500
\ No newline at end of file
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@device_bp.route('/api/admin/restock_plan', methods=['GET'])
+def get_restock_plan():
+    """
+    Admin: Dự báo hết hàng và lập kế hoạch nạp hàng cho toàn bộ máy.
+    Query: target_days (mặc định 7), lookback_days (28), max_units (sức chứa ô, tuỳ chọn), device_id (lọc).
+    """
+    try:
+        from forecasting import DEFAULT_LOOKBACK_DAYS, DEFAULT_TARGET_DAYS
+
+        target_days = float(request.args.get('target_days', DEFAULT_TARGET_DAYS))
+        lookback_days = int(request.args.get('lookback_days', DEFAULT_LOOKBACK_DAYS))
+        max_units = request.args.get('max_units', type=int)
+        device_filter = request.args.getlist('device_id')
+
+        if target_days <= 0 or lookback_days <= 0:
+            return jsonify({'success': False, 'message': 'target_days và lookback_days phải > 0'}), 400
+
+        # pandas chạy trong process pool analytics, không chiếm worker
+        plan = run_analytics(restock_plan, target_days, lookback_days, max_units, device_filter)
+
+        return jsonify({
+            'success': True,
+            'target_days': target_days,
+            'lookback_days': lookback_days,
+            'pick_list': plan['pick_list'],
+            'machines': plan['machines'],
+        })
+    except TimeoutError as te:
+        logger.error(f"Restock Plan Timeout: {te}")
+        return jsonify({'success': False, 'message': str(te)}), 504
+    except ValueError as ve:
+        return jsonify({'success': False, 'message': str(ve)}), 400
+    except Exception as e:
+        logger.error(f"Restock Plan Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
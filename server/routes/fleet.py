@@ -0,0 +1,271 @@
+from flask import Blueprint, request, jsonify
+from datetime import datetime, timezone
+import logging
+
+from database import getDatabaseConnection
+from utils import logSystemEvent
+from alerts import evaluate_stock
+from outbox import Outbox
+from invalidation import notify
+
+logger = logging.getLogger(__name__)
+
+fleet_bp = Blueprint('fleet', __name__)
+
+
+def _device_id_list(value, field):
+    """None / list các chuỗi không rỗng (bỏ trùng, giữ thứ tự); sai kiểu -> ValueError."""
+    if value is None:
+        return None
+    if not isinstance(value, list) or not all(isinstance(d, str) and d.strip() for d in value):
+        raise ValueError(f'{field} phải là danh sách mã máy (chuỗi không rỗng)')
+    return list(dict.fromkeys(value))
+
+
+def _json_bool(data, key, default):
+    """Chỉ nhận true/false của JSON: chuỗi "false" không được coi là True."""
+    value = data.get(key, default)
+    if not isinstance(value, bool):
+        raise ValueError(f'{key} phải là true hoặc false')
+    return value
+
+
+def _resolve_devices(cursor, device_ids):
+    """Danh sách máy đích: list đã kiểm tra, hoặc tất cả máy trong bảng devices nếu để trống."""
+    if device_ids:
+        return device_ids
+    cursor.execute("SELECT device_id FROM devices ORDER BY device_id")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _notify_fleet(cursor, action, device_ids, item_names):
+    """
+    Một sự kiện MQTT chung cho cả thao tác hàng loạt, cộng ảnh chụp catalog riêng
+    của từng máy bị ảnh hưởng (ghi outbox trong transaction hiện tại), và huỷ cache
+    tồn kho / giá của các máy đó ở mọi worker.
+    """
+    if device_ids:
+        outbox = Outbox(cursor)
+        outbox.publish_fleet_changed(action, device_ids, item_names)
+        outbox.publish_catalog_snapshots(device_ids)
+        notify(cursor, 'device', device_ids)
+        notify(cursor, 'pricing', device_ids)
+
+
+@fleet_bp.route('/api/admin/fleet/assign', methods=['POST'])
+def fleet_assign_product():
+    """
+    Admin: Gán một sản phẩm vào nhiều máy (mặc định: tất cả) trong 1 transaction.
+    Body: {"item_name", "slot_number", "units_left", "device_ids"?, "custom_price"?,
+           "on_slot_conflict": "skip" | "replace"}
+    - skip   : máy có ô đó đang chứa sản phẩm khác thì bỏ qua (trả về trong 'skipped').
+    - replace: gỡ sản phẩm đang chiếm ô đó rồi gán.
+    """
+    try:
+        data = request.get_json() or {}
+        item_name = data.get('item_name')
+        on_conflict = data.get('on_slot_conflict', 'skip')
+        try:
+            slot_number = int(data['slot_number'])
+            units_left = int(data.get('units_left', 0))
+            custom_price = int(float(data['custom_price'])) if data.get('custom_price') is not None else None
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'slot_number / units_left / custom_price không hợp lệ'}), 400
+        try:
+            requested_devices = _device_id_list(data.get('device_ids'), 'device_ids')
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        if not item_name or on_conflict not in ('skip', 'replace'):
+            return jsonify({'success': False, 'message': 'Thiếu item_name hoặc on_slot_conflict sai'}), 400
+
+        now_iso = datetime.now(timezone.utc).isoformat()
+        conn = getDatabaseConnection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM inventory WHERE item_name = %s", (item_name,))
+            if not cursor.fetchone():
+                return jsonify({'success': False, 'message': 'Sản phẩm không tồn tại'}), 404
+
+            device_ids = _resolve_devices(cursor, requested_devices)
+
+            # 1. Ô đang bị sản phẩm khác chiếm
+            if on_conflict == 'replace':
+                cursor.execute("""
+                    DELETE FROM device_inventory
+                    WHERE device_id = ANY(%s) AND slot_number = %s AND item_name <> %s
+                """, (device_ids, slot_number, item_name))
+                skipped = []
+            else:
+                cursor.execute("""
+                    SELECT DISTINCT device_id FROM device_inventory
+                    WHERE device_id = ANY(%s) AND slot_number = %s AND item_name <> %s
+                """, (device_ids, slot_number, item_name))
+                skipped = [row[0] for row in cursor.fetchall()]
+            skipped_set = set(skipped)
+            targets = [d for d in device_ids if d not in skipped_set]
+
+            # 2. Gán cho tất cả máy đích trong 1 câu lệnh
+            cursor.execute("""
+                INSERT INTO device_inventory (device_id, item_name, units_left, slot_number, last_updated)
+                SELECT t.device_id, %s, %s, %s, %s
+                FROM unnest(%s::text[]) AS t(device_id)
+                ON CONFLICT(device_id, item_name) DO UPDATE SET
+                    units_left = EXCLUDED.units_left,
+                    slot_number = EXCLUDED.slot_number,
+                    last_updated = EXCLUDED.last_updated
+            """, (item_name, units_left, slot_number, now_iso, targets))
+
+            if custom_price is not None:
+                cursor.execute("""
+                    INSERT INTO device_pricing (device_id, item_name, custom_price)
+                    SELECT t.device_id, %s, %s
+                    FROM unnest(%s::text[]) AS t(device_id)
+                    ON CONFLICT(device_id, item_name) DO UPDATE SET custom_price = EXCLUDED.custom_price
+                """, (item_name, custom_price, targets))
+
+            # replace có thể đã gỡ sản phẩm khác khỏi ô -> đánh giá lại cả máy
+            if on_conflict == 'replace':
+                evaluate_stock(cursor, device_ids=device_ids, now_iso=now_iso)
+            else:
+                evaluate_stock(cursor, pairs=[(d, item_name) for d in targets], now_iso=now_iso)
+            _notify_fleet(cursor, 'assign', targets, [item_name])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        if targets:
+            logSystemEvent('fleet_assign', f'Assigned {item_name} to {len(targets)} devices at slot {slot_number}')
+
+        return jsonify({'success': True, 'assigned': targets, 'skipped': skipped})
+    except Exception as e:
+        logger.error(f"Fleet Assign Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@fleet_bp.route('/api/admin/fleet/remove', methods=['POST'])
+def fleet_remove_product():
+    """
+    Admin: Gỡ một sản phẩm khỏi nhiều máy (mặc định: tất cả), kèm giá riêng của các máy đó.
+    Body: {"item_name", "device_ids"?}
+    """
+    try:
+        data = request.get_json() or {}
+        item_name = data.get('item_name')
+        if not item_name:
+            return jsonify({'success': False, 'message': 'Thiếu item_name'}), 400
+        try:
+            requested_devices = _device_id_list(data.get('device_ids'), 'device_ids')
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+
+        conn = getDatabaseConnection()
+        try:
+            cursor = conn.cursor()
+            device_ids = _resolve_devices(cursor, requested_devices)
+            cursor.execute("""
+                DELETE FROM device_inventory
+                WHERE item_name = %s AND device_id = ANY(%s)
+                RETURNING device_id
+            """, (item_name, device_ids))
+            removed = [row[0] for row in cursor.fetchall()]
+            cursor.execute("""
+                DELETE FROM device_pricing
+                WHERE item_name = %s AND device_id = ANY(%s)
+            """, (item_name, device_ids))
+            evaluate_stock(cursor, pairs=[(d, item_name) for d in removed])
+            _notify_fleet(cursor, 'remove', removed, [item_name])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        if removed:
+            logSystemEvent('fleet_remove', f'Removed {item_name} from {len(removed)} devices')
+
+        return jsonify({'success': True, 'removed': removed})
+    except Exception as e:
+        logger.error(f"Fleet Remove Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+
+@fleet_bp.route('/api/admin/fleet/clone', methods=['POST'])
+def fleet_clone_layout():
+    """
+    Admin: Sao chép bố cục ô (và giá riêng) từ một máy mẫu sang N máy đích.
+    Body: {"template_device_id", "target_device_ids": [...], "include_pricing": true,
+           "copy_units": false}  -- copy_units=false: máy mới bắt đầu với tồn kho 0
+    Bố cục cũ của máy đích bị thay thế hoàn toàn.
+    """
+    try:
+        data = request.get_json() or {}
+        template = data.get('template_device_id')
+        try:
+            targets = [d for d in _device_id_list(data.get('target_device_ids'), 'target_device_ids') or []
+                       if d != template]
+            include_pricing = _json_bool(data, 'include_pricing', True)
+            copy_units = _json_bool(data, 'copy_units', False)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        if not isinstance(template, str) or not template or not targets:
+            return jsonify({'success': False, 'message': 'Thiếu template_device_id hoặc target_device_ids'}), 400
+
+        now_iso = datetime.now(timezone.utc).isoformat()
+        conn = getDatabaseConnection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM device_inventory WHERE device_id = %s", (template,))
+            if cursor.fetchone()[0] == 0:
+                return jsonify({'success': False, 'message': f'Máy mẫu {template} chưa có sản phẩm'}), 404
+
+            # Đảm bảo máy mới xuất hiện trong danh sách thiết bị
+            cursor.execute("""
+                INSERT INTO devices (device_id, last_active)
+                SELECT t.device_id, NULL FROM unnest(%s::text[]) AS t(device_id)
+                ON CONFLICT(device_id) DO NOTHING
+            """, (targets,))
+
+            cursor.execute("DELETE FROM device_inventory WHERE device_id = ANY(%s)", (targets,))
+            cursor.execute("""
+                INSERT INTO device_inventory (device_id, item_name, units_left, slot_number, last_updated)
+                SELECT t.device_id, src.item_name,
+                       CASE WHEN %s THEN src.units_left ELSE 0 END,
+                       src.slot_number, %s
+                FROM device_inventory src
+                CROSS JOIN unnest(%s::text[]) AS t(device_id)
+                WHERE src.device_id = %s
+            """, (copy_units, now_iso, targets, template))
+            cloned_rows = cursor.rowcount
+
+            if include_pricing:
+                cursor.execute("DELETE FROM device_pricing WHERE device_id = ANY(%s)", (targets,))
+                cursor.execute("""
+                    INSERT INTO device_pricing (device_id, item_name, custom_price, custom_cost_price)
+                    SELECT t.device_id, src.item_name, src.custom_price, src.custom_cost_price
+                    FROM device_pricing src
+                    CROSS JOIN unnest(%s::text[]) AS t(device_id)
+                    WHERE src.device_id = %s
+                """, (targets, template))
+
+            cursor.execute("SELECT item_name FROM device_inventory WHERE device_id = %s", (template,))
+            item_names = [row[0] for row in cursor.fetchall()]
+            evaluate_stock(cursor, device_ids=targets, now_iso=now_iso)
+            _notify_fleet(cursor, 'clone', targets, item_names)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        logSystemEvent('fleet_clone', f'Cloned layout of {template} to {len(targets)} devices',
+                       metadata={'rows': cloned_rows, 'include_pricing': include_pricing})
+
+        return jsonify({'success': True, 'template_device_id': template, 'targets': targets, 'rows': cloned_rows})
+    except Exception as e:
+        logger.error(f"Fleet Clone Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
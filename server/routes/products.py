@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, send_from_directory
+from flask import Blueprint, Response, request, jsonify, send_from_directory
 from datetime import datetime, timezone
 import logging
 import os
@@ -7,7 +7,13 @@ import time
 
 from database import getDatabaseConnection, dict_fetchall, dict_fetchone
 from utils import logSystemEvent
-from mqtt_publisher import get_publisher
+from outbox import Outbox
+from auth_tokens import current_device_id, TokenError
+from alerts import evaluate_stock
+from singleflight import SingleFlight
+from catalog_matrix import CATALOG_MATRIX_ENABLED, get_catalog
+from invalidation import notify
+from analytics import run_analytics, rebuild_related
 
 IMAGES_DIR = os.environ.get('IMAGES_DIR', '/app/images')
 os.makedirs(IMAGES_DIR, exist_ok=True)
@@ -16,6 +22,16 @@ logger = logging.getLogger(__name__)
 
 product_bp = Blueprint('products', __name__)
 
+# Gộp các request catalog trùng nhau đang chạy đồng thời (theo worker)
+_catalog_flight = SingleFlight()
+
+# devices.last_active chỉ ghi lại tối đa 1 lần / DEVICE_ACTIVE_INTERVAL giây cho mỗi máy (theo worker)
+# Số gợi ý "thường mua cùng" tối đa mỗi request
+MAX_RELATED_LIMIT = 50
+
+DEVICE_ACTIVE_INTERVAL = float(os.environ.get('DEVICE_ACTIVE_INTERVAL', 60))
+_last_active_written = {}
+
 # ---------------------------------------------------------------------------
 # Image upload helpers
 # ---------------------------------------------------------------------------
@@ -131,12 +147,12 @@ def admin_create_product():
                 VALUES (%s, %s, %s, %s, %s, %s)
                 ON CONFLICT(item_name) DO NOTHING
             """, (item_name, price, cost_price, description, image_filename, image_url))
+            Outbox(cursor).publish_new_product(item_name)
+            notify(cursor, 'product', [item_name])
             conn.commit()
         finally:
             conn.close()
 
-        get_publisher().publish_new_product(item_name)
-
         return jsonify({'success': True, 'message': f'Đã tạo sản phẩm: {item_name}',
                         'image_url': image_url})
     except Exception as e:
@@ -175,32 +191,28 @@ def admin_add_stock():
                     VALUES (%s, %s, %s, %s)
                 """, (device_id, item_name, quantity, now_iso))
 
+            evaluate_stock(cursor, pairs=[(device_id, item_name)], now_iso=now_iso)
+
+            # Tồn kho mới để đưa vào thông báo MQTT (ghi outbox cùng transaction)
+            cursor.execute("""
+                SELECT d.units_left, i.price
+                FROM device_inventory d
+                JOIN inventory i ON i.item_name = d.item_name
+                WHERE d.device_id = %s AND d.item_name = %s
+            """, (device_id, item_name))
+            row = cursor.fetchone()
+            units_left = row[0] if row else quantity
+            price      = row[1] if row else 0
+            outbox = Outbox(cursor)
+            outbox.publish_product_update(device_id, item_name, price, units_left)
+            outbox.publish_catalog_snapshots([device_id])
+            notify(cursor, 'device', [device_id])
+
             conn.commit()
             logSystemEvent('stock_added', f'Added {quantity} units of {item_name} to {device_id}')
         finally:
             conn.close()
 
-        # Fetch updated units_left for this device to include in the MQTT payload
-        try:
-            conn2 = getDatabaseConnection()
-            try:
-                cursor2 = conn2.cursor()
-                cursor2.execute("""
-                    SELECT d.units_left, i.price
-                    FROM device_inventory d
-                    JOIN inventory i ON i.item_name = d.item_name
-                    WHERE d.device_id = %s AND d.item_name = %s
-                """, (device_id, item_name))
-                row = cursor2.fetchone()
-                units_left = row[0] if row else quantity
-                price      = row[1] if row else 0
-            finally:
-                conn2.close()
-
-            get_publisher().publish_product_update(device_id, item_name, price, units_left)
-        except Exception as mqtt_err:
-            logger.warning("MQTT publish after add_stock failed: %s", mqtt_err)
-
         return jsonify({'success': True, 'message': f'Đã nhập {quantity} {item_name} cho {device_id}'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -223,7 +235,9 @@ def setDevicePrice():
                 cursor.execute("UPDATE device_pricing SET custom_price = %s WHERE device_id = %s AND item_name = %s", (price, device_id, item_name))
             else:
                 cursor.execute("INSERT INTO device_pricing (device_id, item_name, custom_price) VALUES (%s, %s, %s)", (device_id, item_name, price))
-                
+
+            Outbox(cursor).publish_catalog_snapshots([device_id])
+            notify(cursor, 'pricing', [device_id])
             conn.commit()
         except Exception:
             conn.rollback()
@@ -235,66 +249,175 @@ def setDevicePrice():
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+# Postgres dựng sẵn toàn bộ body JSON: worker trả nguyên chuỗi, không tạo dict cho từng dòng
+_DEVICE_CATALOG_JSON_SQL = """
+    SELECT json_build_object('success', true, 'products', COALESCE(json_agg(json_build_object(
+               'item_name',      i.item_name,
+               'price',          COALESCE(dp.custom_price, i.price),
+               'description',    i.description,
+               'image_filename', i.image_filename,
+               'image_url',      i.image_url,
+               'created_at',     i.created_at,
+               'units_left',     COALESCE(d.units_left, 0),
+               'slot_number',    d.slot_number
+           ) ORDER BY i.id), '[]'::json))::text
+    FROM inventory i
+    LEFT JOIN device_inventory d ON i.item_name = d.item_name AND d.device_id = %s
+    LEFT JOIN device_pricing dp ON i.item_name = dp.item_name AND dp.device_id = %s
+"""
+_MASTER_CATALOG_JSON_SQL = """
+    SELECT json_build_object('success', true, 'products', COALESCE(json_agg(json_build_object(
+               'id',             i.id,
+               'item_name',      i.item_name,
+               'price',          i.price,
+               'cost_price',     i.cost_price,
+               'description',    i.description,
+               'image_filename', i.image_filename,
+               'image_url',      i.image_url,
+               'created_at',     i.created_at,
+               'updated_at',     i.updated_at
+           ) ORDER BY i.id), '[]'::json))::text
+    FROM inventory i
+"""
+
+
+def _render_catalog(device_id):
+    """Body JSON của GET /api/products do Postgres dựng (giá hiệu lực = COALESCE giá riêng, giá chung)."""
+    conn = getDatabaseConnection()
+    try:
+        cursor = conn.cursor()
+        if device_id:
+            cursor.execute(_DEVICE_CATALOG_JSON_SQL, (device_id, device_id))
+        else:
+            cursor.execute(_MASTER_CATALOG_JSON_SQL)
+        return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _touch_device(device_id):
+    """Ghi nhận máy còn hoạt động (last_active) mà không tốn 1 lần ghi cho mỗi lần poll."""
+    now = time.monotonic()
+    if now - _last_active_written.get(device_id, float('-inf')) < DEVICE_ACTIVE_INTERVAL:
+        return
+    conn = getDatabaseConnection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO devices (device_id, last_active) 
+            VALUES (%s, %s)
+            ON CONFLICT(device_id) DO UPDATE SET last_active = EXCLUDED.last_active
+        """, (device_id, datetime.now(timezone.utc).isoformat()))
+        conn.commit()
+    finally:
+        conn.close()
+    _last_active_written[device_id] = now
+
+
 @product_bp.route('/api/products', methods=['GET'])
 def getProducts():
     """
     Client: Lấy danh sách sản phẩm kèm image_url.
     - Nếu có X-Device-ID: Lấy units_left từ device_inventory.
     - Nếu không (Admin): Lấy master data (không có units_left).
+    Trả về body JSON dựng sẵn từ catalog trong bộ nhớ của worker (catalog_matrix.py); khi tắt
+    CATALOG_MATRIX thì Postgres dựng body (json_agg) và các request trùng nhau đang chạy đồng
+    thời trong worker chỉ chạy 1 query (single-flight).
     """
     try:
-        device_id = request.headers.get('X-Device-ID')
+        try:
+            device_id = current_device_id()
+        except TokenError as te:
+            return jsonify({'success': False, 'message': str(te)}), 401
+
+        if device_id:
+            _touch_device(device_id)
+        if CATALOG_MATRIX_ENABLED:
+            matrix = get_catalog()
+            body = matrix.device_catalog_json(device_id) if device_id else matrix.master_catalog_json()
+        else:
+            body = _catalog_flight.do(('catalog', device_id), lambda: _render_catalog(device_id))
+
+        return Response(body, mimetype='application/json')
+    except Exception as e:
+        logger.error(f"Get Products Error: {e}")
+        return jsonify({'success': False}), 500
+
+@product_bp.route('/api/products/<string:item_name>/related', methods=['GET'])
+def getRelatedProducts(item_name):
+    """
+    Client: Gợi ý "thường mua cùng" cho một sản phẩm (đọc từ bảng product_related đã tính sẵn).
+    - Nếu có device token / X-Device-ID (hoặc ?device_id=): chỉ trả về món máy đó đang còn hàng, kèm giá riêng.
+    - limit: 1..MAX_RELATED_LIMIT (mặc định 5).
+    """
+    try:
+        try:
+            limit = int(request.args.get('limit', 5))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'limit phải là số nguyên'}), 400
+        if limit < 1:
+            return jsonify({'success': False, 'message': 'limit phải >= 1'}), 400
+        limit = min(limit, MAX_RELATED_LIMIT)
+        try:
+            device_id = current_device_id(request.args.get('device_id'))
+        except TokenError as te:
+            return jsonify({'success': False, 'message': str(te)}), 401
 
         conn = getDatabaseConnection()
         try:
             cursor = conn.cursor()
             if device_id:
-                now_iso = datetime.now(timezone.utc).isoformat()
                 cursor.execute("""
-                    INSERT INTO devices (device_id, last_active) 
-                    VALUES (%s, %s)
-                    ON CONFLICT(device_id) DO UPDATE SET last_active = EXCLUDED.last_active
-                """, (device_id, now_iso))
-                conn.commit()
-                query = """
-                    SELECT i.item_name, i.price, i.description,
-                           i.image_filename, i.image_url, i.created_at,
-                           COALESCE(d.units_left, 0) as units_left,
-                           d.slot_number,
-                           dp.custom_price
-                    FROM inventory i
-                    LEFT JOIN device_inventory d ON i.item_name = d.item_name AND d.device_id = %s
-                    LEFT JOIN device_pricing dp ON i.item_name = dp.item_name AND dp.device_id = %s
-                """
-                cursor.execute(query, (device_id, device_id))
+                    SELECT r.related_name AS item_name, r.score, r.support,
+                           COALESCE(dp.custom_price, i.price) AS price,
+                           i.image_url, d.units_left, d.slot_number
+                    FROM product_related r
+                    JOIN inventory i ON i.item_name = r.related_name
+                    JOIN device_inventory d ON d.item_name = r.related_name AND d.device_id = %s
+                    LEFT JOIN device_pricing dp ON dp.item_name = r.related_name AND dp.device_id = %s
+                    WHERE r.item_name = %s AND d.units_left > 0
+                    ORDER BY r.rank
+                    LIMIT %s
+                """, (device_id, device_id, item_name, limit))
             else:
-                cursor.execute(
-                    "SELECT id, item_name, price, cost_price, description, "
-                    "image_filename, image_url, created_at, updated_at FROM inventory"
-                )
-
-            rows = dict_fetchall(cursor)
+                cursor.execute("""
+                    SELECT r.related_name AS item_name, r.score, r.support, i.price, i.image_url
+                    FROM product_related r
+                    JOIN inventory i ON i.item_name = r.related_name
+                    WHERE r.item_name = %s
+                    ORDER BY r.rank
+                    LIMIT %s
+                """, (item_name, limit))
+            related = dict_fetchall(cursor)
         finally:
             conn.close()
 
-        final_list = []
-        for p in rows:
-            if device_id:
-                if p.get('custom_price') is not None:
-                    p['price'] = p['custom_price']
-                if p.get('units_left') is None:
-                    p['units_left'] = 0
-            p.pop('custom_price', None)
-            # Serialize timestamps
-            for ts_field in ('created_at', 'updated_at'):
-                if p.get(ts_field) and hasattr(p[ts_field], 'isoformat'):
-                    p[ts_field] = p[ts_field].isoformat()
-            final_list.append(p)
-
-        return jsonify({'success': True, 'products': final_list})
+        return jsonify({'success': True, 'item_name': item_name, 'related': related})
     except Exception as e:
-        logger.error(f"Get Products Error: {e}")
-        return jsonify({'success': False}), 500
+        logger.error(f"Get Related Products Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@product_bp.route('/api/admin/rebuild_related', methods=['POST'])
+def admin_rebuild_related():
+    """Admin: Chạy lại batch job tính bảng "thường mua cùng"."""
+    try:
+        from recommendations import DEFAULT_TOP_K
+
+        data = request.get_json(silent=True) or {}
+        top_k = int(data.get('top_k', DEFAULT_TOP_K))
+        metric = data.get('metric', 'lift')
+
+        stored = run_analytics(rebuild_related, top_k, metric)
+        logSystemEvent('related_rebuilt', f'Stored {stored} related-product rows ({metric})')
+        return jsonify({'success': True, 'rows': stored})
+    except ValueError as ve:
+        return jsonify({'success': False, 'message': str(ve)}), 400
+    except TimeoutError as te:
+        logger.error(f"Rebuild Related Timeout: {te}")
+        return jsonify({'success': False, 'message': str(te)}), 504
+    except Exception as e:
+        logger.error(f"Rebuild Related Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
 
 @product_bp.route('/api/admin/update_product', methods=['POST'])
 def admin_update_product():
@@ -323,6 +446,8 @@ def admin_update_product():
                 cursor.execute("UPDATE inventory SET item_name = %s WHERE item_name = %s", (new_name, old_name))
                 cursor.execute("UPDATE device_inventory SET item_name = %s WHERE item_name = %s", (new_name, old_name))
                 cursor.execute("UPDATE device_pricing SET item_name = %s WHERE item_name = %s", (new_name, old_name))
+                cursor.execute("UPDATE alert_thresholds SET item_name = %s WHERE item_name = %s", (new_name, old_name))
+                cursor.execute("UPDATE stock_alerts SET item_name = %s WHERE item_name = %s", (new_name, old_name))
                 target_name = new_name
             else:
                 target_name = old_name
@@ -372,36 +497,32 @@ def admin_update_product():
                         INSERT INTO device_inventory (device_id, item_name, units_left, last_updated)
                         VALUES (%s, %s, %s, %s)
                     """, (device_id, target_name, add_stock, now_iso))
+                evaluate_stock(cursor, pairs=[(device_id, target_name)], now_iso=now_iso)
 
-            conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
-
-        try:
-            conn2 = getDatabaseConnection()
-            cursor2 = conn2.cursor()
-            cursor2.execute("""
+            # 4. Hot Update cho từng máy chứa sản phẩm này (ghi outbox cùng transaction)
+            cursor.execute("""
                 SELECT d.device_id, d.units_left, i.price, dp.custom_price
                 FROM device_inventory d
                 JOIN inventory i ON i.item_name = d.item_name
                 LEFT JOIN device_pricing dp ON dp.item_name = d.item_name AND dp.device_id = d.device_id
                 WHERE d.item_name = %s
             """, (target_name,))
-            rows = cursor2.fetchall()
-            
-            for row in rows:
-                dev_id = row[0]
-                u_left = row[1]
-                f_price = row[3] if row[3] is not None else row[2]
-                # Bắn Hot Update cho từng máy chứa sản phẩm này
-                get_publisher().publish_hot_update(dev_id, old_name, target_name, f_price, u_left)
-        except Exception as e:
-            logger.warning(f"Lỗi gửi MQTT Hot Update khi đổi tên/giá: {e}")
+            outbox = Outbox(cursor)
+            holders = cursor.fetchall()
+            for dev_id, u_left, base_price, dev_price in holders:
+                f_price = dev_price if dev_price is not None else base_price
+                outbox.publish_hot_update(dev_id, old_name, target_name, f_price, u_left)
+            outbox.publish_catalog_snapshots(item_name=target_name)
+            notify(cursor, 'product', [old_name, target_name])
+            notify(cursor, 'pricing', [row[0] for row in holders] + [device_id])
+            notify(cursor, 'device', [row[0] for row in holders])
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         finally:
-            if 'conn2' in locals(): conn2.close()
+            conn.close()
 
         return jsonify({'success': True, 'message': 'Cập nhật sản phẩm thành công'})
     except Exception as e:
@@ -425,8 +546,17 @@ def admin_delete_product(item_name):
             image_url = row[0]
 
             cursor.execute("DELETE FROM device_pricing WHERE item_name = %s", (item_name,))
-            cursor.execute("DELETE FROM device_inventory WHERE item_name = %s", (item_name,))
+            cursor.execute("DELETE FROM device_inventory WHERE item_name = %s RETURNING device_id", (item_name,))
+            holders = [r[0] for r in cursor.fetchall()]
+            # Sản phẩm không còn trong máy -> đóng các cảnh báo đang mở
+            evaluate_stock(cursor, pairs=[(device_id, item_name) for device_id in holders])
+            cursor.execute("DELETE FROM alert_thresholds WHERE item_name = %s", (item_name,))
             cursor.execute("DELETE FROM inventory WHERE item_name = %s", (item_name,))
+            outbox = Outbox(cursor)
+            outbox.publish_product_modified(item_name)
+            outbox.publish_catalog_snapshots(holders)
+            notify(cursor, 'product', [item_name])
+            notify(cursor, 'device', holders)
             conn.commit()
             logSystemEvent('product_deleted', f'Deleted product: {item_name}')
         except Exception:
@@ -441,11 +571,6 @@ def admin_delete_product(item_name):
             filepath = os.path.join(IMAGES_DIR, filename)
             if os.path.exists(filepath):
                 os.remove(filepath)
-        try:
-            from mqtt_publisher import get_publisher
-            get_publisher().publish_product_modified(item_name)
-        except Exception as mqtt_err:
-            logger.warning(f"MQTT publish failed in delete product: {mqtt_err}")
             
         return jsonify({'success': True, 'message': f'Đã xóa sản phẩm: {item_name}'})
     except Exception as e:
@@ -498,6 +623,8 @@ def admin_upload_image():
                     os.remove(old_path)
 
             cursor.execute("UPDATE inventory SET image_url = %s WHERE item_name = %s", (image_url, item_name))
+            Outbox(cursor).publish_catalog_snapshots(item_name=item_name)
+            notify(cursor, 'product', [item_name])
             conn.commit()
         except Exception:
             conn.rollback()
@@ -6,6 +6,12 @@ import logging
 
 from database import getDatabaseConnection, dict_fetchall
 from utils import logSystemEvent
+from auth_tokens import current_device_id, current_identity, TokenError
+from alerts import evaluate_stock
+from outbox import Outbox
+from invalidation import notify
+from analytics import run_analytics, advanced_analytics
+from metrics import TRANSACTIONS, device_label
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +21,11 @@ trans_bp = Blueprint('transactions', __name__)
 def recordTransaction():
     try:
         data = request.get_json()
-        device_id = data.get('device_id') or request.headers.get('X-Device-ID') or 'UNKNOWN'
+        try:
+            # Token của máy (nếu có) được tin hơn device_id do client tự khai
+            device_id = current_device_id(data.get('device_id')) or 'UNKNOWN'
+        except TokenError as te:
+            return jsonify({'success': False, 'message': str(te)}), 401
 
         total_amount = data['total_amount']
         items = data['items']
@@ -38,6 +48,8 @@ def recordTransaction():
             """, (transaction_id, total_amount, items_str, user_id, device_id, now_iso))
 
             # 2. Xử lý kho
+            sold_pairs = []
+            provisioned = False   # máy có bố cục trong device_inventory
             for item in items:
                 p_name = item.get('product_name') or item.get('name') or item.get('item_name')
                 qty = item.get('quantity', 1)
@@ -48,6 +60,8 @@ def recordTransaction():
                         SET units_left = units_left - %s
                         WHERE item_name = %s AND device_id = %s
                     """, (qty, p_name, device_id))
+                    provisioned = provisioned or cursor.rowcount > 0
+                    sold_pairs.append((device_id, p_name))
 
                     cursor.execute("""
                         UPDATE inventory
@@ -71,6 +85,14 @@ def recordTransaction():
                 if row:
                     current_user_points = row[0]
 
+            # 4. Cảnh báo tồn kho thấp chỉ cho các sản phẩm vừa bán
+            evaluate_stock(cursor, pairs=sold_pairs, now_iso=now_iso)
+            if sold_pairs:
+                Outbox(cursor).publish_catalog_snapshots([device_id])
+                notify(cursor, 'device', [device_id])
+            if user_id:
+                notify(cursor, 'user', [user_id])
+
             conn.commit()
         except Exception:
             conn.rollback()
@@ -79,6 +101,8 @@ def recordTransaction():
             conn.close()
 
         logSystemEvent('transaction', f'Recorded {transaction_id} from {device_id}')
+        # current_identity() đã được current_device_id() verify và cache trong g
+        TRANSACTIONS.labels(device_label(device_id, provisioned or current_identity() is not None), 'http').inc()
 
         return jsonify({
             'success': True,
@@ -154,81 +178,16 @@ def get_inventory_stats():
 
 @trans_bp.route('/api/admin/analytics', methods=['GET'])
 def get_advanced_analytics():
-    """API: Thống kê và Phân tích Dữ liệu nâng cao cho Dashboard"""
+    """API: Thống kê và Phân tích Dữ liệu nâng cao cho Dashboard (chạy trong process pool analytics)"""
     device_id = request.args.get('device_id') # Có thể lọc theo máy nếu cần
     try:
-        conn = getDatabaseConnection()
-        cursor = conn.cursor()
-        
-        # Điều kiện WHERE linh hoạt
-        where_clause = "WHERE payment_status = 'completed'"
-        params = []
-        if device_id:
-            where_clause += " AND device_id = %s"
-            params.append(device_id)
-
-        # 1. Tổng doanh thu (Có lọc theo máy)
-        cursor.execute(f"SELECT COALESCE(SUM(total_amount), 0) FROM transactions {where_clause}", params)
-        total_revenue = cursor.fetchone()[0]
-
-        # 2. Top sản phẩm bán chạy tổng hợp
-        cursor.execute(f"""
-            SELECT 
-                COALESCE(elem->>'product_name', elem->>'name', elem->>'item_name') AS item_name,
-                SUM((elem->>'quantity')::int) AS units_sold
-            FROM transactions, json_array_elements(items::json) AS elem
-            {where_clause}
-            GROUP BY 1 ORDER BY units_sold DESC LIMIT 5
-        """, params)
-        top_products = dict_fetchall(cursor)
-
-        # 3. Sản phẩm "ế" (Bán <= 3 cái) tại từng máy
-        cursor.execute(f"""
-            SELECT 
-                device_id,
-                COALESCE(elem->>'product_name', elem->>'name', elem->>'item_name') AS item_name,
-                SUM((elem->>'quantity')::int) AS units_sold
-            FROM transactions, json_array_elements(items::json) AS elem
-            {where_clause}
-            GROUP BY 1, 2 HAVING SUM((elem->>'quantity')::int) <= 3
-            ORDER BY units_sold ASC
-        """, params)
-        underperforming = dict_fetchall(cursor)
-
-        # 4. Doanh thu theo từng máy (Luôn lấy toàn hệ thống để vẽ chart bar)
-        cursor.execute("""
-            SELECT device_id, SUM(total_amount) as revenue 
-            FROM transactions WHERE payment_status = 'completed' 
-            GROUP BY device_id ORDER BY revenue DESC
-        """)
-        revenue_by_device = dict_fetchall(cursor)
-
-        # 5. [THÊM MỚI] Top sản phẩm bán chạy CHIA THEO TỪNG MÁY
-        cursor.execute("""
-            SELECT 
-                device_id,
-                COALESCE(elem->>'product_name', elem->>'name', elem->>'item_name') AS item_name,
-                SUM((elem->>'quantity')::int) AS units_sold
-            FROM transactions, json_array_elements(items::json) AS elem
-            WHERE payment_status = 'completed'
-            GROUP BY 1, 2
-            ORDER BY device_id, units_sold DESC
-        """)
-        top_products_by_device = dict_fetchall(cursor)
-
-        conn.close()
-        
+        data = run_analytics(advanced_analytics, device_id)
+
         # Trả về đầy đủ dữ liệu cho Streamlit
-        return jsonify({
-            'success': True,
-            'data': {
-                'total_revenue': total_revenue,
-                'top_products': top_products,
-                'revenue_by_device': revenue_by_device,
-                'underperforming_products': underperforming,
-                'top_products_by_device': top_products_by_device # Key quan trọng cho giao diện mới
-            }
-        })
+        return jsonify({'success': True, 'data': data})
+    except TimeoutError as te:
+        logger.error(f"Analytics API Timeout: {te}")
+        return jsonify({'success': False, 'message': str(te)}), 504
     except Exception as e:
         logger.error(f"Analytics API Error: {e}")
-        return jsonify({'success': False, 'message': str(e)}), 500
\ No newline at end of file
+        return jsonify({'success': False, 'message': str(e)}), 500
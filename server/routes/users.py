@@ -1,16 +1,44 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, g
 from datetime import datetime, timezone
 import logging
 import json
+import hmac
 from collections import Counter
 
 # Import các hàm dùng chung từ database và utils
-from database import getDatabaseConnection, dict_fetchone, dict_fetchall
+from database import getDatabaseConnection, dict_fetchone, dict_fetchall, estimate_count, has_extension, USER_SEARCH_DOC
 from utils import logSystemEvent
+from auth_tokens import issue_token, revoke_token, require_token, USER_SCOPES
+from invalidation import notify
 
 logger = logging.getLogger(__name__)
 user_bp = Blueprint('users', __name__)
 
+# Dưới ngưỡng này đếm chính xác (rẻ); vượt ngưỡng thì dùng số ước lượng của planner
+_EXACT_COUNT_CAP = 1000
+
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _user_search_filter(cursor, search):
+    """
+    Trả về (where_clause, params, order_prefix, order_params) cho ô tìm kiếm khách hàng.
+    - Có pg_trgm và từ khoá >= 3 ký tự: LIKE '%...%' + word similarity trên index GIN trigram, xếp hạng theo độ khớp.
+    - Ngược lại: tìm theo tiền tố SĐT / email / tên (index text_pattern_ops).
+    """
+    term = search.strip().lower()
+    escaped = _escape_like(term)
+    if len(term) >= 3 and has_extension(cursor, 'pg_trgm'):
+        where = f" WHERE ({USER_SEARCH_DOC} LIKE %s OR %s <%% {USER_SEARCH_DOC})"
+        order = f"word_similarity(%s, {USER_SEARCH_DOC}) DESC, "
+        return where, [f"%{escaped}%", term], order, [term]
+
+    where = " WHERE (phone_number LIKE %s OR lower(email) LIKE %s OR lower(full_name) LIKE %s)"
+    return where, [f"{escaped}%"] * 3, "", []
+
+
 @user_bp.route('/api/users', methods=['GET'])
 def listUsers():
     try:
@@ -21,28 +49,31 @@ def listUsers():
         conn = getDatabaseConnection()
         try:
             cursor = conn.cursor()
-            base_query = "SELECT user_id, full_name, phone_number, points, email, status, created_at, password FROM users"
-            count_query = "SELECT COUNT(*) AS total FROM users"
-            params = []
+            where_clause, params, order_prefix, order_params = "", [], "", []
+            if search and search.strip():
+                where_clause, params, order_prefix, order_params = _user_search_filter(cursor, search)
 
-            if search:
-                where_clause = " WHERE (full_name LIKE %s OR phone_number LIKE %s OR email LIKE %s)"
-                base_query += where_clause
-                count_query += where_clause
-                params.extend([f"%{search}%", f"%{search}%", f"%{search}%"])
-
-            cursor.execute(count_query, params)
+            # Đếm có giới hạn: chỉ quét tối đa _EXACT_COUNT_CAP + 1 dòng
+            match_query = "SELECT 1 FROM users" + where_clause
+            cursor.execute(f"SELECT COUNT(*) FROM ({match_query} LIMIT %s) AS capped",
+                           params + [_EXACT_COUNT_CAP + 1])
             total_records = cursor.fetchone()[0]
+            total_is_estimate = total_records > _EXACT_COUNT_CAP
+            if total_is_estimate:
+                total_records = max(total_records, estimate_count(cursor, match_query, params))
 
-            base_query += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
-            params.extend([limit, offset])
-
-            cursor.execute(base_query, params)
+            cursor.execute(f"""
+                SELECT user_id, full_name, phone_number, points, email, status, created_at, password
+                FROM users{where_clause}
+                ORDER BY {order_prefix}created_at DESC
+                LIMIT %s OFFSET %s
+            """, params + order_params + [limit, offset])
             users = dict_fetchall(cursor)
         finally:
             conn.close()
 
-        return jsonify({'success': True, 'total': total_records, 'users': users})
+        return jsonify({'success': True, 'total': total_records,
+                        'total_is_estimate': total_is_estimate, 'users': users})
     except Exception as e:
         logger.error(f"Error /api/users: {e}")
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -78,6 +109,7 @@ def registerUser():
                 INSERT INTO users (user_id, full_name, phone_number, email, password, status, created_at, updated_at)
                 VALUES (%s, %s, %s, %s, %s, 'active', %s, %s)
             """, (user_id, data['full_name'], data['phone_number'], data['email'], data['password'], now_iso, now_iso))
+            notify(cursor, 'user', [user_id])
             conn.commit()
         except Exception:
             conn.rollback()
@@ -102,11 +134,18 @@ def loginUser():
         try:
             cursor = conn.cursor()
             # Tìm kiếm theo SĐT hoặc Email
-            cursor.execute("SELECT * FROM users WHERE phone_number = %s OR email = %s", (login_id, login_id))
+            cursor.execute("""
+                SELECT user_id, full_name, phone_number, email, points, status, password
+                FROM users WHERE phone_number = %s OR email = %s
+            """, (login_id, login_id))
             user = dict_fetchone(cursor)
 
-            if user and user['password'] == str(password):
-                return jsonify({'success': True, 'user': user})
+            if user and hmac.compare_digest(str(user['password']).encode(), str(password).encode()):
+                user.pop('password')
+                # Cấp token phiên: các request sau chỉ cần verify chữ ký, không query lại DB
+                token, claims = issue_token(user['user_id'], 'user', USER_SCOPES)
+                return jsonify({'success': True, 'user': user, 'token': token,
+                                'expires_at': claims['exp']})
 
         finally:
             conn.close()
@@ -114,6 +153,17 @@ def loginUser():
         logger.error(f"Login error: {e}")
     return jsonify({'success': False, 'message': 'Invalid credentials'}), 401
 
+@user_bp.route('/api/user/logout', methods=['POST'])
+@require_token(kind='user')
+def logoutUser():
+    """Kết thúc phiên kiosk: thu hồi token đang dùng."""
+    try:
+        revoke_token(g.identity['jti'], g.identity['sub'], g.identity['exp'])
+        return jsonify({'success': True})
+    except Exception as e:
+        logger.error(f"Logout error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
 @user_bp.route('/api/user/<string:user_id>', methods=['GET'])
 def get_user_by_id(user_id):
     try:
@@ -225,6 +275,7 @@ def sync_user_profile():
                     password = EXCLUDED.password,
                     updated_at = EXCLUDED.updated_at
             """, (user_id, full_name, phone, email, pwd, created_at, now_iso))
+            notify(cursor, 'user', [user_id])
             conn.commit()
         except Exception:
             conn.rollback()
@@ -236,4 +287,171 @@ def sync_user_profile():
 
     except Exception as e:
         logger.error(f"Sync User Profile Error: {e}")
-        return jsonify({'success': False, 'message': str(e)}), 500
\ No newline at end of file
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+# Giới hạn số hồ sơ trong một lần đồng bộ hàng loạt
+MAX_SYNC_BATCH = 5000
+
+_SYNC_REQUIRED_FIELDS = ('user_id', 'full_name', 'phone_number', 'email')
+
+
+def _parse_utc(value):
+    """ISO 8601 -> datetime UTC (không có offset thì coi là UTC); ValueError nếu sai định dạng."""
+    if not isinstance(value, str):
+        raise ValueError('must be an ISO 8601 string')
+    ts = datetime.fromisoformat(value)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc)
+
+
+def _validate_sync_profile(p, now):
+    """Chuẩn hoá một hồ sơ đồng bộ; trả về (profile, None) hoặc (None, lý do không hợp lệ)."""
+    if not isinstance(p, dict):
+        return None, 'profile must be an object'
+    for field in _SYNC_REQUIRED_FIELDS:
+        value = p.get(field)
+        if not isinstance(value, str) or not value.strip():
+            return None, f'{field} must be a non-empty string'
+    password = p.get('password', '123456')
+    if not isinstance(password, str) or not password:
+        return None, 'password must be a non-empty string'
+    try:
+        updated_at = _parse_utc(p['updated_at']) if p.get('updated_at') is not None else now
+    except ValueError:
+        return None, 'updated_at must be ISO 8601'
+    try:
+        created_at = _parse_utc(p['created_at']) if p.get('created_at') is not None else now
+    except ValueError:
+        return None, 'created_at must be ISO 8601'
+    return dict(p, password=password, updated_at=updated_at, created_at=created_at), None
+
+
+@user_bp.route('/api/user/sync_profiles', methods=['POST'])
+def sync_user_profiles():
+    """
+    Máy đồng bộ nhiều hồ sơ khách hàng (đăng ký offline) trong MỘT câu lệnh:
+    INSERT ... SELECT FROM unnest(...) ON CONFLICT DO UPDATE.
+    - Last-writer-wins theo updated_at: bản ghi cũ hơn DB sẽ bị bỏ qua (status 'stale') -> gửi lại an toàn.
+    - Trùng SĐT/Email với khách khác -> status 'conflict' cho riêng bản ghi đó, không hỏng cả lô.
+    - Thiếu / sai kiểu user_id, full_name, phone_number, email hoặc updated_at không phải ISO 8601
+      -> status 'invalid' (kèm 'index' trong lô), các bản ghi khác vẫn được ghi.
+    """
+    try:
+        data = request.get_json(silent=True)
+        profiles = data.get('profiles') if isinstance(data, dict) else None
+        if not isinstance(profiles, list) or not profiles:
+            return jsonify({'success': False, 'message': 'profiles phải là danh sách không rỗng'}), 400
+        if len(profiles) > MAX_SYNC_BATCH:
+            return jsonify({'success': False, 'message': f'Tối đa {MAX_SYNC_BATCH} hồ sơ mỗi lần'}), 413
+
+        now = datetime.now(timezone.utc)
+        results = {}
+        invalid = []
+
+        # 1. Lọc trong lô: mỗi user_id giữ bản mới nhất; SĐT/Email trùng giữa các user_id khác nhau -> conflict
+        latest = {}
+        for index, raw in enumerate(profiles):
+            p, error = _validate_sync_profile(raw, now)
+            if error:
+                user_id = raw.get('user_id') if isinstance(raw, dict) and isinstance(raw.get('user_id'), str) else None
+                invalid.append({'index': index, 'user_id': user_id, 'status': 'invalid', 'message': error})
+                continue
+            user_id = p['user_id']
+            if user_id not in latest or p['updated_at'] >= latest[user_id]['updated_at']:
+                latest[user_id] = p
+
+        owners = {}
+        batch = []
+        for user_id, p in latest.items():
+            clash = None
+            for field in ('phone_number', 'email'):
+                key = (field, p.get(field))
+                if p.get(field) and key in owners:
+                    clash = {'status': 'conflict', 'field': field, 'existing_user_id': owners[key]}
+                    break
+            if clash:
+                results[user_id] = clash
+                continue
+            owners[('phone_number', p.get('phone_number'))] = user_id
+            owners[('email', p.get('email'))] = user_id
+            batch.append(p)
+
+        if batch:
+            columns = (
+                [p['user_id'] for p in batch],
+                [p['full_name'] for p in batch],
+                [p['phone_number'] for p in batch],
+                [p['email'] for p in batch],
+                [p['password'] for p in batch],
+                [p['created_at'].isoformat() for p in batch],
+                [p['updated_at'].isoformat() for p in batch],
+            )
+            conn = getDatabaseConnection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    WITH incoming AS (
+                        SELECT * FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[],
+                                             %s::text[], %s::text[], %s::text[])
+                            AS t(user_id, full_name, phone_number, email, password, created_at, updated_at)
+                    ),
+                    conflicts AS (
+                        SELECT DISTINCT ON (i.user_id)
+                               i.user_id,
+                               CASE WHEN u.phone_number = i.phone_number THEN 'phone_number' ELSE 'email' END AS field,
+                               u.user_id AS existing_user_id
+                        FROM incoming i
+                        JOIN users u ON (u.phone_number = i.phone_number OR u.email = i.email)
+                                    AND u.user_id <> i.user_id
+                        ORDER BY i.user_id
+                    ),
+                    upserted AS (
+                        INSERT INTO users (user_id, full_name, phone_number, email, password, points, status, created_at, updated_at)
+                        SELECT i.user_id, i.full_name, i.phone_number, i.email, i.password, 0, 'active', i.created_at, i.updated_at
+                        FROM incoming i
+                        WHERE NOT EXISTS (SELECT 1 FROM conflicts c WHERE c.user_id = i.user_id)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                            full_name = EXCLUDED.full_name,
+                            phone_number = EXCLUDED.phone_number,
+                            email = EXCLUDED.email,
+                            password = EXCLUDED.password,
+                            updated_at = EXCLUDED.updated_at
+                        WHERE users.updated_at::timestamptz <= EXCLUDED.updated_at::timestamptz
+                        RETURNING users.user_id, (xmax = 0) AS inserted
+                    )
+                    SELECT i.user_id,
+                           CASE WHEN c.user_id IS NOT NULL THEN 'conflict'
+                                WHEN up.user_id IS NULL THEN 'stale'
+                                WHEN up.inserted THEN 'inserted'
+                                ELSE 'updated' END AS status,
+                           c.field, c.existing_user_id
+                    FROM incoming i
+                    LEFT JOIN conflicts c ON c.user_id = i.user_id
+                    LEFT JOIN upserted up ON up.user_id = i.user_id
+                """, columns)
+                for user_id, status, field, existing_user_id in cursor.fetchall():
+                    result = {'status': status}
+                    if status == 'conflict':
+                        result.update(field=field, existing_user_id=existing_user_id)
+                    results[user_id] = result
+                notify(cursor, 'user', [u for u, r in results.items() if r['status'] in ('inserted', 'updated')])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+
+        summary = Counter(r['status'] for r in results.values())
+        if invalid:
+            summary['invalid'] = len(invalid)
+        logSystemEvent('user_bulk_sync', f'Synced {len(batch)} profiles', metadata=dict(summary))
+        return jsonify({
+            'success': True,
+            'summary': dict(summary),
+            'results': [{'user_id': uid, **r} for uid, r in results.items()] + invalid,
+        })
+    except Exception as e:
+        logger.error(f"Bulk Sync User Profiles Error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
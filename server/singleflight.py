@@ -0,0 +1,54 @@
+"""
+Single-flight: concurrent calls with the same key share one execution.
+
+Used by the catalog endpoints so that a burst of identical requests reaching
+the same worker (threaded / gevent workers) runs the query once and every
+waiting caller receives the same result. Nothing is cached afterwards: a call
+that starts after the leader finished runs again.
+"""
+
+import threading
+from collections import Counter
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = Counter()   # executed / shared
+
+    def do(self, key, fn):
+        """Run fn() unless a call for key is already in flight, in which case wait for its result."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            self.stats["shared"] += 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            self.stats["executed"] += 1
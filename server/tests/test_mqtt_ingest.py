@@ -0,0 +1,131 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import json
+
+import pytest
+
+import mqtt_ingest
+from mqtt_ingest import TOPIC_SALES, TOPIC_STOCK, InProcessBroker, TelemetryIngestor
+
+
+class FakeConnection:
+    closed = 0
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Replace the Postgres write with a recorder; a sale with message_id "poison" fails the transaction."""
+    rows = []
+
+    def fake_write_batch(conn, sales, stock_reports):
+        if any(msg["message_id"] == "poison" for _, msg in sales):
+            raise RuntimeError("violates check constraint")
+        # write_batch đọc các trường này: phải đúng kiểu sau khi normalize
+        for _, msg in sales:
+            assert isinstance(msg["total_amount"], float)
+            assert all(isinstance(item["quantity"], int) for item in msg["items"])
+        for _, msg in stock_reports:
+            assert all(isinstance(item["units_left"], int) for item in msg["items"])
+        rows.extend(msg["message_id"] for _, msg in sales + stock_reports)
+        return set(), []
+
+    monkeypatch.setattr(mqtt_ingest, "write_batch", fake_write_batch)
+    return rows
+
+
+@pytest.fixture
+def broker():
+    return InProcessBroker()
+
+
+@pytest.fixture
+def ingestor(broker):
+    ingestor = TelemetryIngestor(broker, connect=FakeConnection, batch_size=100, flush_interval=0.01)
+    broker.subscribe(TOPIC_SALES, ingestor.handle_message)
+    broker.subscribe(TOPIC_STOCK, ingestor.handle_message)
+    return ingestor
+
+
+def _sale(message_id, **fields):
+    msg = {"message_id": message_id, "total_amount": 15000, "items": [{"item_name": "Coke", "quantity": 1}]}
+    msg.update(fields)
+    return json.dumps(msg)
+
+
+def _acks(broker, device_id):
+    acks = {}
+    for topic, payload in broker.published:
+        if topic == f"vending_machine/{device_id}/ack":
+            body = json.loads(payload)
+            for message_id in body["message_ids"]:
+                acks[message_id] = body["status"]
+    return acks
+
+
+@pytest.mark.parametrize("bad", [
+    {"total_amount": "abc"},
+    {"total_amount": None},
+    {"items": ["Coke"]},
+    {"items": "Coke"},
+    {"items": [{"item_name": "Coke", "quantity": "two"}]},
+    {"customer_info": "U1"},
+    {"created_at": "yesterday"},
+])
+def test_malformed_sale_is_rejected_without_blocking_batch(broker, ingestor, written, bad):
+    broker.publish("vending_machine/VM001/sales", _sale("m1"))
+    broker.publish("vending_machine/VM001/sales", _sale("bad", **bad))
+    broker.publish("vending_machine/VM002/sales", _sale("m2", total_amount="5000"))
+
+    assert ingestor.flush(ingestor._drain())
+    assert written == ["m1", "m2"]
+    assert _acks(broker, "VM001") == {"m1": "ok", "bad": "rejected"}
+    assert _acks(broker, "VM002") == {"m2": "ok"}
+    assert ingestor.stats["rejected"] == 1
+
+
+def test_invalid_json_is_rejected_without_blocking_batch(broker, ingestor, written):
+    broker.publish("vending_machine/VM001/sales", b"not json")
+    broker.publish("vending_machine/VM001/sales", _sale("m1"))
+    broker.publish("vending_machine/VM001/sales", json.dumps(["no", "message_id"]))
+
+    assert ingestor.flush(ingestor._drain())
+    assert written == ["m1"]
+    # Không có message_id để ack -> chỉ ack tin hợp lệ
+    assert _acks(broker, "VM001") == {"m1": "ok"}
+    assert ingestor.stats["rejected"] == 2
+
+
+def test_malformed_stock_report_is_rejected(broker, ingestor, written):
+    broker.publish("vending_machine/VM001/stock", json.dumps({"message_id": "s1", "items": [{"item_name": "Coke", "units_left": "4"}]}))
+    broker.publish("vending_machine/VM001/stock", json.dumps({"message_id": "s2", "items": [{"item_name": "Coke", "units_left": "many"}]}))
+    broker.publish("vending_machine/VM001/stock", json.dumps({"message_id": "s3", "items": {"Coke": 4}}))
+
+    assert ingestor.flush(ingestor._drain())
+    assert written == ["s1"]
+    assert _acks(broker, "VM001") == {"s1": "ok", "s2": "rejected", "s3": "rejected"}
+
+
+def test_failed_batch_is_retried_one_message_at_a_time(broker, ingestor, written):
+    broker.publish("vending_machine/VM001/sales", _sale("m1"))
+    broker.publish("vending_machine/VM001/sales", _sale("poison"))
+    broker.publish("vending_machine/VM002/sales", _sale("m2"))
+
+    assert not ingestor.flush(ingestor._drain())
+    assert written == ["m1", "m2"]
+    # Tin lỗi không được ack và được phép gửi lại
+    assert _acks(broker, "VM001") == {"m1": "ok"}
+    assert _acks(broker, "VM002") == {"m2": "ok"}
+    broker.publish("vending_machine/VM001/sales", _sale("poison"))
+    assert ingestor.stats["duplicates"] == 0
+    assert ingestor.stats["failed"] == 1